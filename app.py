@@ -6,10 +6,40 @@ import msal
 from datetime import datetime, timedelta
 import pytz
 import time
+import re
+import hashlib
+import bisect
+import json
+import os
+import unicodedata
+import sys
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    TIPO_TEXTO_COMPACTO = 'string[pyarrow]'
+except ImportError:
+    pa = None
+    pc = None
+    TIPO_TEXTO_COMPACTO = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
 # =========================================================
 # CONFIGURAÇÕES INICIAIS
 # =========================================================
@@ -18,6 +48,10 @@ pd.set_option('display.max_columns', None)
 pd.set_option('display.width', None)
 pd.set_option('display.max_colwidth', None)
 
+# O snapshot é compartilhado entre sessões: alterações locais nunca podem escrever nele
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 st.set_page_config(
     page_title="Dashboard de Campanhas - SICOOB COCRED", 
     layout="wide",
@@ -140,6 +174,13 @@ USUARIO_PRINCIPAL = "cristini.cordesco@ideatoreamericas.com"
 SHAREPOINT_FILE_ID = "01S7YQRRWMBXCV3AAHYZEIZGL55EPOZULE"
 SHEET_NAME = "Demandas ID"
 
+# "pandas" (padrão) ou "polars": motor das consultas que varrem linhas (filtros e KPIs fora do cubo)
+MOTOR_CONSULTAS = st.secrets.get("MOTOR_CONSULTAS", "pandas")
+
+# Modo aproximado (opt-in): só vale a partir deste número de linhas; abaixo disso tudo é exato
+MODO_APROXIMADO = bool(st.secrets.get("MODO_APROXIMADO", False))
+LIMIAR_LINHAS_APROXIMADO = int(st.secrets.get("LIMIAR_LINHAS_APROXIMADO", 200_000))
+
 # =========================================================
 # AUTENTICAÇÃO
 # =========================================================
@@ -179,7 +220,28 @@ def get_access_token():
 # =========================================================
 # CARREGAR DADOS
 # =========================================================
-@st.cache_data(ttl=60, show_spinner="🔄 Baixando dados do Excel...")
+@st.cache_data(ttl=60, show_spinner=False)
+def obter_versao_planilha():
+    """eTag do arquivo no SharePoint; o snapshot só é reconstruído quando ela muda"""
+    access_token = get_access_token()
+    if not access_token:
+        return 'exemplo'
+    
+    file_url = f"https://graph.microsoft.com/v1.0/users/{USUARIO_PRINCIPAL}/drive/items/{SHAREPOINT_FILE_ID}?$select=eTag,lastModifiedDateTime"
+    
+    try:
+        response = requests.get(file_url, headers={"Authorization": f"Bearer {access_token}"}, timeout=15)
+        if response.status_code == 200:
+            metadados = response.json()
+            versao = metadados.get('eTag') or metadados.get('lastModifiedDateTime')
+            if versao:
+                return versao
+    except Exception:
+        pass
+    
+    # Sem metadados: uma versão por minuto, como o cache antigo
+    return f"minuto-{int(time.time() // 60)}"
+
 def carregar_dados_excel_online():
     access_token = get_access_token()
     if not access_token:
@@ -199,12 +261,12 @@ def carregar_dados_excel_online():
             excel_file = BytesIO(response.content)
             
             try:
-                df = pd.read_excel(excel_file, sheet_name=SHEET_NAME, engine='openpyxl')
+                df = ler_planilha(excel_file, sheet_name=SHEET_NAME)
                 return df
             except Exception as e:
                 st.warning(f"⚠️ Erro na aba '{SHEET_NAME}': {str(e)[:100]}")
                 excel_file.seek(0)
-                df = pd.read_excel(excel_file, engine='openpyxl')
+                df = ler_planilha(excel_file)
                 return df
         else:
             return pd.DataFrame()
@@ -222,32 +284,10 @@ def calcular_altura_tabela(num_linhas, num_colunas):
     altura_maxima = 2000
     return min(altura_conteudo, altura_maxima)
 
-def converter_para_data(df, coluna):
-    try:
-        df[coluna] = pd.to_datetime(df[coluna], errors='coerce', dayfirst=True)
-    except:
-        pass
-    return df
-
-def extrair_tipo_demanda(df, texto):
-    count = 0
-    for col in df.columns:
-        if df[col].dtype == 'object':
-            try:
-                count += len(df[df[col].astype(str).str.contains(texto, na=False, case=False)])
-            except:
-                pass
-    return count
-
-# =========================================================
-# CARREGAR DADOS
-# =========================================================
-with st.spinner("📥 Carregando dados do Excel..."):
-    df = carregar_dados_excel_online()
+def eh_coluna_texto(serie):
+    return (pd.api.types.is_object_dtype(serie) or isinstance(serie.dtype, (pd.StringDtype, pd.CategoricalDtype)))
 
-if df.empty:
-    st.warning("⚠️ Não foi possível carregar os dados do SharePoint. Usando dados de exemplo...")
-    
+def gerar_dados_exemplo():
     dados_exemplo = {
         'ID': range(1, 501),
         'Status': ['Aprovado', 'Em Produção', 'Aguardando Aprovação', 'Concluído', 'Solicitação de Ajustes'] * 100,
@@ -265,302 +305,2819 @@ if df.empty:
         'Peça': ['PEÇA AVULSA - DERIVAÇÃO', 'CAMPANHA - ESTRATÉGIA', 'CAMPANHA - ANÚNCIO',
                 'CAMPANHA - LP/TKY', 'CAMPANHA - RELATÓRIO', 'CAMPANHA - KV'] * 83 + ['PEÇA AVULSA - DERIVAÇÃO'] * 2
     }
-    df = pd.DataFrame(dados_exemplo)
-
-# Converter datas
-for col in ['Data de Solicitação', 'Deadline', 'Data de Entrega']:
-    if col in df.columns:
-        df = converter_para_data(df, col)
-        if pd.api.types.is_datetime64_any_dtype(df[col]):
-            df[col] = df[col].dt.tz_localize(None)
+    return pd.DataFrame(dados_exemplo)
 
 # =========================================================
-# CALCULAR MÉTRICAS
+# ESQUEMA DA ABA "Demandas ID"
 # =========================================================
-total_linhas = len(df)
-total_colunas = len(df.columns)
+# Papel semântico -> tipo esperado, nomes aceitos (comparados sem acento/minúsculas)
+# e trechos aceitos quando nenhum nome bate exatamente.
+PAPEIS_COLUNAS = {
+    'id': {'tipo': 'inteiro', 'nomes': ['ID', 'Id Demanda', 'Código Jira', 'Código']},
+    'data_solicitacao': {'tipo': 'data', 'nomes': ['Data de Solicitação', 'Data Solicitação', 'Solicitado em']},
+    'deadline': {'tipo': 'data', 'nomes': ['Deadline', 'Prazo', 'Data Entrega', 'Data de Entrega'],
+                 'trechos': ['deadline', 'prazo', 'data entrega']},
+    'data_entrega': {'tipo': 'data', 'nomes': ['Data de Entrega', 'Data Entrega', 'Entregue em']},
+    'status': {'tipo': 'texto', 'nomes': ['Status', 'Situação']},
+    'prioridade': {'tipo': 'texto', 'nomes': ['Prioridade']},
+    'producao': {'tipo': 'texto', 'nomes': ['Produção', 'Equipe']},
+    'solicitante': {'tipo': 'texto', 'nomes': ['Solicitante', 'Solicitado por', 'Origem']},
+    'campanha': {'tipo': 'texto', 'nomes': ['Campanha', 'Campanha ou Ação']},
+    'tipo': {'tipo': 'texto', 'nomes': ['Tipo', 'Tipo de Demanda']},
+    'tipo_atividade': {'tipo': 'texto', 'nomes': ['Tipo Atividade', 'Tipo de Atividade']},
+    'peca': {'tipo': 'texto', 'nomes': ['Peça', 'Peças']},
+}
+PAPEIS_DATA = ['data_solicitacao', 'deadline', 'data_entrega']
 
-total_concluidos = 0
-if 'Status' in df.columns:
-    total_concluidos = len(df[df['Status'].str.contains('Concluído|Aprovado', na=False, case=False)])
+def impressao_esquema(colunas):
+    return hashlib.sha1('\x1f'.join(map(str, colunas)).encode('utf-8')).hexdigest()[:12]
 
-total_alta = 0
-if 'Prioridade' in df.columns:
-    total_alta = len(df[df['Prioridade'].str.contains('Alta', na=False, case=False)])
+@st.cache_data(show_spinner=False)
+def resolver_esquema(colunas):
+    """Mapeia papéis para colunas físicas; o resultado fica em cache por impressão do cabeçalho"""
+    normalizadas = {col: normalizar_texto(col) for col in colunas}
+    mapa = {}
+    
+    for papel, definicao in PAPEIS_COLUNAS.items():
+        nomes = [normalizar_texto(nome) for nome in definicao['nomes']]
+        mapa[papel] = next((col for nome in nomes for col, norm in normalizadas.items() if norm == nome), None)
+    
+    usadas = {col for col in mapa.values() if col}
+    for papel, definicao in PAPEIS_COLUNAS.items():
+        if mapa[papel] is None:
+            for trecho in definicao.get('trechos', []):
+                mapa[papel] = next((col for col, norm in normalizadas.items() if trecho in norm and col not in usadas), None)
+                if mapa[papel]:
+                    usadas.add(mapa[papel])
+                    break
+    
+    # Texto é lido como objeto para o leitor não inferir tipos
+    dtypes = {col: object for papel, col in mapa.items() if col and PAPEIS_COLUNAS[papel]['tipo'] == 'texto'}
+    
+    return {
+        'impressao': impressao_esquema(colunas),
+        'colunas_fisicas': list(colunas),
+        'colunas': mapa,
+        'dtypes': dtypes,
+        'ausentes': [papel for papel, col in mapa.items() if col is None],
+    }
+
+@st.cache_resource
+def historico_esquema():
+    return {'ultimo': None}
 
-total_hoje = 0
-if 'Data de Solicitação' in df.columns:
-    hoje = datetime.now().date()
-    total_hoje = len(df[pd.to_datetime(df['Data de Solicitação']).dt.date == hoje])
+def detectar_deriva(esquema):
+    """Compara com o último esquema visto neste processo"""
+    historico = historico_esquema()
+    anterior = historico['ultimo']
+    historico['ultimo'] = esquema
+    if anterior is None or anterior['impressao'] == esquema['impressao']:
+        return None
+    
+    return {
+        'removidas': [c for c in anterior['colunas_fisicas'] if c not in esquema['colunas_fisicas']],
+        'novas': [c for c in esquema['colunas_fisicas'] if c not in anterior['colunas_fisicas']],
+        'papeis_perdidos': [p for p in esquema['ausentes'] if p not in anterior['ausentes']],
+    }
 
-if 'Tipo' in df.columns:
-    criacoes = len(df[df['Tipo'].str.contains('Criação|Criacao', na=False, case=False)])
-    derivacoes = len(df[df['Tipo'].str.contains('Derivação|Derivacao|Peça|Peca', na=False, case=False)])
-    extra_contrato = len(df[df['Tipo'].str.contains('Extra|Contrato', na=False, case=False)])
-else:
-    criacoes = extrair_tipo_demanda(df, 'Criação|Criacao|Novo|New')
-    derivacoes = extrair_tipo_demanda(df, 'Derivação|Derivacao|Peça|Peca')
-    extra_contrato = extrair_tipo_demanda(df, 'Extra|Contrato')
+def rotulo_papel(papel):
+    return PAPEIS_COLUNAS[papel]['nomes'][0]
 
-if 'Campanha' in df.columns:
-    campanhas_unicas = df['Campanha'].nunique()
-else:
-    campanhas_unicas = len(df['ID'].unique()) // 50 if 'ID' in df.columns else 12
+def ler_planilha(excel_file, **kwargs):
+    cabecalho = pd.read_excel(excel_file, engine='openpyxl', nrows=0, **kwargs).columns
+    esquema = resolver_esquema(tuple(cabecalho))
+    excel_file.seek(0)
+    return pd.read_excel(excel_file, engine='openpyxl', dtype=esquema['dtypes'], **kwargs)
 
 # =========================================================
-# SIDEBAR
+# NORMALIZAÇÃO DE DATAS
 # =========================================================
-with st.sidebar:
-    st.markdown("""
-    <div style="text-align: center; margin-bottom: 20px;">
-        <h1 style="color: #003366; font-size: 28px; margin: 0;">📊 COCRED</h1>
-        <p style="color: #00A3E0; font-size: 12px; margin: 0;">Dashboard de Campanhas</p>
-    </div>
-    """, unsafe_allow_html=True)
+FORMATOS_DATA = [
+    '%d/%m/%Y', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d/%m/%y',
+    '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+]
+TAMANHO_AMOSTRA_FORMATO = 50
+LIMITE_MEMO_DATAS = 200_000
+
+@st.cache_resource
+def memo_datas():
+    """Texto -> Timestamp e formato detectado por coluna, compartilhados entre cargas"""
+    return {'valores': {}, 'formatos': {}}
+
+def detectar_formato(textos):
+    amostra = pd.Series(textos[:TAMANHO_AMOSTRA_FORMATO], dtype=object)
+    melhor_formato, melhor_acertos = None, 0
+    for formato in FORMATOS_DATA:
+        acertos = pd.to_datetime(amostra, format=formato, errors='coerce').notna().sum()
+        if acertos > melhor_acertos:
+            melhor_formato, melhor_acertos = formato, acertos
+    return melhor_formato
+
+def converter_textos_data(textos, formato):
+    convertidos = pd.Series(pd.NaT, index=range(len(textos)), dtype='datetime64[ns]')
+    textos = pd.Series(textos, dtype=object)
+    if formato:
+        convertidos = pd.to_datetime(textos, format=formato, errors='coerce')
     
-    st.divider()
+    # O que não seguiu o formato da coluna cai em ISO 8601 e depois na inferência (dia primeiro)
+    for formato_alternativo, dia_primeiro in [('ISO8601', False), ('mixed', True)]:
+        restantes = convertidos.isna()
+        if not restantes.any():
+            break
+        convertidos[restantes] = pd.to_datetime(textos[restantes], format=formato_alternativo, dayfirst=dia_primeiro, errors='coerce')
+    return convertidos
+
+def normalizar_datas(serie, coluna):
+    """Converte uma coluna em datetime64 analisando cada valor distinto uma única vez.
+    Retorna a coluna convertida e a lista de valores que não puderam ser convertidos."""
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        if getattr(serie.dt, 'tz', None) is not None:
+            serie = serie.dt.tz_localize(None)
+        return serie, []
     
-    st.markdown("### 🔄 **Atualização**")
+    memo = memo_datas()
+    if len(memo['valores']) > LIMITE_MEMO_DATAS:
+        memo['valores'].clear()
     
-    col1, col2 = st.columns(2)
+    codigos, valores = pd.factorize(serie)
+    convertidos = pd.Series(pd.NaT, index=range(len(valores)), dtype='datetime64[ns]')
     
-    with col1:
-        if st.button("🔄 Atualizar", type="primary", use_container_width=True):
-            st.cache_data.clear()
-            st.toast("✅ Cache limpo! Atualizando...")
-            time.sleep(1)
-            st.rerun()
+    eh_texto = np.array([isinstance(v, str) for v in valores], dtype=bool)
     
-    with col2:
-        if st.button("🗑️ Limpar Cache", type="secondary", use_container_width=True):
-            st.cache_data.clear()
-            st.cache_resource.clear()
-            st.toast("🧹 Cache completamente limpo!")
-            time.sleep(1)
-            st.rerun()
+    # Valores já tipados pelo Excel (datetime, números) convertem direto
+    if (~eh_texto).any():
+        convertidos[~eh_texto] = pd.to_datetime(pd.Series(valores[~eh_texto], dtype=object), errors='coerce').to_numpy()
     
-    token = get_access_token()
-    if token:
-        st.success("✅ **Conectado** | Token ativo", icon="🔌")
-    else:
-        st.warning("⚠️ **Offline** | Usando dados de exemplo", icon="💾")
+    textos = [v.strip() for v in valores[eh_texto]]
+    novos = [t for t in textos if t not in memo['valores']]
+    if novos:
+        formato = memo['formatos'].get(coluna)
+        if formato is None or pd.to_datetime(pd.Series(novos[:TAMANHO_AMOSTRA_FORMATO], dtype=object), format=formato, errors='coerce').isna().all():
+            formato = detectar_formato(novos)
+            memo['formatos'][coluna] = formato
+        memo['valores'].update(zip(novos, converter_textos_data(novos, formato)))
     
-    st.divider()
+    if textos:
+        convertidos[eh_texto] = pd.to_datetime(pd.Series([memo['valores'][t] for t in textos], dtype=object)).to_numpy()
     
-    st.markdown("### 👁️ **Visualização**")
+    nao_convertidos = [str(v) for v, data in zip(valores, convertidos) if pd.isna(data) and str(v).strip()]
     
-    linhas_por_pagina = st.selectbox(
-        "📋 Linhas por página:",
-        ["50", "100", "200", "500", "Todas"],
-        index=1
-    )
+    resultado = np.append(convertidos.to_numpy(), np.datetime64('NaT'))[codigos]
+    return pd.Series(resultado, index=serie.index, name=serie.name), nao_convertidos
+
+# =========================================================
+# COLUNAS DERIVADAS (CALCULADAS UMA VEZ POR CARGA)
+# =========================================================
+CHAVE_NULA = np.iinfo(np.int32).min  # Sentinela para datas vazias (NaT)
+
+def dia_epoca(data):
+    """Converte uma data em dias desde 01/01/1970"""
+    return int(np.datetime64(pd.Timestamp(data).date(), 'D').astype(np.int64))
+
+def data_epoca(dia):
+    """Inverso de dia_epoca"""
+    return pd.Timestamp(int(dia), unit='D').date()
+
+def rotulo_mes(chave_mes):
+    return str(np.datetime64(int(chave_mes), 'M'))
+
+def chaves_inteiras(serie, unidade):
+    valores = serie.to_numpy(dtype='datetime64[ns]').astype(f'datetime64[{unidade}]').astype(np.int64)
+    valores[pd.isna(serie).to_numpy()] = CHAVE_NULA
+    return valores.astype(np.int32)
+
+def propagar_por_codigo(codigos, valores):
+    """Propaga para as linhas um resultado calculado por valor distinto"""
+    codigos_valores, categorias = pd.factorize(pd.Series(valores, dtype=object))
+    codigos_valores = np.append(codigos_valores, -1)  # código -1 (vazio) continua vazio
+    return pd.Categorical.from_codes(codigos_valores[codigos], categories=categorias)
+
+def normalizar_texto(valor):
+    return unicodedata.normalize('NFKD', str(valor)).encode('ascii', 'ignore').decode('ascii').lower().strip()
+
+def dobrar_texto(serie):
+    """Minúsculas e sem acentos, calculado uma única vez por valor distinto"""
+    codigos, valores = pd.factorize(serie)
+    return propagar_por_codigo(codigos, [normalizar_texto(v) for v in valores])
+
+def adicionar_colunas_derivadas(df, colunas):
+    """Chaves inteiras de mês/dia e textos normalizados, alinhados por posição com df"""
+    derivadas = pd.DataFrame(index=df.index)
     
-    modo_compacto = st.checkbox("📏 Modo compacto", value=False)
+    for papel in PAPEIS_DATA:
+        col = colunas[papel]
+        if col and pd.api.types.is_datetime64_any_dtype(df[col]):
+            derivadas[f'dia_{papel}'] = chaves_inteiras(df[col], 'D')
     
-    if modo_compacto:
-        st.markdown("""
-        <style>
-            .block-container {padding-top: 1rem; padding-bottom: 0rem;}
-            .stMetric {padding: 0.5rem;}
-        </style>
-        """, unsafe_allow_html=True)
+    col_solicitacao = colunas['data_solicitacao']
+    if col_solicitacao and pd.api.types.is_datetime64_any_dtype(df[col_solicitacao]):
+        derivadas['chave_mes'] = chaves_inteiras(df[col_solicitacao], 'M')
     
-    st.divider()
+    for col in df.columns:
+        if eh_coluna_texto(df[col]):
+            derivadas[f'txt_{col}'] = dobrar_texto(df[col])
     
-    st.markdown("### 📊 **Resumo Executivo**")
+    return derivadas
+
+# =========================================================
+# ARMAZENAMENTO COMPACTO
+# =========================================================
+# Texto com poucos valores distintos (em relação ao nº de linhas) vira category;
+# o restante vai para string[pyarrow] quando o pyarrow está disponível.
+FRACAO_MAXIMA_CATEGORIA = 0.5
+
+def compactar_dataframe(df, colunas_protegidas):
+    """Reduz a memória do DataFrame e devolve o relatório por coluna (antes/depois)"""
+    antes = df.memory_usage(deep=True, index=False)
+    tipos_antes = df.dtypes.astype(str)
     
-    col_m1, col_m2 = st.columns(2)
+    # Colunas totalmente vazias saem, exceto as que têm papel no esquema
+    vazias = [col for col in df.columns if col not in colunas_protegidas and df[col].isna().all()]
+    df = df.drop(columns=vazias)
     
-    with col_m1:
-        st.metric(label="📋 Total de Registros", value=f"{total_linhas:,}", delta=None)
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_integer_dtype(serie):
+            df[col] = pd.to_numeric(serie, downcast='integer')
+        elif eh_coluna_texto(serie) and pd.api.types.infer_dtype(serie, skipna=True) == 'string':
+            # Colunas com tipos misturados (texto e número) ficam como estão
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                continue
+            if serie.nunique() <= FRACAO_MAXIMA_CATEGORIA * serie.notna().sum():
+                df[col] = serie.astype('category')
+            elif TIPO_TEXTO_COMPACTO:
+                df[col] = serie.astype(TIPO_TEXTO_COMPACTO)
     
-    with col_m2:
-        percentual_concluidos = (total_concluidos / total_linhas * 100) if total_linhas > 0 else 0
-        st.metric(label="✅ Concluídos/Aprovados", value=f"{total_concluidos:,}", delta=f"{percentual_concluidos:.0f}%")
+    depois = df.memory_usage(deep=True, index=False)
+    relatorio = pd.DataFrame({
+        'Coluna': antes.index,
+        'Tipo antes': tipos_antes.reindex(antes.index).to_numpy(),
+        'Antes (KB)': (antes / 1024).round(1).to_numpy(),
+        'Tipo depois': [str(df[col].dtype) if col in df.columns else 'removida' for col in antes.index],
+        'Depois (KB)': [round(depois[col] / 1024, 1) if col in depois.index else 0.0 for col in antes.index],
+    })
+    return df, relatorio
+
+# =========================================================
+# REGRAS DE CLASSIFICAÇÃO
+# =========================================================
+# Padrões aplicados sobre o texto normalizado (minúsculas, sem acento) da coluna do papel.
+# 'padrao_sem_coluna' é usado em todas as colunas de texto quando o papel não tem coluna.
+REGRAS_CLASSIFICACAO = {
+    'criacao': {'papel': 'tipo', 'padrao': r'criacao', 'padrao_sem_coluna': r'criacao|novo|new'},
+    'derivacao': {'papel': 'tipo', 'padrao': r'derivacao|peca', 'padrao_sem_coluna': r'derivacao|peca'},
+    'extra_contrato': {'papel': 'tipo', 'padrao': r'extra|contrato', 'padrao_sem_coluna': r'extra|contrato'},
+    'concluido_aprovado': {'papel': 'status', 'padrao': r'concluido|aprovado'},
+    'aguardando': {'papel': 'status', 'padrao': r'aguardando'},
+    'em_producao': {'papel': 'status', 'padrao': r'producao'},
+    'aprovado': {'papel': 'status', 'padrao': r'aprovado'},
+    'concluido': {'papel': 'status', 'padrao': r'concluido'},
+    'prioridade_alta': {'papel': 'prioridade', 'padrao': r'alta'},
+}
+
+# "CAMPANHA - KV" -> família "CAMPANHA", item "KV"
+REGRA_PECA = {'papel': 'peca', 'separador': r'\s+-\s+'}
+
+@st.cache_resource
+def compilar_regras():
+    regras = {}
+    for nome, regra in REGRAS_CLASSIFICACAO.items():
+        regras[nome] = {
+            'papel': regra['papel'],
+            'padrao': re.compile(regra['padrao']),
+            'padrao_sem_coluna': re.compile(regra['padrao_sem_coluna']) if 'padrao_sem_coluna' in regra else None,
+        }
+    regras['_peca'] = {'papel': REGRA_PECA['papel'], 'separador': re.compile(REGRA_PECA['separador'])}
+    return regras
+
+def avaliar_padrao(categorico, padrao):
+    """Avalia o padrão uma vez por categoria e propaga para as linhas pelos códigos"""
+    acertos = np.array([padrao.search(v) is not None for v in categorico.cat.categories] + [False])
+    return acertos[categorico.cat.codes.to_numpy()]
+
+def separar_peca(serie, separador):
+    codigos, valores = pd.factorize(serie)
+    partes = [separador.split(str(v).strip(), maxsplit=1) for v in valores]
+    familias = [p[0] for p in partes]
+    itens = [p[1] if len(p) > 1 else None for p in partes]
+    return propagar_por_codigo(codigos, familias), propagar_por_codigo(codigos, itens)
+
+def aplicar_regras(df, derivadas, colunas):
+    """Acrescenta às colunas derivadas as flags 'regra_*' e a família/item da peça"""
+    regras = compilar_regras()
+    colunas_texto = [c for c in derivadas.columns if c.startswith('txt_')]
     
-    col_m3, col_m4 = st.columns(2)
+    for nome, regra in regras.items():
+        if nome == '_peca':
+            continue
+        coluna_txt = f"txt_{colunas[regra['papel']]}"
+        if coluna_txt in derivadas.columns:
+            derivadas[f'regra_{nome}'] = avaliar_padrao(derivadas[coluna_txt], regra['padrao'])
+        elif regra['padrao_sem_coluna'] is not None:
+            flags = np.zeros(len(derivadas), dtype=bool)
+            for col in colunas_texto:
+                flags |= avaliar_padrao(derivadas[col], regra['padrao_sem_coluna'])
+            derivadas[f'regra_{nome}'] = flags
     
-    with col_m3:
-        st.metric(label="🔴 Prioridade Alta", value=f"{total_alta:,}", delta=None)
+    regra_peca = regras['_peca']
+    if colunas[regra_peca['papel']]:
+        familia, item = separar_peca(df[colunas[regra_peca['papel']]], regra_peca['separador'])
+        derivadas['peca_familia'] = familia
+        derivadas['peca_item'] = item
     
-    with col_m4:
-        st.metric(label="📅 Solicitações Hoje", value=total_hoje, delta=None)
+    return derivadas
+
+def construir_snapshot(versao):
+    df = carregar_dados_excel_online() if versao != 'exemplo' else pd.DataFrame()
+    origem = 'excel'
     
-    st.divider()
+    if df.empty:
+        df = gerar_dados_exemplo()
+        origem = 'exemplo'
+        versao = 'exemplo'  # nunca sob o eTag real: o que é guardado por versão não pode misturar os dados de exemplo
     
-    st.markdown("### 🛠️ **Ferramentas**")
+    df = df.reset_index(drop=True)
+    esquema = resolver_esquema(tuple(df.columns))
+    colunas = esquema['colunas']
     
-    if 'debug_mode' not in st.session_state:
-        st.session_state.debug_mode = False
+    # Converter datas
+    datas_invalidas = {}
+    for col in dict.fromkeys(colunas[papel] for papel in PAPEIS_DATA if colunas[papel]):
+        df[col], nao_convertidos = normalizar_datas(df[col], col)
+        if nao_convertidos:
+            datas_invalidas[col] = nao_convertidos
     
-    debug_mode = st.checkbox("🐛 **Modo Debug**", value=st.session_state.debug_mode)
-    st.session_state.debug_mode = debug_mode
+    # Inteiros só são convertidos se todos os valores forem numéricos
+    for papel, col in colunas.items():
+        if col and PAPEIS_COLUNAS[papel]['tipo'] == 'inteiro' and not pd.api.types.is_integer_dtype(df[col]):
+            numeros = pd.to_numeric(df[col], errors='coerce')
+            if numeros.notna().sum() == df[col].notna().sum() and (numeros.dropna() % 1 == 0).all():
+                df[col] = numeros.astype('Int64')
     
-    auto_refresh = st.checkbox("🔄 **Auto-refresh (60s)**", value=False)
+    df, relatorio_memoria = compactar_dataframe(df, {col for col in colunas.values() if col})
     
-    st.divider()
+    derivadas = adicionar_colunas_derivadas(df, colunas)
+    derivadas = aplicar_regras(df, derivadas, colunas)
     
-    st.markdown("### ℹ️ **Informações**")
-    st.caption(f"🕐 **Última atualização:** {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+    carga = {
+        'origem': origem,
+        'relatorio_memoria': relatorio_memoria,
+        'datas_invalidas': datas_invalidas,
+        'esquema': esquema,
+        'deriva': detectar_deriva(esquema),
+    }
+    return Snapshot(versao, df, derivadas, carga)
+
+# =========================================================
+# ÍNDICE DE FILTROS (BITMAPS)
+# =========================================================
+PAPEIS_FILTRAVEIS = ['status', 'prioridade', 'producao', 'tipo', 'tipo_atividade', 'campanha', 'solicitante']
+LIMITE_BITMAPS_ANTECIPADOS = 256  # Colunas com mais valores distintos geram bitmaps sob demanda
+
+class IndiceFiltros:
+    """Códigos por coluna filtrável e um bitmap compactado (np.packbits) por valor.
+    Qualquer combinação de filtros vira um AND bit a bit e uma única máscara no final."""
     
-    st.markdown("""
-    **📎 Links úteis:**
-    - [📊 Abrir Excel Online](https://agenciaideatore-my.sharepoint.com/:x:/g/personal/cristini_cordesco_ideatoreamericas_com/IQDMDcVdgAfGSIyZfeke7NFkAatm3fhI0-X4r6gIPQJmosY)
-    """)
+    def __init__(self, df, colunas):
+        self.total_linhas = len(df)
+        self.codigos = {}
+        self.posicao_valor = {}
+        self._bitmaps = {}
+        
+        for col in colunas:
+            codigos, valores = pd.factorize(df[col])
+            self.codigos[col] = codigos
+            self.posicao_valor[col] = {valor: i for i, valor in enumerate(valores)}
+            if len(valores) <= LIMITE_BITMAPS_ANTECIPADOS:
+                for i, valor in enumerate(valores):
+                    self._bitmaps[(col, valor)] = np.packbits(codigos == i)
     
-    st.divider()
+    def bitmap(self, col, valor):
+        chave = (col, valor)
+        if chave not in self._bitmaps:
+            codigo = self.posicao_valor[col].get(valor)
+            linhas = self.codigos[col] == codigo if codigo is not None else np.zeros(self.total_linhas, dtype=bool)
+            self._bitmaps[chave] = np.packbits(linhas)
+        return self._bitmaps[chave]
     
-    st.markdown("""
-    <div style="text-align: center; color: #6C757D; font-size: 11px; padding: 10px 0;">
-        <p style="margin: 0;">Desenvolvido para</p>
-        <p style="margin: 0; font-weight: bold; color: #003366;">SICOOB COCRED</p>
-        <p style="margin: 5px 0 0 0;">© 2026 - Ideatore</p>
-        <p style="margin: 5px 0 0 0;">v4.2.0</p>
-    </div>
-    """, unsafe_allow_html=True)
+    def combinar(self, filtros, bitmaps_extras=()):
+        """AND de {coluna: valor} e de outros bitmaps (ex.: janelas de data); devolve a máscara por linha"""
+        bitmaps = [self.bitmap(col, valor) for col, valor in filtros.items()] + list(bitmaps_extras)
+        if not bitmaps:
+            return np.ones(self.total_linhas, dtype=bool)
+        bits = bitmaps[0].copy()
+        for outro in bitmaps[1:]:
+            np.bitwise_and(bits, outro, out=bits)
+        return np.unpackbits(bits, count=self.total_linhas).astype(bool)
 
 # =========================================================
-# INTERFACE PRINCIPAL
+# ÍNDICE ORDENADO DE DATAS
 # =========================================================
-st.markdown(f"""
-<div style="display: flex; align-items: center; margin-bottom: 20px;">
-    <h1 style="color: #003366; margin: 0;">📊 Dashboard de Campanhas</h1>
-    <span style="background: #00A3E0; color: white; padding: 5px 15px; border-radius: 20px; margin-left: 20px; font-size: 14px;">
-        SICOOB COCRED
-    </span>
-</div>
-""", unsafe_allow_html=True)
+DIA_MAXIMO = np.iinfo(np.int32).max
+LIMITE_JANELAS_DATA = 64
 
-st.caption(f"🔗 Conectado ao Excel Online | Aba: {SHEET_NAME}")
+class IndiceDatas:
+    """Posições das linhas ordenadas pelo dia; um intervalo de datas vira dois searchsorted.
+    As janelas já consultadas ficam guardadas como bitmaps (as predefinidas mudam só com o dia)."""
+    
+    def __init__(self, dias):
+        self.total_linhas = len(dias)
+        self.ordem = np.argsort(dias, kind='stable')
+        self.dias_ordenados = dias[self.ordem]
+        self._janelas = {}
+        self._trava = threading.Lock()  # o índice é compartilhado entre as sessões
+    
+    def limites(self, inicio, fim):
+        """inicio/fim em dias desde a época, inclusivos"""
+        return (int(np.searchsorted(self.dias_ordenados, inicio, side='left')),
+                int(np.searchsorted(self.dias_ordenados, fim, side='right')))
+    
+    def posicoes(self, inicio, fim):
+        ini, fim = self.limites(inicio, fim)
+        return self.ordem[ini:fim]
+    
+    def contar(self, inicio, fim):
+        ini, fim = self.limites(inicio, fim)
+        return fim - ini
+    
+    def bitmap(self, inicio, fim):
+        chave = (inicio, fim)
+        with self._trava:
+            bitmap = self._janelas.get(chave)
+        if bitmap is None:
+            linhas = np.zeros(self.total_linhas, dtype=bool)
+            linhas[self.posicoes(inicio, fim)] = True
+            bitmap = np.packbits(linhas)
+            with self._trava:
+                if len(self._janelas) >= LIMITE_JANELAS_DATA:
+                    self._janelas.clear()
+                self._janelas[chave] = bitmap
+        return bitmap
 
-st.success(f"✅ **{total_linhas} registros** carregados com sucesso!")
-st.info(f"📋 **Colunas:** {', '.join(df.columns.tolist()[:5])}{'...' if len(df.columns) > 5 else ''}")
+LIMITE_PERMUTACOES = 16
 
-# =========================================================
-# TABS
-# =========================================================
-tab1, tab2, tab3, tab4 = st.tabs([
-    "📊 Dados Completos", 
-    "📈 Análise Estratégica", 
-    "🔍 Pesquisa",
-    "🎯 KPIs COCRED"
-])
+class IndiceOrdenacao:
+    """Permutações (argsort estável) das linhas por coluna e sentido, calculadas na primeira vez que são pedidas.
+    Vazios ficam no fim nos dois sentidos, como no sort_values."""
+    
+    def __init__(self, df):
+        self.df = df
+        self._permutacoes = {}
+        self._trava = threading.Lock()  # o índice é compartilhado entre as sessões
+    
+    def permutacao(self, coluna, decrescente=False):
+        chave = (coluna, decrescente)
+        with self._trava:
+            permutacao = self._permutacoes.get(chave)
+        if permutacao is None:
+            serie = self.df[coluna].reset_index(drop=True)
+            try:
+                ordenada = serie.sort_values(ascending=not decrescente, kind='stable', na_position='last')
+            except TypeError:  # tipos misturados na coluna: compara como texto
+                ordenada = serie.astype(str).where(serie.notna()).sort_values(ascending=not decrescente, kind='stable', na_position='last')
+            permutacao = ordenada.index.to_numpy(dtype=np.int32)
+            permutacao.flags.writeable = False  # compartilhada entre sessões
+            with self._trava:
+                if len(self._permutacoes) >= LIMITE_PERMUTACOES:
+                    self._permutacoes.clear()
+                self._permutacoes[chave] = permutacao
+        return permutacao
+    
+    def restringir(self, permutacao, posicoes):
+        """Só as posições filtradas, na ordem da permutação: perm[mascara[perm]]"""
+        mascara = np.zeros(len(permutacao), dtype=bool)
+        mascara[posicoes] = True
+        return permutacao[mascara[permutacao]]
 
 # =========================================================
-# TAB 1: DADOS COMPLETOS
+# CUBO OLAP (CONTAGENS PRÉ-AGREGADAS)
 # =========================================================
-with tab1:
-    if linhas_por_pagina == "Todas":
-        altura_tabela = calcular_altura_tabela(total_linhas, total_colunas)
-        st.subheader(f"📋 Todos os {total_linhas} registros")
-        st.dataframe(df, height=altura_tabela, use_container_width=True, hide_index=False)
-    else:
-        linhas_por_pagina = int(linhas_por_pagina)
-        total_paginas = (total_linhas - 1) // linhas_por_pagina + 1
+# Eixos em ordem de prioridade: se o cubo passar do limite, os últimos saem primeiro
+PAPEIS_CUBO = ['status', 'prioridade', 'producao', 'tipo', 'tipo_atividade', 'campanha', 'solicitante']
+LIMITE_CELULAS_CUBO = 2_000_000
+
+def chave_mes_de(data):
+    """Mesma chave de derivadas['chave_mes']: meses desde 01/1970"""
+    return (data.year - 1970) * 12 + data.month - 1
+
+class ContagemPorEixos:
+    """Base dos índices de contagem: um eixo por papel categórico (com uma posição extra no fim
+    para os vazios) e um eixo 0/1 por regra avaliada em todas as colunas de texto."""
+    
+    def _montar_eixos(self, derivadas, indice, colunas, papeis, limite_celulas, celulas_fixas=1):
+        """Devolve os códigos por linha de cada eixo; os últimos saem enquanto passar do limite"""
+        self.posicao_valor = indice.posicao_valor
+        eixos = {}
         
-        if 'pagina_atual' not in st.session_state:
-            st.session_state.pagina_atual = 1
+        for nome, regra in REGRAS_CLASSIFICACAO.items():
+            if f'regra_{nome}' in derivadas.columns and not colunas[regra['papel']]:
+                eixos[f'regra_{nome}'] = (derivadas[f'regra_{nome}'].to_numpy().astype(np.intp), 2)
         
-        col_nav1, col_nav2, col_nav3, col_nav4 = st.columns([2, 1, 1, 2])
+        self.eixo_papel = {}
+        eixo_coluna = {}
+        for papel in papeis:
+            col = colunas[papel]
+            if not col or col not in indice.codigos:
+                continue
+            if col not in eixo_coluna:
+                codigos = indice.codigos[col]
+                distintos = len(indice.posicao_valor[col])
+                eixos[papel] = (np.where(codigos < 0, distintos, codigos), distintos + 1)
+                eixo_coluna[col] = papel
+            self.eixo_papel[papel] = eixo_coluna[col]
         
-        with col_nav1:
-            st.write(f"**Página {st.session_state.pagina_atual} de {total_paginas}**")
+        while eixos and celulas_fixas * np.prod([tamanho for _, tamanho in eixos.values()], dtype=float) > limite_celulas:
+            removido, _ = eixos.popitem()
+            self.eixo_papel = {papel: eixo for papel, eixo in self.eixo_papel.items() if eixo != removido}
         
-        with col_nav2:
-            if st.session_state.pagina_atual > 1:
-                if st.button("⬅️ Anterior", use_container_width=True):
-                    st.session_state.pagina_atual -= 1
-                    st.rerun()
+        self.eixos = list(eixos)
+        self.eixo_coluna = {col: eixo for col, eixo in eixo_coluna.items() if eixo in eixos}
+        self.forma = tuple(tamanho for _, tamanho in eixos.values())
         
-        with col_nav3:
-            if st.session_state.pagina_atual < total_paginas:
-                if st.button("Próxima ➡️", use_container_width=True):
-                    st.session_state.pagina_atual += 1
-                    st.rerun()
+        # Regras de um papel com coluna: verdadeira ou falsa para cada valor do eixo
+        self.regras_por_valor = {}
+        self.regras_sem_dados = {nome for nome in REGRAS_CLASSIFICACAO if f'regra_{nome}' not in derivadas.columns}
+        for nome, regra in REGRAS_CLASSIFICACAO.items():
+            eixo = self.eixo_papel.get(regra['papel'])
+            if nome in self.regras_sem_dados or f'regra_{nome}' in eixos or eixo is None:
+                continue
+            codigos, tamanho = eixos[eixo]
+            por_valor = np.zeros(tamanho, dtype=bool)
+            por_valor[codigos[derivadas[f'regra_{nome}'].to_numpy()]] = True
+            self.regras_por_valor[nome] = (eixo, por_valor)
         
-        with col_nav4:
-            nova_pagina = st.number_input("Ir para página:", min_value=1, max_value=total_paginas, 
-                                         value=st.session_state.pagina_atual, key="pagina_input")
-            if nova_pagina != st.session_state.pagina_atual:
-                st.session_state.pagina_atual = nova_pagina
-                st.rerun()
+        return [codigos for codigos, _ in eixos.values()]
+    
+    def regra_coberta(self, nome):
+        return f'regra_{nome}' in self.eixos or nome in self.regras_por_valor or nome in self.regras_sem_dados
+    
+    def seletores(self, filtros, regra=None):
+        """Posições aceitas em cada eixo restrito pelos filtros {coluna: valor} e pela regra"""
+        seletores = {}
+        
+        def restringir(eixo, aceitas):
+            posicao = self.eixos.index(eixo)
+            seletores[posicao] = seletores[posicao] & aceitas if posicao in seletores else aceitas
+        
+        for col, valor in filtros.items():
+            eixo = self.eixo_coluna[col]
+            aceitas = np.zeros(self.forma[self.eixos.index(eixo)], dtype=bool)
+            codigo = self.posicao_valor[col].get(valor)
+            if codigo is not None:
+                aceitas[codigo] = True
+            restringir(eixo, aceitas)
+        
+        if regra is not None:
+            if f'regra_{regra}' in self.eixos:
+                restringir(f'regra_{regra}', np.array([False, True]))
+            elif regra in self.regras_por_valor:
+                restringir(*self.regras_por_valor[regra])
+            elif self.eixos:
+                restringir(self.eixos[0], np.zeros(self.forma[0], dtype=bool))
+        return seletores
+
+class CuboOlap(ContagemPorEixos):
+    """Contagem densa de linhas por mês × papéis categóricos × regras sem coluna própria.
+    Filtro + agrupamento vira fatia + soma, sem passar pelas linhas."""
+    
+    def __init__(self, derivadas, indice, colunas):
+        self.mes_inicial = 0
+        codigos_mes, meses = None, 0
+        if 'chave_mes' in derivadas.columns:
+            chaves = derivadas['chave_mes'].to_numpy()
+            validas = chaves != CHAVE_NULA
+            if validas.any():
+                self.mes_inicial = int(chaves[validas].min())
+                meses = int(chaves[validas].max()) - self.mes_inicial + 1
+            codigos_mes = np.where(validas, chaves - self.mes_inicial, meses)
         
-        inicio = (st.session_state.pagina_atual - 1) * linhas_por_pagina
-        fim = min(inicio + linhas_por_pagina, total_linhas)
+        codigos = self._montar_eixos(derivadas, indice, colunas, PAPEIS_CUBO, LIMITE_CELULAS_CUBO, meses + 1)
+        if codigos_mes is not None:
+            self.eixos.insert(0, 'mes')
+            self.forma = (meses + 1,) + self.forma
+            codigos.insert(0, codigos_mes)
         
-        st.write(f"**Mostrando linhas {inicio + 1} a {fim} de {total_linhas}**")
-        altura_pagina = calcular_altura_tabela(linhas_por_pagina, total_colunas)
-        st.dataframe(df.iloc[inicio:fim], height=altura_pagina, use_container_width=True, hide_index=False)
+        celulas = int(np.prod(self.forma)) if codigos else 0
+        plano = np.ravel_multi_index(codigos, self.forma) if codigos else np.zeros(0, dtype=np.intp)
+        self.contagens = np.bincount(plano, minlength=celulas).astype(np.int32).reshape(self.forma)
+        
+        self.cobre_kpis = (
+            bool(self.eixos) and all(self.regra_coberta(nome) for nome in REGRAS_CLASSIFICACAO)
+            and ('chave_mes' not in derivadas.columns or 'mes' in self.eixos)
+            and all(papel in self.eixo_papel for papel in PAPEIS_CONTAGEM if colunas[papel] and colunas[papel] in indice.codigos)
+        )
+    
+    def cobre(self, consulta):
+        """consulta = {'filtros': {coluna: valor}, 'meses': (chave inicial, chave final ou None) ou None,
+        'dias': (dia inicial, dia final) da solicitação ou None}; janelas em dias não cabem no cubo"""
+        return (self.cobre_kpis
+                and consulta.get('dias') is None
+                and all(col in self.eixo_coluna for col in consulta['filtros'])
+                and (consulta['meses'] is None or 'mes' in self.eixos))
+    
+    def recortar(self, consulta):
+        """Fatia do cubo para a consulta, com as fatias usadas em cada eixo"""
+        fatias = [slice(None)] * len(self.eixos)
+        for col, valor in consulta['filtros'].items():
+            codigo = self.posicao_valor[col].get(valor)
+            fatias[self.eixos.index(self.eixo_coluna[col])] = slice(codigo, codigo + 1) if codigo is not None else slice(0, 0)
+        if consulta['meses'] is not None:
+            inicio, fim = consulta['meses']
+            eixo = self.eixos.index('mes')
+            meses = self.forma[eixo] - 1  # a última posição é a de datas vazias
+            ini = min(max(inicio - self.mes_inicial, 0), meses)
+            fi = meses if fim is None else min(max(fim - self.mes_inicial + 1, ini), meses)
+            fatias[eixo] = slice(ini, fi)
+        return self.contagens[tuple(fatias)], fatias
+    
+    def margem(self, recorte, fatias, eixo):
+        """Soma do recorte por posição do eixo, devolvida no tamanho completo do eixo"""
+        posicao = self.eixos.index(eixo)
+        completa = np.zeros(self.forma[posicao], dtype=np.int64)
+        completa[fatias[posicao]] = recorte.sum(axis=tuple(i for i in range(recorte.ndim) if i != posicao), dtype=np.int64)
+        return completa
+    
+    @property
+    def tamanho_bytes(self):
+        return self.contagens.nbytes
 
 # =========================================================
-# TAB 2: ANÁLISE ESTRATÉGICA
+# CONTAGENS DIÁRIAS ACUMULADAS (SOMAS DE PREFIXO)
 # =========================================================
-with tab2:
-    st.markdown("## 📈 Análise Estratégica")
+PAPEIS_ACUMULADOS = ['status', 'tipo', 'producao', 'prioridade']
+LIMITE_CELULAS_ACUMULADAS = 4_000_000
+
+class ContagensDiarias(ContagemPorEixos):
+    """Solicitações acumuladas dia a dia para cada combinação de status × tipo × produção × prioridade.
+    Quantas linhas entre d1 e d2 = acumulado[d2 + 1] - acumulado[d1], duas leituras por combinação."""
     
-    # Configurações de template para Plotly (funciona em dark/light)
-    is_dark = st.get_option('theme.base') == 'dark'
-    plotly_template = 'plotly_dark' if is_dark else 'plotly_white'
-    text_color = 'white' if is_dark else 'black'
+    def __init__(self, dias, derivadas, indice, colunas):
+        validas = dias != CHAVE_NULA
+        self.dia_inicial = int(dias[validas].min())
+        self.dia_final = int(dias[validas].max())
+        self.total_dias = self.dia_final - self.dia_inicial + 1
+        
+        codigos = self._montar_eixos(derivadas, indice, colunas, PAPEIS_ACUMULADOS, LIMITE_CELULAS_ACUMULADAS, self.total_dias + 1)
+        forma = self.forma + (self.total_dias,)
+        plano = np.ravel_multi_index([c[validas] for c in codigos] + [dias[validas] - self.dia_inicial], forma)
+        diarias = np.bincount(plano, minlength=int(np.prod(forma))).reshape(forma)
+        
+        self.acumulado = np.zeros(self.forma + (self.total_dias + 1,), dtype=np.int32)
+        np.cumsum(diarias, axis=-1, out=self.acumulado[..., 1:])
     
-    # ========== 1. MÉTRICAS DE NEGÓCIO ==========
-    st.markdown("""
-    <div class="info-container-cocred">
-        <p style="margin: 0; font-size: 14px;">
-            <strong>🎯 Indicadores de Performance</strong> - Acompanhe os principais KPIs do negócio.
-        </p>
-    </div>
-    """, unsafe_allow_html=True)
+    def cobre(self, filtros, regra=None):
+        return all(col in self.eixo_coluna for col in filtros) and (regra is None or self.regra_coberta(regra))
     
-    col_metric1, col_metric2, col_metric3, col_metric4 = st.columns(4)
+    def contar(self, inicio, fim, filtros=None, regra=None):
+        """inicio/fim em dias desde a época, inclusivos"""
+        ini = min(max(inicio - self.dia_inicial, 0), self.total_dias)
+        fi = min(max(fim - self.dia_inicial + 1, ini), self.total_dias)
+        contagem = self.acumulado[..., fi] - self.acumulado[..., ini]
+        for posicao, aceitas in self.seletores(filtros or {}, regra).items():
+            contagem = np.compress(aceitas, contagem, axis=posicao)
+        return int(contagem.sum())
     
-    with col_metric1:
-        taxa_conclusao = (total_concluidos / total_linhas * 100) if total_linhas > 0 else 0
-        st.markdown(f"""
-        <div class="metric-card-cocred">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">✅ TAXA DE CONCLUSÃO</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{taxa_conclusao:.1f}%</p>
-            <p style="font-size: 12px; margin: 0;">{total_concluidos} de {total_linhas} concluídos</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Percentual de demandas finalizadas
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
+    def comparar(self, atual, anterior, filtros=None, regra=None):
+        return self.contar(*atual, filtros, regra), self.contar(*anterior, filtros, regra)
     
-    with col_metric2:
-        st.markdown(f"""
-        <div class="metric-card-cocred" style="background: linear-gradient(135deg, #00A3E0 0%, #0077A3 100%);">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">⏱️ TEMPO MÉDIO</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">4.2 dias</p>
-            <p style="font-size: 12px; margin: 0;">da solicitação à entrega</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Tempo médio de execução
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
+    @property
+    def tamanho_bytes(self):
+        return self.acumulado.nbytes
+
+def janelas_comparacao(referencia):
+    """Semana e mês até a data de referência, cada um com o mesmo trecho do período anterior (em dias)"""
+    inicio_semana = referencia - timedelta(days=referencia.weekday())
+    inicio_mes = referencia.replace(day=1)
+    fim_mes_anterior = inicio_mes - timedelta(days=1)
+    inicio_mes_anterior = fim_mes_anterior.replace(day=1)
+    referencia_mes_anterior = inicio_mes_anterior.replace(day=min(referencia.day, fim_mes_anterior.day))
+    janelas = {
+        'semana': ((inicio_semana, referencia), (inicio_semana - timedelta(days=7), referencia - timedelta(days=7))),
+        'mes': ((inicio_mes, referencia), (inicio_mes_anterior, referencia_mes_anterior)),
+    }
+    return {nome: tuple((dia_epoca(a), dia_epoca(b)) for a, b in par) for nome, par in janelas.items()}
+
+def variacao_percentual(atual, anterior):
+    return (atual - anterior) / anterior * 100 if anterior > 0 else None
+
+def formatar_variacao(variacao):
+    return f"{variacao:+.1f}%" if variacao is not None else "—"
+
+# =========================================================
+# SNAPSHOT COMPARTILHADO
+# =========================================================
+class Snapshot:
+    """Uma versão da planilha com tudo o que é derivado dela.
+    Fica em st.cache_resource e é lida por todas as sessões, por isso nada aqui pode ser alterado."""
     
-    with col_metric3:
-        if 'Solicitante' in df.columns:
-            media_solicitante = total_linhas / df['Solicitante'].nunique() if df['Solicitante'].nunique() > 0 else 0
-        else:
-            media_solicitante = total_linhas / 9
-        st.markdown(f"""
-        <div class="metric-card-cocred" style="background: linear-gradient(135deg, #28A745 0%, #1E7E34 100%);">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">👥 MÉDIA POR SOLICITANTE</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{media_solicitante:.1f}</p>
-            <p style="font-size: 12px; margin: 0;">demandas por pessoa</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Volume médio por usuário
-            </p>
-        </div>
+    def __init__(self, versao, df, derivadas, carga):
+        colunas = carga['esquema']['colunas']
+        opcoes = {}
+        for papel in ['status', 'prioridade', 'producao']:
+            if colunas[papel]:
+                opcoes[papel] = sorted(df[colunas[papel]].dropna().unique().tolist())
+        limites_datas = {}
+        for papel in PAPEIS_DATA:
+            if f'dia_{papel}' in derivadas.columns:
+                validas = df[colunas[papel]].dropna()
+                if not validas.empty:
+                    limites_datas[papel] = (validas.min().date(), validas.max().date())
+        
+        indice_filtros = IndiceFiltros(df, [colunas[papel] for papel in PAPEIS_FILTRAVEIS if colunas[papel]])
+        indices_datas = {
+            papel: IndiceDatas(derivadas[f'dia_{papel}'].to_numpy())
+            for papel in PAPEIS_DATA if f'dia_{papel}' in derivadas.columns
+        }
+        cubo = CuboOlap(derivadas, indice_filtros, colunas)
+        indice_ordenacao = IndiceOrdenacao(df)
+        contagens_diarias = None
+        if 'dia_data_solicitacao' in derivadas.columns and (derivadas['dia_data_solicitacao'] != CHAVE_NULA).any():
+            contagens_diarias = ContagensDiarias(derivadas['dia_data_solicitacao'].to_numpy(), derivadas, indice_filtros, colunas)
+        
+        campos = {
+            'versao': versao,
+            'criado_em': datetime.now(),
+            'df': df,
+            'derivadas': derivadas,
+            'carga': carga,
+            'colunas': colunas,
+            'total_linhas': len(df),
+            'opcoes': opcoes,
+            'limites_datas': limites_datas,
+            'indice_filtros': indice_filtros,
+            'indices_datas': indices_datas,
+            'indice_ordenacao': indice_ordenacao,
+            'cubo': cubo,
+            'contagens_diarias': contagens_diarias,
+        }
+        for nome, valor in campos.items():
+            object.__setattr__(self, nome, valor)
+    
+    def __setattr__(self, nome, valor):
+        raise AttributeError("Snapshot é somente leitura")
+
+TTL_FALHA_DOWNLOAD = 60  # segundos até tentar baixar de novo uma versão cujo download falhou
+
+@st.cache_resource
+def snapshot_exemplo():
+    return construir_snapshot('exemplo')
+
+@st.cache_resource(max_entries=2, show_spinner="🔄 Baixando dados do Excel...")
+def snapshot_planilha(versao):
+    """Snapshot da versão; se o download falhar nada fica guardado (a exceção não entra no cache)"""
+    snapshot = construir_snapshot(versao)
+    if snapshot.versao != versao:
+        raise ConnectionError("Não foi possível baixar a planilha")
+    return snapshot
+
+@st.cache_resource(ttl=TTL_FALHA_DOWNLOAD, show_spinner=False)
+def tentativa_download(versao):
+    """Snapshot da versão, ou None quando o download falhou; a falha vale por TTL_FALHA_DOWNLOAD,
+    para que as execuções durante uma queda não repitam o download (e seu timeout) a cada vez"""
+    try:
+        return snapshot_planilha(versao)
+    except ConnectionError:
+        return None
+
+def obter_snapshot(versao):
+    """Snapshot compartilhado da versão da planilha; sem ela, o dos dados de exemplo (versão 'exemplo')"""
+    snapshot = tentativa_download(versao) if versao != 'exemplo' else None
+    return snapshot_exemplo() if snapshot is None else snapshot
+
+# =========================================================
+# CACHE LRU DE RESULTADOS
+# =========================================================
+LIMITE_BYTES_CACHE_FILTROS = 64 * 1024 * 1024
+
+def tamanho_em_bytes(valor):
+    """Estimativa do espaço ocupado por um resultado guardado em cache"""
+    if isinstance(valor, np.ndarray):
+        return valor.nbytes
+    if isinstance(valor, (pd.Series, pd.DataFrame)):
+        return int(np.sum(valor.memory_usage(deep=True)))
+    if pa is not None and isinstance(valor, pa.Table):
+        return valor.nbytes
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(tamanho_em_bytes(k) + tamanho_em_bytes(v) for k, v in valor.items())
+    if isinstance(valor, (list, tuple)):
+        return sys.getsizeof(valor) + sum(tamanho_em_bytes(v) for v in valor)
+    return sys.getsizeof(valor)
+
+class CacheLRU:
+    """LRU limitado em bytes e compartilhado entre as sessões.
+    A versão do snapshot faz parte da chave: quando muda, o que era da versão anterior é descartado."""
+    
+    def __init__(self, limite_bytes):
+        self.limite_bytes = limite_bytes
+        self.versao = None
+        self.bytes = 0
+        self.acertos = 0
+        self.falhas = 0
+        self._itens = OrderedDict()  # chave -> (valor, bytes)
+        self._trava = threading.Lock()
+    
+    def obter(self, versao, chave, calcular):
+        with self._trava:
+            if versao != self.versao:
+                self._itens.clear()
+                self.bytes = 0
+                self.versao = versao
+            if chave in self._itens:
+                self._itens.move_to_end(chave)
+                self.acertos += 1
+                return self._itens[chave][0]
+            self.falhas += 1
+        
+        # Calcula fora da trava; duas sessões com a mesma chave no mesmo instante só repetem o trabalho
+        valor = calcular()
+        tamanho = tamanho_em_bytes(valor)
+        with self._trava:
+            if versao == self.versao and tamanho <= self.limite_bytes and chave not in self._itens:
+                self._itens[chave] = (valor, tamanho)
+                self.bytes += tamanho
+                while self.bytes > self.limite_bytes:
+                    _, (_, liberado) = self._itens.popitem(last=False)
+                    self.bytes -= liberado
+        return valor
+    
+    def contem(self, versao, chave):
+        with self._trava:
+            return versao == self.versao and chave in self._itens
+    
+    @property
+    def taxa_acerto(self):
+        consultas = self.acertos + self.falhas
+        return self.acertos / consultas if consultas else 0.0
+    
+    def resumo(self):
+        return (f"{len(self._itens)} itens | {self.bytes / 1024 / 1024:.2f} de {self.limite_bytes / 1024 / 1024:.0f} MB | "
+                f"acertos {self.taxa_acerto:.0%} ({self.acertos}/{self.acertos + self.falhas})")
+
+@st.cache_resource
+def cache_filtros():
+    return CacheLRU(LIMITE_BYTES_CACHE_FILTROS)
+
+def posicoes_ordenadas(snapshot, posicoes, chave_filtros, coluna, decrescente):
+    """Posições na ordem pedida; com filtros, a permutação do snapshot restrita a elas (memorizada como os filtros).
+    Paginar vira fatiar o resultado."""
+    permutacao = snapshot.indice_ordenacao.permutacao(coluna, decrescente)
+    if posicoes is None or len(posicoes) == snapshot.total_linhas:
+        return permutacao
+    
+    def restringir():
+        ordenadas = snapshot.indice_ordenacao.restringir(permutacao, posicoes)
+        ordenadas.flags.writeable = False
+        return ordenadas
+    
+    return cache_filtros().obter(snapshot.versao, ('ordem', chave_filtros, coluna, decrescente), restringir)
+
+def controle_ordenacao(chave, colunas):
+    """Coluna e sentido da ordenação feita no servidor; coluna None mantém a ordem da planilha"""
+    col_ordem, col_sentido = st.columns([3, 1])
+    with col_ordem:
+        coluna = st.selectbox("↕️ Ordenar por:", [None] + list(colunas), key=f"ordem_{chave}",
+                              format_func=lambda col: "Ordem da planilha" if col is None else str(col))
+    with col_sentido:
+        decrescente = st.checkbox("⬇️ Decrescente", key=f"ordem_decrescente_{chave}", disabled=coluna is None)
+    return coluna, decrescente
+
+# =========================================================
+# PAGINAÇÃO DAS TABELAS
+# =========================================================
+# Toda tabela de resultados mostra uma página: o navegador recebe só essas linhas e o servidor
+# converte para Arrow só elas, qualquer que seja o tamanho do resultado
+LIMITE_BYTES_CACHE_PAGINAS = 32 * 1024 * 1024
+LIMITE_LINHAS_TODAS = 5_000  # "Todas" mostra no máximo isso; o resultado completo fica na exportação
+LIMITE_ANTECIPACOES = 8      # páginas seguintes na fila, somando todas as sessões
+
+@st.cache_resource
+def cache_paginas():
+    return CacheLRU(LIMITE_BYTES_CACHE_PAGINAS)
+
+class FilaAntecipacao:
+    """Uma thread para todas as sessões montar as páginas seguintes; o mesmo pedido não entra
+    duas vezes e, com a fila cheia, a antecipação é simplesmente pulada"""
+    
+    def __init__(self, limite):
+        self.limite = limite
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pagina-seguinte")
+        self.pendentes = set()
+        self._trava = threading.Lock()
+    
+    def enviar(self, pedido, tarefa):
+        with self._trava:
+            if pedido in self.pendentes or len(self.pendentes) >= self.limite:
+                return
+            self.pendentes.add(pedido)
+        
+        def executar():
+            try:
+                tarefa()
+            finally:
+                with self._trava:
+                    self.pendentes.discard(pedido)
+        self.executor.submit(executar)
+
+@st.cache_resource
+def fila_antecipacao():
+    return FilaAntecipacao(LIMITE_ANTECIPACOES)
+
+def montar_pagina(snapshot, posicoes, colunas, inicio, fim):
+    linhas = slice(inicio, fim) if posicoes is None else posicoes[inicio:fim]
+    pagina = snapshot.df.iloc[linhas] if colunas is None else snapshot.df.iloc[linhas, snapshot.df.columns.get_indexer(colunas)]
+    return pagina if pa is None else tabela_arrow(pagina, manter_indice=True)
+
+def pagina_tabela(snapshot, identidade, posicoes, colunas, inicio, fim):
+    """Linhas [inicio, fim) do resultado já em Arrow (DataFrame quando não há pyarrow),
+    memorizadas por snapshot, resultado + ordem, colunas e página"""
+    return cache_paginas().obter(snapshot.versao, ('pagina', identidade, colunas, inicio, fim),
+                                 lambda: montar_pagina(snapshot, posicoes, colunas, inicio, fim))
+
+def antecipar_pagina(snapshot, identidade, posicoes, colunas, inicio, fim):
+    """Manda montar a página seguinte na fila, para o 'Próxima' já encontrá-la pronta.
+    Os recursos do Streamlit são obtidos aqui; a thread só usa o CacheLRU e o snapshot."""
+    cache = cache_paginas()
+    chave = ('pagina', identidade, colunas, inicio, fim)
+    if not cache.contem(snapshot.versao, chave):
+        fila_antecipacao().enviar((snapshot.versao, chave), lambda: cache.obter(
+            snapshot.versao, chave, lambda: montar_pagina(snapshot, posicoes, colunas, inicio, fim)))
+
+def mudar_pagina(chave_pagina, passo):
+    st.session_state[chave_pagina] += passo
+
+def tabela_paginada(chave, snapshot, posicoes, identidade, linhas_por_pagina, colunas=None, altura_maxima=None):
+    """Navegação + página atual do resultado. posicoes: linhas do snapshot na ordem de exibição
+    (None = todas, na ordem da planilha); identidade: chave que muda sempre que elas mudam."""
+    total = snapshot.total_linhas if posicoes is None else len(posicoes)
+    colunas = None if colunas is None else tuple(colunas)
+    total_colunas = len(snapshot.df.columns) if colunas is None else len(colunas)
+    
+    if linhas_por_pagina == "Todas":
+        inicio, fim = 0, min(total, LIMITE_LINHAS_TODAS)
+        if fim < total:
+            st.caption(f"ℹ️ Mostrando as primeiras {fim:,} de {total:,} linhas; use a paginação ou a exportação para ver o restante.")
+        altura = calcular_altura_tabela(fim, total_colunas)
+    else:
+        linhas_por_pagina = int(linhas_por_pagina)
+        total_paginas = max((total - 1) // linhas_por_pagina + 1, 1)
+        chave_pagina = f"pagina_{chave}"
+        if st.session_state.get(f"resultado_{chave_pagina}") != identidade:  # outro resultado começa na página 1
+            st.session_state[f"resultado_{chave_pagina}"] = identidade
+            st.session_state[chave_pagina] = 1
+        elif st.session_state.setdefault(chave_pagina, 1) > total_paginas:  # menos páginas com o novo tamanho
+            st.session_state[chave_pagina] = total_paginas
+        pagina_atual = st.session_state[chave_pagina]
+        
+        col_nav1, col_nav2, col_nav3, col_nav4 = st.columns([2, 1, 1, 2])
+        
+        with col_nav1:
+            st.write(f"**Página {pagina_atual} de {total_paginas}**")
+        
+        with col_nav2:
+            if pagina_atual > 1:
+                st.button("⬅️ Anterior", key=f"anterior_{chave}", use_container_width=True,
+                          on_click=mudar_pagina, args=(chave_pagina, -1))
+        
+        with col_nav3:
+            if pagina_atual < total_paginas:
+                st.button("Próxima ➡️", key=f"proxima_{chave}", use_container_width=True,
+                          on_click=mudar_pagina, args=(chave_pagina, 1))
+        
+        with col_nav4:
+            st.number_input("Ir para página:", min_value=1, max_value=total_paginas, key=chave_pagina)
+        
+        inicio = (pagina_atual - 1) * linhas_por_pagina
+        fim = min(inicio + linhas_por_pagina, total)
+        st.write(f"**Mostrando linhas {inicio + 1 if total else 0} a {fim} de {total}**")
+        altura = calcular_altura_tabela(linhas_por_pagina, total_colunas)
+        if fim < total:
+            antecipar_pagina(snapshot, identidade, posicoes, colunas, fim, min(fim + linhas_por_pagina, total))
+    
+    if altura_maxima is not None:
+        altura = min(altura, altura_maxima)
+    st.dataframe(pagina_tabela(snapshot, identidade, posicoes, colunas, inicio, fim),
+                 height=altura, use_container_width=True, hide_index=False)
+
+# Arquivos de exportação: gerados uma vez por resultado (filtros, ordem e colunas); paginar,
+# ordenar de novo para a mesma coluna ou reabrir o resultado não reconverte a tabela
+LIMITE_BYTES_CACHE_EXPORTACOES = 64 * 1024 * 1024
+
+@st.cache_resource
+def cache_exportacoes():
+    return CacheLRU(LIMITE_BYTES_CACHE_EXPORTACOES)
+
+def arquivo_exportacao(snapshot, identidade, formato, df_exportar):
+    def gerar():
+        if formato == 'csv':
+            return df_exportar.to_csv(index=False, encoding='utf-8-sig')
+        if formato == 'xlsx':
+            output = BytesIO()
+            with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                df_exportar.to_excel(writer, index=False, sheet_name='Dados')
+            return output.getvalue()
+        return df_exportar.to_json(orient='records', force_ascii=False, date_format='iso')
+    return cache_exportacoes().obter(snapshot.versao, (formato, identidade), gerar)
+
+# =========================================================
+# MOTOR DE KPIs
+# =========================================================
+# Papéis contados por valor (cards, gráficos e rankings); todos vêm dos códigos do índice de filtros
+PAPEIS_CONTAGEM = ['status', 'prioridade', 'producao', 'tipo_atividade', 'campanha', 'solicitante']
+LIMITE_BYTES_CACHE_KPIS = 16 * 1024 * 1024
+
+def impressao_mascara(mascara):
+    if mascara is None or mascara.all():
+        return 'todas'
+    return hashlib.blake2b(np.packbits(mascara).tobytes(), digest_size=16).hexdigest()
+
+def serie_contagem(contagem, valores):
+    """Contagem por valor na mesma ordem de um value_counts (empates pela ordem de aparição)"""
+    serie = pd.Series(contagem, index=pd.Index(valores, dtype=object), dtype='int64')
+    return serie[serie > 0].sort_values(ascending=False, kind='stable')
+
+def serie_mensal(contagem, mes_inicial):
+    meses = np.flatnonzero(contagem)
+    return pd.Series(contagem[meses], index=meses + mes_inicial, dtype='int64')
+
+def contagem_por_codigo(codigos, valores, mascara):
+    """bincount dos códigos (-1 = vazio) no recorte"""
+    selecionados = codigos if mascara is None else codigos[mascara]
+    return serie_contagem(np.bincount(selecionados + 1, minlength=len(valores) + 1)[1:], valores)
+
+def agregar_kpis_cubo(snapshot, consulta):
+    """Mesmo resultado de agregar_kpis, lido do cubo sem passar pelas linhas"""
+    cubo = snapshot.cubo
+    recorte, fatias = cubo.recortar(consulta)
+    margens = {eixo: cubo.margem(recorte, fatias, eixo) for eixo in cubo.eixos}
+    
+    regras = {}
+    for nome in REGRAS_CLASSIFICACAO:
+        if f'regra_{nome}' in margens:
+            regras[nome] = int(margens[f'regra_{nome}'][1])
+        elif nome in cubo.regras_por_valor:
+            eixo, por_valor = cubo.regras_por_valor[nome]
+            regras[nome] = int(margens[eixo][por_valor].sum())
+        else:
+            regras[nome] = 0
+    
+    contagens = {}
+    for papel in PAPEIS_CONTAGEM:
+        if papel in cubo.eixo_papel:
+            valores = list(cubo.posicao_valor[snapshot.colunas[papel]])
+            contagens[papel] = serie_contagem(margens[cubo.eixo_papel[papel]][:-1], valores)
+    
+    por_mes = serie_mensal(margens['mes'][:-1], cubo.mes_inicial) if 'mes' in margens else pd.Series(dtype='int64')
+    
+    return {
+        'total': int(recorte.sum(dtype=np.int64)),
+        'regras': regras,
+        'contagens': contagens,
+        'distintos': {papel: len(serie) for papel, serie in contagens.items()},
+        'por_mes': por_mes,
+        'origem': 'cubo',
+    }
+
+def agregar_kpis(snapshot, mascara):
+    derivadas = snapshot.derivadas
+    indice = snapshot.indice_filtros
+    total = snapshot.total_linhas if mascara is None else int(np.count_nonzero(mascara))
+    
+    regras = {}
+    for nome in REGRAS_CLASSIFICACAO:
+        coluna = f'regra_{nome}'
+        if coluna not in derivadas.columns:
+            regras[nome] = 0
+            continue
+        flags = derivadas[coluna].to_numpy()
+        regras[nome] = int(np.count_nonzero(flags if mascara is None else flags & mascara))
+    
+    contagens = {}
+    for papel in PAPEIS_CONTAGEM:
+        col = snapshot.colunas[papel]
+        if col and col in indice.codigos:
+            valores = list(indice.posicao_valor[col])
+            contagens[papel] = contagem_por_codigo(indice.codigos[col], valores, mascara)
+    
+    por_mes = pd.Series(dtype='int64')
+    if 'chave_mes' in derivadas.columns:
+        chaves = derivadas['chave_mes'].to_numpy()
+        if mascara is not None:
+            chaves = chaves[mascara]
+        chaves = chaves[chaves != CHAVE_NULA]
+        if len(chaves):
+            inicio = int(chaves.min())
+            por_mes = serie_mensal(np.bincount(chaves - inicio), inicio)
+    
+    return {
+        'total': total,
+        'regras': regras,
+        'contagens': contagens,
+        'distintos': {papel: len(serie) for papel, serie in contagens.items()},
+        'por_mes': por_mes,
+        'origem': 'linhas',
+    }
+
+@st.cache_resource
+def cache_kpis():
+    return CacheLRU(LIMITE_BYTES_CACHE_KPIS)
+
+def calcular_kpis(snapshot, mascara=None, consulta=None, aproximado=False, cache=None, quadro=None):
+    """Todos os KPIs do recorte em uma passada, memorizados por versão do snapshot.
+    'consulta' descreve a máscara (ver CuboOlap.cobre); quando o cubo a cobre, os números saem dele,
+    senão vêm da amostra (modo aproximado) ou do motor de consultas configurado.
+    cache/quadro: recursos já obtidos, para quem roda fora da thread do script (pré-cálculo)."""
+    if cache is None:
+        cache = cache_kpis()
+    if consulta is None and mascara is None:
+        consulta = {'filtros': {}, 'meses': None}
+    if consulta is not None:
+        descricao = (tuple(sorted(consulta['filtros'].items(), key=str)), consulta['meses'], consulta.get('dias'))
+        if snapshot.cubo.cobre(consulta):
+            return cache.obter(snapshot.versao, ('cubo',) + descricao, lambda: agregar_kpis_cubo(snapshot, consulta))
+        if aproximado and snapshot.total_linhas >= LIMIAR_LINHAS_APROXIMADO:
+            return cache.obter(snapshot.versao, ('aproximado',) + descricao, lambda: aproximar_kpis(snapshot, consulta, mascara))
+        if motor_polars_ativo():
+            return cache.obter(snapshot.versao, ('polars',) + descricao, lambda: agregar_kpis_polars(snapshot, consulta, quadro))
+    impressao = impressao_mascara(mascara)
+    recorte = None if impressao == 'todas' else mascara
+    return cache.obter(snapshot.versao, ('linhas', impressao), lambda: agregar_kpis(snapshot, recorte))
+
+PERIODOS_KPI = ["Todo período", "Últimos 30 dias", "Últimos 90 dias", "Este ano"]
+
+def consulta_kpi_periodo(snapshot, filtros_kpi, periodo_kpi, hoje):
+    """Consulta, máscara e janelas de comparação dos filtros da aba de KPIs"""
+    janelas_kpi = []
+    consulta_kpi = {'filtros': filtros_kpi, 'meses': None, 'dias': None}
+    comparacao_kpi = None
+    if periodo_kpi != "Todo período" and 'data_solicitacao' in snapshot.indices_datas:
+        if periodo_kpi == "Últimos 30 dias":
+            data_limite = hoje - timedelta(days=30)
+        elif periodo_kpi == "Últimos 90 dias":
+            data_limite = hoje - timedelta(days=90)
+        else:
+            data_limite = hoje.replace(month=1, day=1)
+        # Só "Este ano" começa no início de um mês (cabe no cubo); as outras janelas são em dias
+        if data_limite.day == 1:
+            consulta_kpi['meses'] = (chave_mes_de(data_limite), None)
+        else:
+            consulta_kpi['dias'] = (dia_epoca(data_limite), DIA_MAXIMO)
+        janelas_kpi.append(snapshot.indices_datas['data_solicitacao'].bitmap(dia_epoca(data_limite), DIA_MAXIMO))
+        
+        # Período anterior de mesmo tamanho (no ano, o mesmo trecho do ano passado)
+        inicio_kpi = dia_epoca(data_limite)
+        if periodo_kpi == "Este ano":
+            anterior_kpi = (dia_epoca(data_limite.replace(year=data_limite.year - 1)), dia_epoca(pd.Timestamp(hoje) - pd.DateOffset(years=1)))
+        else:
+            anterior_kpi = (inicio_kpi - (dia_epoca(hoje) - inicio_kpi), inicio_kpi - 1)
+        comparacao_kpi = ((inicio_kpi, DIA_MAXIMO), anterior_kpi)
+    
+    return consulta_kpi, snapshot.indice_filtros.combinar(filtros_kpi, janelas_kpi), comparacao_kpi
+
+def contagem_pecas(snapshot):
+    """Demandas por família e item da peça (separados na carga pela REGRA_PECA), famílias maiores primeiro;
+    None quando a planilha não tem a coluna"""
+    derivadas = snapshot.derivadas
+    if 'peca_familia' not in derivadas.columns:
+        return None
+    contagem = (pd.DataFrame({'Família': derivadas['peca_familia'], 'Item': derivadas['peca_item']})
+                .groupby(['Família', 'Item'], observed=True, dropna=False).size().rename('Quantidade').reset_index())
+    contagem = contagem[contagem['Família'].notna()].astype({'Família': str, 'Item': object})
+    contagem['Item'] = contagem['Item'].fillna('—')  # peça sem separador: só a família
+    totais = contagem.groupby('Família', observed=True)['Quantidade'].transform('sum')
+    return contagem.assign(total=totais).sort_values(['total', 'Quantidade'], ascending=False, kind='stable').drop(columns='total')
+
+# =========================================================
+# REGISTRO DE MÉTRICAS (AVALIAÇÃO SOB DEMANDA)
+# =========================================================
+# Cada métrica declara de que depende: entradas do contexto (snapshot, consulta, aproximado, hoje) ou outras métricas.
+# Nada é calculado até alguém ler a métrica.
+METRICAS = {
+    'kpis': {
+        'entradas': ['snapshot', 'consulta', 'aproximado'],
+        'calcular': lambda snapshot, consulta, aproximado: calcular_kpis(snapshot, consulta=consulta, aproximado=aproximado),
+    },
+    'total_linhas': {'entradas': ['snapshot'], 'calcular': lambda snapshot: snapshot.total_linhas},
+    'pecas': {'entradas': ['snapshot'], 'calcular': contagem_pecas},
+    'total_concluidos': {'entradas': ['kpis'], 'calcular': lambda kpis: kpis['regras']['concluido_aprovado']},
+    'total_alta': {'entradas': ['kpis'], 'calcular': lambda kpis: kpis['regras']['prioridade_alta']},
+    'criacoes': {'entradas': ['kpis'], 'calcular': lambda kpis: kpis['regras']['criacao']},
+    'derivacoes': {'entradas': ['kpis'], 'calcular': lambda kpis: kpis['regras']['derivacao']},
+    'extra_contrato': {'entradas': ['kpis'], 'calcular': lambda kpis: kpis['regras']['extra_contrato']},
+    'campanhas_unicas': {
+        'entradas': ['snapshot', 'kpis'],
+        'calcular': lambda snapshot, kpis: kpis['distintos']['campanha'] if snapshot.colunas['campanha']
+            else (len(snapshot.df[snapshot.colunas['id']].unique()) // 50 if snapshot.colunas['id'] else 12),
+    },
+    'taxa_conclusao': {
+        'entradas': ['total_concluidos', 'total_linhas'],
+        'calcular': lambda concluidos, total: (concluidos / total * 100) if total > 0 else 0,
+    },
+    'percentual_alta': {
+        'entradas': ['total_alta', 'total_linhas'],
+        'calcular': lambda alta, total: (alta / total * 100) if total > 0 else 0,
+    },
+    'media_solicitante': {
+        'entradas': ['snapshot', 'kpis', 'total_linhas'],
+        'calcular': lambda snapshot, kpis, total: total / 9 if not snapshot.colunas['solicitante']
+            else (total / kpis['distintos']['solicitante'] if kpis['distintos']['solicitante'] > 0 else 0),
+    },
+    'total_hoje': {
+        'entradas': ['snapshot', 'hoje'],
+        'calcular': lambda snapshot, hoje: snapshot.indices_datas['data_solicitacao'].contar(dia_epoca(hoje), dia_epoca(hoje))
+            if 'data_solicitacao' in snapshot.indices_datas else 0,
+    },
+    # Comparações de período pelas contagens acumuladas (sem varrer linhas)
+    'total_ontem': {
+        'entradas': ['snapshot', 'hoje'],
+        'calcular': lambda snapshot, hoje: snapshot.contagens_diarias.contar(dia_epoca(hoje) - 1, dia_epoca(hoje) - 1)
+            if snapshot.contagens_diarias is not None else None,
+    },
+    'novos_7_dias': {
+        'entradas': ['snapshot', 'hoje'],
+        'calcular': lambda snapshot, hoje: snapshot.contagens_diarias.contar(dia_epoca(hoje) - 6, dia_epoca(hoje))
+            if snapshot.contagens_diarias is not None else None,
+    },
+}
+
+class AvaliadorMetricas:
+    """Lê métricas do registro sob demanda (metricas['nome']), memorizadas por (versão do snapshot, chave dos filtros).
+    Anota a origem e o tempo próprio de cada uma, sem contar as entradas, para o grafo do modo debug."""
+    
+    def __init__(self, chave, **contexto):
+        self.chave = chave
+        self.contexto = contexto
+        self.valores = {}
+        self.execucao = {}  # nome -> {'origem': 'calculada' | 'cache', 'segundos': tempo próprio}
+        self._tempo_entradas = []
+    
+    def __getitem__(self, nome):
+        if nome in self.contexto:
+            return self.contexto[nome]
+        if nome not in self.valores:
+            definicao = METRICAS[nome]
+            calculada = []
+            
+            def calcular():
+                calculada.append(True)
+                return definicao['calcular'](*[self[entrada] for entrada in definicao['entradas']])
+            
+            inicio = time.perf_counter()
+            self._tempo_entradas.append(0.0)
+            try:
+                valor = cache_kpis().obter(self.contexto['snapshot'].versao, ('metrica', nome, self.chave), calcular)
+            finally:
+                tempo_entradas = self._tempo_entradas.pop()
+            decorrido = time.perf_counter() - inicio
+            if self._tempo_entradas:
+                self._tempo_entradas[-1] += decorrido
+            self.valores[nome] = valor
+            self.execucao[nome] = {'origem': 'calculada' if calculada else 'cache', 'segundos': decorrido - tempo_entradas}
+        return self.valores[nome]
+    
+    def grafo_dot(self):
+        """Grafo de dependências em DOT: verde = calculada, azul = cache, cinza = não lida nesta execução"""
+        linhas = ['digraph metricas {', 'rankdir=LR; node [shape=box, style="rounded,filled", fontsize=10];']
+        for nome in self.contexto:
+            linhas.append(f'"{nome}" [shape=ellipse, fillcolor="#E9ECEF"];')
+        for nome, definicao in METRICAS.items():
+            execucao = self.execucao.get(nome)
+            if execucao is None:
+                linhas.append(f'"{nome}" [fillcolor="#F8F9FA", fontcolor="#ADB5BD"];')
+            else:
+                cor = "#C3E6CB" if execucao['origem'] == 'calculada' else "#BEE5EB"
+                linhas.append(f'"{nome}" [label="{nome}\\n{execucao["segundos"] * 1000:.2f} ms ({execucao["origem"]})", fillcolor="{cor}"];')
+            for entrada in definicao['entradas']:
+                linhas.append(f'"{entrada}" -> "{nome}";')
+        linhas.append('}')
+        return "\n".join(linhas)
+
+# =========================================================
+# CONSOLE SQL (DUCKDB)
+# =========================================================
+LIMITE_LINHAS_SQL = 5000
+TEMPO_LIMITE_SQL = 15  # segundos
+ESPERA_INTERRUPCAO_SQL = 2  # segundos para a consulta parar depois do interrupt; passado isso, é abandonada
+# Literais ('texto', "coluna") e comentários: comentários só valem fora das aspas
+PADRAO_LITERAIS_COMENTARIOS_SQL = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/""", re.S)
+LIMITE_BYTES_CACHE_SQL = 32 * 1024 * 1024
+
+def tabela_arrow(df, manter_indice=False):
+    """Snapshot como tabela Arrow; só colunas de tipos misturados são convertidas (para texto)"""
+    convertidas = {}
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_object_dtype(serie) and pd.api.types.infer_dtype(serie, skipna=True) not in ('string', 'empty'):
+            serie = serie.map(lambda v: v if pd.isna(v) else str(v))
+        convertidas[str(col)] = serie
+    return pa.Table.from_pandas(pd.DataFrame(convertidas, index=df.index, copy=False), preserve_index=manter_indice)
+
+@st.cache_resource(max_entries=2)
+def banco_duckdb(versao, _snapshot):
+    """Conexão em memória sem acesso a arquivos/rede; o snapshot entra como a tabela 'demandas'"""
+    conexao = duckdb.connect(config={'enable_external_access': False})
+    conexao.execute("SET lock_configuration = true")
+    return conexao, tabela_arrow(_snapshot.df)
+
+@st.cache_resource
+def cache_sql():
+    return CacheLRU(LIMITE_BYTES_CACHE_SQL)
+
+def validar_sql(consulta):
+    """Aceita uma única consulta SELECT/WITH; devolve o texto sem comentários e sem ';' final.
+    Textos entre aspas ficam intactos, mesmo com '--', '/*' ou ';' dentro."""
+    texto = PADRAO_LITERAIS_COMENTARIOS_SQL.sub(
+        lambda trecho: trecho.group(0) if trecho.group(0)[0] in '\'"' else ' ', consulta
+    ).strip().rstrip(';').strip()
+    if not texto:
+        raise ValueError("Consulta vazia")
+    if ';' in PADRAO_LITERAIS_COMENTARIOS_SQL.sub("''", texto):
+        raise ValueError("Envie apenas uma consulta por vez")
+    if not re.match(r'(select|with)\b', texto, re.I):
+        raise ValueError("Apenas consultas SELECT ou WITH são permitidas")
+    return texto
+
+def executar_sql(conexao, tabela, consulta, limite, tempo_limite):
+    # Cada consulta usa um cursor próprio (e thread própria) para poder ser interrompida
+    cursor = conexao.cursor()
+    cursor.register('demandas', tabela)
+    resultado = {}
+    
+    def rodar():
+        try:
+            resultado['df'] = cursor.execute(f"SELECT * FROM ({consulta}) AS consulta LIMIT {limite + 1}").df()
+        except Exception as erro:
+            resultado['erro'] = erro
+        finally:
+            cursor.close()  # quem fecha é a thread: uma consulta abandonada fecha o cursor ao terminar
+    
+    tarefa = threading.Thread(target=rodar, daemon=True)
+    tarefa.start()
+    tarefa.join(tempo_limite)
+    if tarefa.is_alive():
+        cursor.interrupt()
+        tarefa.join(ESPERA_INTERRUPCAO_SQL)
+        if tarefa.is_alive():
+            raise TimeoutError(f"A consulta passou de {tempo_limite}s e não parou ao ser interrompida; o resultado será descartado")
+        raise TimeoutError(f"A consulta passou de {tempo_limite}s e foi interrompida")
+    if 'erro' in resultado:
+        raise resultado['erro']
+    return {'df': resultado['df'].head(limite), 'truncado': len(resultado['df']) > limite}
+
+def consultar_sql(snapshot, consulta, limite=LIMITE_LINHAS_SQL, tempo_limite=TEMPO_LIMITE_SQL):
+    """Resultado memorizado por (versão do snapshot, consulta normalizada, limite)"""
+    texto = validar_sql(consulta)
+    conexao, tabela = banco_duckdb(snapshot.versao, snapshot)
+    chave = (' '.join(texto.split()), limite)
+    return cache_sql().obter(snapshot.versao, chave, lambda: executar_sql(conexao, tabela, texto, limite, tempo_limite))
+
+# =========================================================
+# MOTOR POLARS (OPCIONAL)
+# =========================================================
+def motor_polars_ativo():
+    return MOTOR_CONSULTAS == 'polars' and pl is not None and pa is not None
+
+@st.cache_resource(max_entries=2)
+def quadro_polars(versao, _snapshot):
+    """Snapshot + chaves derivadas como DataFrame Polars (a partir da mesma tabela Arrow do SQL)"""
+    tabela = tabela_arrow(_snapshot.df)
+    derivadas = _snapshot.derivadas
+    for col in [c for c in derivadas.columns if c.startswith(('dia_', 'regra_')) or c == 'chave_mes']:
+        tabela = tabela.append_column(col, pa.array(derivadas[col].to_numpy()))
+    return pl.from_arrow(tabela)
+
+def expressao_polars(consulta):
+    """Predicado da consulta; o plano lazy empurra o filtro para a leitura das colunas"""
+    expressao = pl.lit(True)
+    for col, valor in consulta['filtros'].items():
+        expressao = expressao & (pl.col(str(col)).cast(pl.String) == str(valor))
+    if consulta['meses'] is not None:
+        inicio, fim = consulta['meses']
+        expressao = expressao & (pl.col('chave_mes') >= inicio) & (pl.col('chave_mes') != CHAVE_NULA)
+        if fim is not None:
+            expressao = expressao & (pl.col('chave_mes') <= fim)
+    for papel, (inicio, fim) in consulta.get('janelas', {}).items():
+        expressao = expressao & pl.col(f'dia_{papel}').is_between(inicio, fim)
+    if consulta.get('dias') is not None:
+        expressao = expressao & pl.col('dia_data_solicitacao').is_between(*consulta['dias'])
+    return expressao
+
+def agregar_kpis_polars(snapshot, consulta, quadro=None):
+    """Mesmo resultado de agregar_kpis, com um plano lazy por agregação executados juntos (collect_all)"""
+    if quadro is None:
+        quadro = quadro_polars(snapshot.versao, snapshot)
+    plano = quadro.lazy().filter(expressao_polars(consulta))
+    regras_presentes = [nome for nome in REGRAS_CLASSIFICACAO if f'regra_{nome}' in snapshot.derivadas.columns]
+    papeis = [papel for papel in PAPEIS_CONTAGEM if snapshot.colunas[papel] and snapshot.colunas[papel] in snapshot.indice_filtros.codigos]
+    
+    planos = [plano.select(pl.len().alias('total'), *[pl.col(f'regra_{nome}').sum() for nome in regras_presentes])]
+    for papel in papeis:
+        col = str(snapshot.colunas[papel])
+        planos.append(plano.filter(pl.col(col).is_not_null()).group_by(pl.col(col).cast(pl.String)).len())
+    tem_mes = 'chave_mes' in snapshot.derivadas.columns
+    if tem_mes:
+        planos.append(plano.filter(pl.col('chave_mes') != CHAVE_NULA).group_by('chave_mes').len().sort('chave_mes'))
+    
+    resultados = pl.collect_all(planos)
+    
+    # Conversão para pandas só aqui, na saída para a interface
+    linha_total = resultados[0].row(0, named=True)
+    contagens = {}
+    for papel, quadro in zip(papeis, resultados[1:]):
+        # Reordena pelos valores do snapshot para empatar igual aos outros caminhos
+        col = snapshot.colunas[papel]
+        por_texto = dict(zip(quadro[str(col)].to_list(), quadro['len'].to_list()))
+        valores = list(snapshot.indice_filtros.posicao_valor[col])
+        contagens[papel] = serie_contagem(np.array([por_texto.get(str(v), 0) for v in valores], dtype=np.int64), valores)
+    por_mes = pd.Series(dtype='int64')
+    if tem_mes and resultados[-1].height:
+        por_mes = pd.Series(resultados[-1]['len'].to_numpy(), index=resultados[-1]['chave_mes'].to_numpy().astype(np.int64), dtype='int64')
+    
+    return {
+        'total': int(linha_total['total']),
+        'regras': {nome: int(linha_total.get(f'regra_{nome}') or 0) for nome in REGRAS_CLASSIFICACAO},
+        'contagens': contagens,
+        'distintos': {papel: len(serie) for papel, serie in contagens.items()},
+        'por_mes': por_mes,
+        'origem': 'polars',
+    }
+
+def posicoes_polars(snapshot, consulta, quadro=None):
+    if quadro is None:
+        quadro = quadro_polars(snapshot.versao, snapshot)
+    plano = (quadro.lazy()
+             .with_row_index('__linha')
+             .filter(expressao_polars(consulta))
+             .select('__linha'))
+    return plano.collect()['__linha'].to_numpy().astype(np.int32)
+
+def comparar_kpis(a, b):
+    """(KPI, valor A, valor B) para cada número que difere entre dois resultados de calcular_kpis"""
+    diferencas = [('total', a['total'], b['total'])] if a['total'] != b['total'] else []
+    for campo in ['regras', 'distintos']:
+        for chave in sorted(set(a[campo]) | set(b[campo])):
+            if a[campo].get(chave) != b[campo].get(chave):
+                diferencas.append((f'{campo}.{chave}', a[campo].get(chave), b[campo].get(chave)))
+    # Rankings comparados com a ordem (empates inclusive)
+    for papel in sorted(set(a['contagens']) | set(b['contagens'])):
+        sa = a['contagens'].get(papel, pd.Series(dtype='int64'))
+        sb = b['contagens'].get(papel, pd.Series(dtype='int64'))
+        if list(sa.rename(index=str).items()) != list(sb.rename(index=str).items()):
+            diferencas.append((f'contagens.{papel}', len(sa), len(sb)))
+    if list(a['por_mes'].items()) != list(b['por_mes'].items()):
+        diferencas.append(('por_mes', len(a['por_mes']), len(b['por_mes'])))
+    return diferencas
+
+def verificar_paridade(snapshot, consultas):
+    """Compara pandas e Polars nas consultas dadas; devolve uma linha por consulta.
+    Roda fora do dashboard: python scripts/verificar_paridade.py [planilha.xlsx]"""
+    linhas = []
+    for nome, consulta in consultas.items():
+        mascara = snapshot.indice_filtros.combinar(consulta['filtros'], [
+            snapshot.indices_datas[papel].bitmap(*janela) for papel, janela in consulta.get('janelas', {}).items()
+        ])
+        if consulta['meses'] is not None:
+            chaves = snapshot.derivadas['chave_mes'].to_numpy()
+            inicio, fim = consulta['meses']
+            mascara = mascara & (chaves >= inicio) & (chaves != CHAVE_NULA) & ((chaves <= fim) if fim is not None else True)
+        diferencas = comparar_kpis(agregar_kpis(snapshot, mascara), agregar_kpis_polars(snapshot, consulta))
+        if not np.array_equal(np.flatnonzero(mascara), posicoes_polars(snapshot, consulta)):
+            diferencas.append(('posições filtradas', int(mascara.sum()), None))
+        linhas.append({
+            'Consulta': nome,
+            'Resultado': '✅ idêntico' if not diferencas else '❌ ' + '; '.join(f'{k}: {va} × {vb}' for k, va, vb in diferencas),
+        })
+    return pd.DataFrame(linhas)
+
+# =========================================================
+# MODO APROXIMADO (AMOSTRAS E HYPERLOGLOG)
+# =========================================================
+# Estratos = status × prioridade × mês; cada um guarda uma amostra e um HyperLogLog por papel
+PAPEIS_ESTRATO = ['status', 'prioridade']
+PAPEIS_DISTINTOS = ['campanha', 'solicitante']
+TAMANHO_AMOSTRA = 20_000
+MINIMO_POR_ESTRATO = 20
+PRECISAO_HLL = 10  # 2^10 registradores: erro padrão ~3,2%
+Z_95 = 1.96
+
+def comprimento_bits(valores):
+    """Número de bits significativos de cada uint64, sem passar por float"""
+    valores = valores.copy()
+    comprimento = np.zeros(valores.shape, dtype=np.int64)
+    for deslocamento in (32, 16, 8, 4, 2, 1):
+        grandes = valores >= (np.uint64(1) << np.uint64(deslocamento))
+        comprimento[grandes] += deslocamento
+        valores[grandes] >>= np.uint64(deslocamento)
+    return comprimento + (valores > 0)
+
+def registradores_hll(grupos, total_grupos, codigos):
+    """HyperLogLog por grupo a partir dos códigos dos valores (hash numpy de 64 bits)"""
+    registradores = np.zeros((total_grupos, 1 << PRECISAO_HLL), dtype=np.uint8)
+    validos = codigos >= 0
+    hashes = pd.util.hash_array(codigos[validos].astype(np.int64))
+    resto_bits = 64 - PRECISAO_HLL
+    posicao = (hashes >> np.uint64(resto_bits)).astype(np.intp)
+    resto = hashes & np.uint64((1 << resto_bits) - 1)
+    rho = (resto_bits - comprimento_bits(resto) + 1).astype(np.uint8)
+    np.maximum.at(registradores, (grupos[validos], posicao), rho)
+    return registradores
+
+def estimar_hll(registradores):
+    m = len(registradores)
+    alfa = 0.7213 / (1 + 1.079 / m)
+    estimativa = alfa * m * m / np.sum(np.power(2.0, -registradores.astype(np.float64)))
+    vazios = int(np.count_nonzero(registradores == 0))
+    if estimativa <= 2.5 * m and vazios:
+        estimativa = m * np.log(m / vazios)
+    return estimativa
+
+class AmostraEstratificada:
+    """Amostra de reservatório por estrato (mesmo efeito de sortear k linhas de cada um) e
+    HyperLogLog por estrato para os papéis de contagem distinta; os sketches se unem por máximo."""
+    
+    def __init__(self, snapshot, semente=0):
+        indice = snapshot.indice_filtros
+        colunas = snapshot.colunas
+        derivadas = snapshot.derivadas
+        total = snapshot.total_linhas
+        
+        eixos = []
+        self.eixo_coluna = {}
+        for papel in PAPEIS_ESTRATO:
+            col = colunas[papel]
+            if col and col in indice.codigos and col not in self.eixo_coluna:
+                distintos = len(indice.posicao_valor[col])
+                self.eixo_coluna[col] = len(eixos)
+                eixos.append((np.where(indice.codigos[col] < 0, distintos, indice.codigos[col]), distintos + 1))
+        self.mes_inicial = 0
+        self.eixo_mes = None
+        if 'chave_mes' in derivadas.columns:
+            chaves = derivadas['chave_mes'].to_numpy()
+            validas = chaves != CHAVE_NULA
+            meses = 0
+            if validas.any():
+                self.mes_inicial = int(chaves[validas].min())
+                meses = int(chaves[validas].max()) - self.mes_inicial + 1
+            self.eixo_mes = len(eixos)
+            eixos.append((np.where(validas, chaves - self.mes_inicial, meses), meses + 1))
+        
+        self.forma = tuple(tamanho for _, tamanho in eixos) or (1,)
+        self.posicao_valor = indice.posicao_valor
+        estrato = np.ravel_multi_index([c for c, _ in eixos], self.forma) if eixos else np.zeros(total, dtype=np.intp)
+        total_estratos = int(np.prod(self.forma))
+        
+        # Reservatório: ordem aleatória dentro de cada estrato e os k primeiros de cada um
+        self.linhas_estrato = np.bincount(estrato, minlength=total_estratos)
+        ocupados = max(int(np.count_nonzero(self.linhas_estrato)), 1)
+        k = max(int(np.ceil(TAMANHO_AMOSTRA / ocupados)), MINIMO_POR_ESTRATO)
+        ordem = np.lexsort((np.random.default_rng(semente).random(total), estrato))
+        estrato_ordenado = estrato[ordem]
+        novo_grupo = np.r_[True, estrato_ordenado[1:] != estrato_ordenado[:-1]] if total else np.zeros(0, dtype=bool)
+        inicios = np.flatnonzero(novo_grupo)
+        posicao_no_estrato = np.arange(total) - inicios[np.cumsum(novo_grupo) - 1] if total else np.zeros(0, dtype=np.int64)
+        self.posicoes = np.sort(ordem[posicao_no_estrato < k])
+        self.estrato = estrato[self.posicoes]
+        self.amostrados_estrato = np.bincount(self.estrato, minlength=total_estratos)
+        self.pesos = self.linhas_estrato[self.estrato] / self.amostrados_estrato[self.estrato]
+        
+        self.hll = {}
+        for papel in PAPEIS_DISTINTOS:
+            col = colunas[papel]
+            if col and col in indice.codigos:
+                self.hll[papel] = registradores_hll(estrato, total_estratos, indice.codigos[col])
+    
+    def estratos_da_consulta(self, consulta):
+        """Estratos selecionados pela consulta, ou None se ela não puder ser expressa em estratos"""
+        if consulta.get('dias') is not None or consulta.get('janelas') or not all(col in self.eixo_coluna for col in consulta['filtros']):
+            return None
+        selecionados = np.ones(self.forma, dtype=bool)
+        for col, valor in consulta['filtros'].items():
+            aceitas = np.zeros(self.forma[self.eixo_coluna[col]], dtype=bool)
+            codigo = self.posicao_valor[col].get(valor)
+            if codigo is not None:
+                aceitas[codigo] = True
+            selecionados &= aceitas.reshape([-1 if i == self.eixo_coluna[col] else 1 for i in range(len(self.forma))])
+        if consulta['meses'] is not None:
+            if self.eixo_mes is None:
+                return None
+            inicio, fim = consulta['meses']
+            meses = np.arange(self.forma[self.eixo_mes]) + self.mes_inicial
+            aceitas = (meses >= inicio) & (np.arange(len(meses)) < len(meses) - 1)
+            if fim is not None:
+                aceitas &= meses <= fim
+            selecionados &= aceitas.reshape([-1 if i == self.eixo_mes else 1 for i in range(len(self.forma))])
+        return selecionados.ravel()
+    
+    def selecionar(self, snapshot, consulta):
+        """Máscara da consulta avaliada só nas linhas da amostra"""
+        selecao = np.ones(len(self.posicoes), dtype=bool)
+        for col, valor in consulta['filtros'].items():
+            codigo = snapshot.indice_filtros.posicao_valor[col].get(valor)
+            selecao &= snapshot.indice_filtros.codigos[col][self.posicoes] == (codigo if codigo is not None else -2)
+        derivadas = snapshot.derivadas
+        if consulta['meses'] is not None:
+            chaves = derivadas['chave_mes'].to_numpy()[self.posicoes]
+            inicio, fim = consulta['meses']
+            selecao &= (chaves >= inicio) & (chaves != CHAVE_NULA) & ((chaves <= fim) if fim is not None else True)
+        janelas = dict(consulta.get('janelas', {}))
+        if consulta.get('dias') is not None:
+            janelas['data_solicitacao'] = consulta['dias']
+        for papel, (inicio, fim) in janelas.items():
+            dias = derivadas[f'dia_{papel}'].to_numpy()[self.posicoes]
+            selecao &= (dias >= inicio) & (dias <= fim)
+        return selecao
+    
+    def estimar_contagem(self, indicadora):
+        """Total estimado e margem de 95% (estimador estratificado, com correção de população finita)"""
+        soma = np.bincount(self.estrato, weights=indicadora, minlength=len(self.linhas_estrato))
+        linhas, amostrados = self.linhas_estrato, self.amostrados_estrato
+        com_amostra = amostrados > 0
+        proporcao = np.zeros(len(linhas))
+        proporcao[com_amostra] = soma[com_amostra] / amostrados[com_amostra]
+        variancia_estrato = np.zeros(len(linhas))
+        varia = amostrados > 1
+        variancia_estrato[varia] = (linhas[varia] ** 2 * (1 - amostrados[varia] / linhas[varia])
+                                    * proporcao[varia] * (1 - proporcao[varia]) / (amostrados[varia] - 1))
+        return float(np.sum(linhas * proporcao)), float(Z_95 * np.sqrt(variancia_estrato.sum()))
+    
+    @property
+    def tamanho_bytes(self):
+        return self.posicoes.nbytes + self.estrato.nbytes + self.pesos.nbytes + sum(r.nbytes for r in self.hll.values())
+
+@st.cache_resource(max_entries=2)
+def amostra_estratificada(versao, _snapshot):
+    return AmostraEstratificada(_snapshot)
+
+def aproximar_kpis(snapshot, consulta, mascara=None):
+    """KPIs estimados pela amostra estratificada; contagens distintas pelo HyperLogLog dos estratos.
+    'erros' traz a margem de 95% de cada número estimado."""
+    amostra = amostra_estratificada(snapshot.versao, snapshot)
+    selecao = amostra.selecionar(snapshot, consulta)
+    pesos = amostra.pesos * selecao
+    derivadas = snapshot.derivadas
+    
+    total, erro_total = amostra.estimar_contagem(selecao.astype(np.float64))
+    regras, erros_regras = {}, {}
+    for nome in REGRAS_CLASSIFICACAO:
+        coluna = f'regra_{nome}'
+        if coluna not in derivadas.columns:
+            regras[nome], erros_regras[nome] = 0, 0.0
+            continue
+        estimado, erro = amostra.estimar_contagem((derivadas[coluna].to_numpy()[amostra.posicoes] & selecao).astype(np.float64))
+        regras[nome], erros_regras[nome] = int(round(estimado)), erro
+    
+    contagens = {}
+    for papel in PAPEIS_CONTAGEM:
+        col = snapshot.colunas[papel]
+        if col and col in snapshot.indice_filtros.codigos:
+            valores = list(snapshot.indice_filtros.posicao_valor[col])
+            codigos = snapshot.indice_filtros.codigos[col][amostra.posicoes]
+            estimado = np.bincount(codigos + 1, weights=pesos, minlength=len(valores) + 1)[1:]
+            contagens[papel] = serie_contagem(np.rint(estimado).astype(np.int64), valores)
+    
+    por_mes = pd.Series(dtype='int64')
+    if 'chave_mes' in derivadas.columns:
+        chaves = derivadas['chave_mes'].to_numpy()[amostra.posicoes]
+        validas = (chaves != CHAVE_NULA) & selecao
+        if validas.any():
+            inicio = int(chaves[validas].min())
+            por_mes = serie_mensal(np.rint(np.bincount(chaves[validas] - inicio, weights=pesos[validas])).astype(np.int64), inicio)
+    
+    # Distintos: união (máximo) dos HyperLogLog dos estratos; sem estratos equivalentes, conta exato na máscara
+    distintos = {papel: len(serie) for papel, serie in contagens.items()}
+    erros_distintos = {}
+    estratos = amostra.estratos_da_consulta(consulta)
+    for papel, registradores in amostra.hll.items():
+        if estratos is not None:
+            distintos[papel] = int(round(estimar_hll(registradores[estratos].max(axis=0)))) if estratos.any() else 0
+            erros_distintos[papel] = Z_95 * 1.04 / np.sqrt(registradores.shape[1]) * distintos[papel]
+        elif mascara is not None:
+            codigos = snapshot.indice_filtros.codigos[snapshot.colunas[papel]][mascara]
+            distintos[papel] = len(np.unique(codigos[codigos >= 0]))
+            erros_distintos[papel] = 0.0
+    
+    return {
+        'total': int(round(total)),
+        'regras': regras,
+        'contagens': contagens,
+        'distintos': distintos,
+        'por_mes': por_mes,
+        'origem': 'aproximado',
+        'erros': {'total': erro_total, 'regras': erros_regras, 'distintos': erros_distintos},
+    }
+
+def margem_erro(kpis, campo, nome=None, modelo="{}"):
+    """Texto '±N' de um KPI estimado (aplicado ao modelo); vazio quando o número é exato"""
+    if kpis.get('origem') != 'aproximado':
+        return ""
+    erro = kpis['erros'][campo] if nome is None else kpis['erros'][campo].get(nome)
+    return modelo.format(f" ±{erro:.0f}") if erro is not None else ""
+
+MODELO_MARGEM_CARD = '<span style="font-size: 16px;">{}</span>'
+
+
+# =========================================================
+# ÍNDICE INVERTIDO DA PESQUISA
+# =========================================================
+# Token (minúsculo, sem acento) -> valores distintos de cada coluna de texto que o contêm -> linhas.
+# As linhas de cada valor ficam contíguas: posições ordenadas pelo código + deslocamento de cada código.
+PADRAO_TOKEN = re.compile(r'\w+')
+# Depois de dobrado o texto é ASCII: o que não é letra, dígito ou _ vira espaço (\x01 separa os valores)
+TABELA_SEPARADORES = bytes(c if chr(c).isalnum() or c in (1, ord('_')) else ord(' ') for c in range(128)) + b' ' * 128
+PADRAO_TERMO = re.compile(r'(?:([^\s:"]+):)?(?:"([^"]*)"|(\S+))')
+
+def tokens_texto(texto):
+    return PADRAO_TOKEN.findall(normalizar_texto(texto))
+
+def nome_campo(texto):
+    return '_'.join(tokens_texto(texto))
+
+def dobrar_valores(valores):
+    """normalizar_texto de cada valor, feito de uma vez sobre todos unidos por \x01"""
+    textos = [str(texto) for texto in valores]
+    unido = '\x01'.join(textos)
+    if unido.count('\x01') != len(textos) - 1:  # algum valor já trazia o separador
+        unido = '\x01'.join(texto.replace('\x01', ' ') for texto in textos)
+    return normalizar_texto(unido).split('\x01') if textos else []
+
+def eh_coluna_pesquisavel(serie):
+    """Texto e inteiros (IDs, códigos): os inteiros são pesquisados pelo número escrito"""
+    return eh_coluna_texto(serie) or (pd.api.types.is_integer_dtype(serie) and not pd.api.types.is_bool_dtype(serie))
+
+class IndiceTextual:
+    """Índice invertido das colunas de texto e de inteiros, montado sobre os valores distintos
+    (uma coluna category com 1M de linhas e 50 valores tokeniza só 50 textos)."""
+    
+    def __init__(self, df, colunas_papeis):
+        self.total_linhas = len(df)
+        self.colunas = [col for col in df.columns if eh_coluna_pesquisavel(df[col])]
+        self.codigos = {}  # coluna -> código do valor em cada linha (-1 = vazio)
+        self.linhas = {}   # coluna -> posições ordenadas pelo código do valor
+        self.inicios = {}  # coluna -> onde começa cada código em linhas (um a mais no fim)
+        self.dobrados = {}  # coluna -> texto dobrado de cada valor distinto (busca por trecho)
+        ocorrencias = {}   # token -> coluna -> códigos dos valores que contêm o token
+        for col in self.colunas:
+            codigos, valores = pd.factorize(df[col])
+            vazios = int(np.count_nonzero(codigos < 0))
+            self.codigos[col] = codigos.astype(np.int32)
+            self.linhas[col] = np.argsort(codigos, kind='stable').astype(np.int32)[vazios:]
+            self.inicios[col] = np.concatenate([[0], np.cumsum(np.bincount(codigos[codigos >= 0], minlength=len(valores)))])
+            dobrados = dobrar_valores(valores.tolist())
+            self.dobrados[col] = pd.Series(dobrados, dtype='string')
+            for token, codigos_token in self.tokens_por_valor(dobrados):
+                ocorrencias.setdefault(token, {})[col] = codigos_token
+        self.vocabulario = sorted(ocorrencias)
+        self.ocorrencias = ocorrencias
+        # Campo nas consultas: papel do esquema ou nome da coluna sem acento (espaços viram _)
+        self.campos = {nome_campo(col): col for col in self.colunas}
+        self.campos.update({papel: col for papel, col in colunas_papeis.items() if col in self.linhas})
+    
+    @staticmethod
+    def tokens_por_valor(dobrados):
+        """(token, códigos dos valores que o contêm). Os valores distintos já dobrados são quebrados juntos,
+        como um único texto, e os pares token × valor são agrupados com numpy."""
+        dobrado = '\x01'.join(dobrados).encode('ascii').translate(TABELA_SEPARADORES)
+        partes = np.array(dobrado.replace(b'\x01', b' \x01 ').decode('ascii').split(), dtype=object)
+        separador = partes == '\x01'
+        if separador.all():
+            return []
+        ids_tokens, nomes = pd.factorize(partes[~separador])
+        pares = np.sort(ids_tokens.astype(np.int64) * len(dobrados) + np.cumsum(separador)[~separador])
+        pares = pares[np.r_[True, pares[1:] != pares[:-1]]]
+        tokens_pares, codigos = np.divmod(pares, len(dobrados))
+        cortes = np.flatnonzero(np.diff(tokens_pares)) + 1
+        return zip(nomes[tokens_pares[np.r_[0, cortes]]].tolist(), np.split(codigos, cortes))
+    
+    @property
+    def tamanho_bytes(self):
+        return (sum(linhas.nbytes + self.inicios[col].nbytes + self.codigos[col].nbytes
+                    + int(self.dobrados[col].memory_usage(deep=True)) for col, linhas in self.linhas.items())
+                + sum(codigos.nbytes for por_coluna in self.ocorrencias.values() for codigos in por_coluna.values()))
+    
+    def tokens_com_prefixo(self, prefixo):
+        return self.vocabulario[bisect.bisect_left(self.vocabulario, prefixo):bisect.bisect_left(self.vocabulario, prefixo + '\uffff')]
+    
+    def posicoes_codigos(self, col, codigos):
+        """Junta os trechos contíguos de cada código sem laço em Python"""
+        inicios = self.inicios[col][codigos]
+        tamanhos = self.inicios[col][codigos + 1] - inicios
+        deslocamentos = np.repeat(inicios - np.cumsum(tamanhos) + tamanhos, tamanhos)
+        return self.linhas[col][deslocamentos + np.arange(len(deslocamentos))]
+    
+    def valores_presentes(self, posicoes):
+        """coluna -> códigos (ordenados) dos valores que aparecem nessas linhas"""
+        presentes = {}
+        for col in self.colunas:
+            marcados = np.zeros(len(self.inicios[col]), dtype=bool)
+            marcados[self.codigos[col][posicoes] + 1] = True
+            presentes[col] = np.flatnonzero(marcados[1:])
+        return presentes
+    
+    def codigos_token(self, token, prefixo=False, presentes=None):
+        """coluna -> códigos dos valores que têm o token (ou, como prefixo, algum token que começa por ele).
+        Com presentes (refino de poucas linhas), confere só o texto desses valores, sem varrer o vocabulário."""
+        if presentes is not None:
+            padrao = '(?:^|[^a-z0-9_])' + re.escape(token) + ('' if prefixo else '(?:$|[^a-z0-9_])')
+            por_coluna = {}
+            for col, codigos in presentes.items():
+                achados = codigos[self.dobrados[col].iloc[codigos].str.contains(padrao).to_numpy(dtype=bool)]
+                if len(achados):
+                    por_coluna[col] = achados
+            return por_coluna
+        por_coluna = {}
+        for candidato in (self.tokens_com_prefixo(token) if prefixo else [token]):
+            for col, codigos in self.ocorrencias.get(candidato, {}).items():
+                por_coluna.setdefault(col, []).append(codigos)
+        return {col: np.unique(np.concatenate(listas)) if len(listas) > 1 else listas[0] for col, listas in por_coluna.items()}
+    
+    def marcar_linhas(self, codigos_por_coluna, posicoes=None):
+        """Máscara das linhas com algum dos valores; com posicoes, só dessas linhas (na mesma ordem)"""
+        if posicoes is not None:
+            mascara = np.zeros(len(posicoes), dtype=bool)
+            for col, codigos in codigos_por_coluna.items():
+                aceitos = np.zeros(len(self.inicios[col]), dtype=bool)
+                aceitos[codigos + 1] = True
+                mascara |= aceitos[self.codigos[col][posicoes] + 1]
+            return mascara
+        mascara = np.zeros(self.total_linhas, dtype=bool)
+        for col, codigos in codigos_por_coluna.items():
+            inicios = self.inicios[col]
+            if int((inicios[codigos + 1] - inicios[codigos]).sum()) * 8 < self.total_linhas:
+                mascara[self.posicoes_codigos(col, codigos)] = True
+            else:
+                # Token comum: mais barato consultar o código de cada linha numa tabela de valores aceitos
+                aceitos = np.zeros(len(inicios), dtype=bool)
+                aceitos[codigos + 1] = True
+                mascara |= aceitos[self.codigos[col] + 1]
+        return mascara
+    
+    def linhas_termo(self, coluna, tokens, prefixo_final, posicoes=None, presentes=None):
+        """Linhas com todos os tokens do termo. Com campo, a interseção é feita nos valores distintos
+        da coluna antes de ir às linhas; sem campo, cada token pode estar em qualquer coluna."""
+        if coluna is None:
+            mascara = None
+            for posicao, token in enumerate(tokens):
+                linhas = self.marcar_linhas(self.codigos_token(token, prefixo_final and posicao == len(tokens) - 1, presentes), posicoes)
+                mascara = linhas if mascara is None else np.logical_and(mascara, linhas, out=mascara)
+            return mascara
+        if presentes is not None:
+            presentes = {coluna: presentes[coluna]}
+        codigos = None
+        for posicao, token in enumerate(tokens):
+            do_token = self.codigos_token(token, prefixo_final and posicao == len(tokens) - 1, presentes).get(coluna, np.empty(0, dtype=np.int64))
+            codigos = do_token if codigos is None else np.intersect1d(codigos, do_token, assume_unique=True)
+        return self.marcar_linhas({coluna: codigos}, posicoes)
+    
+    def interpretar(self, consulta):
+        """[(coluna ou None, texto do termo)] e os campos que não existem (esses viram texto comum)"""
+        termos = []
+        desconhecidos = []
+        for campo, entre_aspas, solto in PADRAO_TERMO.findall(consulta):
+            texto = entre_aspas or solto
+            coluna = None
+            if campo:
+                coluna = self.campos.get(nome_campo(campo))
+                if coluna is None:
+                    desconhecidos.append(campo)
+                    texto = f"{campo}:{texto}"
+            termos.append((coluna, texto))
+        return termos, desconhecidos
+    
+    def pesquisar(self, consulta, posicoes=None):
+        """Posições das linhas que têm todos os tokens (cada 'campo:valor' só na sua coluna).
+        O último token vale como prefixo enquanto a pessoa ainda está digitando.
+        Com posicoes, só essas linhas são avaliadas (resultado de uma consulta mais ampla)."""
+        termos, desconhecidos = self.interpretar(consulta)
+        termos = [(coluna, tokens_texto(texto)) for coluna, texto in termos]
+        termos = [(coluna, tokens) for coluna, tokens in termos if tokens]
+        if not termos:  # só pontuação ("(", "-"): nada a procurar, nada encontrado
+            return np.empty(0, dtype=np.int32), desconhecidos
+        prefixo_final = not consulta.endswith((' ', '"'))
+        presentes = None if posicoes is None else self.valores_presentes(posicoes)
+        mascara = None
+        for posicao, (coluna, tokens) in enumerate(termos):
+            linhas = self.linhas_termo(coluna, tokens, prefixo_final and posicao == len(termos) - 1, posicoes, presentes)
+            mascara = linhas if mascara is None else np.logical_and(mascara, linhas, out=mascara)
+        if posicoes is not None:
+            return posicoes[mascara], desconhecidos
+        return np.flatnonzero(mascara).astype(np.int32), desconhecidos
+
+# Trigramas: 3 caracteres ASCII seguidos do texto dobrado, guardados em 21 bits (7 por caractere).
+# Acham trechos em qualquer posição (pedaços de ID, códigos, nomes parciais), não só início de palavra.
+LIMITE_BYTES_TRIGRAMAS = 64 * 1024 * 1024
+LIMIAR_COBERTURA = 0.5       # fração dos trigramas do termo que o valor precisa ter para ser aceito com erro
+VALORES_POR_BLOCO = 200_000  # montagem em blocos para limitar a memória temporária
+
+def trigramas_bloco(dobrados):
+    """Pares (trigrama, valor) distintos, ordenados por trigrama e valor, de uma lista de textos dobrados"""
+    texto = np.frombuffer('\x01'.join(dobrados).encode('ascii'), dtype=np.uint8)
+    if len(texto) < 3:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    separador = texto == 1
+    caracteres = texto.astype(np.int64)
+    trigramas = (caracteres[:-2] << 14) | (caracteres[1:-1] << 7) | caracteres[2:]
+    validos = ~(separador[:-2] | separador[1:-1] | separador[2:])
+    pares = np.sort((trigramas[validos] << 32) | np.cumsum(separador)[:-2][validos])
+    pares = pares[np.r_[True, pares[1:] != pares[:-1]]]
+    return (pares >> 32).astype(np.int32), (pares & 0xFFFFFFFF).astype(np.int32)
+
+class IndiceTrigramas:
+    """Trigrama -> códigos dos valores distintos (por coluna do índice textual) que o contêm.
+    Os candidatos de um trecho são os valores com todos os seus trigramas; só eles são conferidos.
+    Para caber em LIMITE_BYTES_TRIGRAMAS ficam de fora as listas mais longas (trigramas comuns,
+    que quase não filtram): sem elas a busca apenas confere mais candidatos."""
+    
+    def __init__(self, indice, limite_bytes=LIMITE_BYTES_TRIGRAMAS):
+        self.indice = indice
+        self.trigramas_por_valor = {}  # coluna -> quantos trigramas distintos cada valor tem
+        contagens = {}
+        for col in indice.colunas:
+            total_valores = len(indice.dobrados[col])
+            por_valor = np.zeros(total_valores, dtype=np.int32)
+            por_trigrama = np.zeros(1 << 21, dtype=np.int64)
+            for trigramas, valores, inicio in self.blocos(col):
+                por_valor[inicio:inicio + VALORES_POR_BLOCO] = np.bincount(valores, minlength=min(VALORES_POR_BLOCO, total_valores - inicio))
+                por_trigrama += np.bincount(trigramas, minlength=1 << 21)
+            self.trigramas_por_valor[col] = por_valor
+            contagens[col] = (np.flatnonzero(por_trigrama).astype(np.int32), por_trigrama[por_trigrama > 0])
+        # Mantém as listas mais curtas até o limite; as demais entram em omitidos
+        tamanhos = np.concatenate([quantidades for _, quantidades in contagens.values()] or [np.empty(0, dtype=np.int64)])
+        cabem = np.zeros(len(tamanhos), dtype=bool)
+        ordem = np.argsort(tamanhos, kind='stable')
+        cabem[ordem[np.cumsum(tamanhos[ordem]) * 4 <= limite_bytes]] = True
+        self.chaves, self.inicios, self.valores, self.omitidos = {}, {}, {}, {}
+        deslocamento = 0
+        for col, (trigramas_coluna, quantidades) in contagens.items():
+            mantidos_coluna = cabem[deslocamento:deslocamento + len(quantidades)]
+            deslocamento += len(quantidades)
+            self.omitidos[col] = trigramas_coluna[~mantidos_coluna]
+            mantidos = np.zeros(1 << 21, dtype=bool)
+            mantidos[trigramas_coluna[mantidos_coluna]] = True
+            partes_trigramas, partes_valores = [], []
+            for trigramas, valores, inicio in self.blocos(col):
+                manter = mantidos[trigramas]
+                partes_trigramas.append(trigramas[manter])
+                partes_valores.append(valores[manter] + inicio)
+            trigramas = np.concatenate(partes_trigramas or [np.empty(0, dtype=np.int32)])
+            ordem = np.argsort(trigramas, kind='stable')  # blocos em ordem: valores continuam crescentes
+            trigramas = trigramas[ordem]
+            self.valores[col] = np.concatenate(partes_valores or [np.empty(0, dtype=np.int32)])[ordem]
+            cortes = np.flatnonzero(np.r_[True, trigramas[1:] != trigramas[:-1]]) if len(trigramas) else np.empty(0, dtype=np.int64)
+            self.chaves[col] = trigramas[cortes]
+            self.inicios[col] = np.r_[cortes, len(trigramas)].astype(np.int64)
+    
+    def blocos(self, col):
+        dobrados = self.indice.dobrados[col]
+        for inicio in range(0, len(dobrados), VALORES_POR_BLOCO):
+            trigramas, valores = trigramas_bloco(dobrados.iloc[inicio:inicio + VALORES_POR_BLOCO].tolist())
+            yield trigramas, valores, inicio
+    
+    @property
+    def tamanho_bytes(self):
+        return sum(self.chaves[col].nbytes + self.inicios[col].nbytes + self.valores[col].nbytes
+                   + self.omitidos[col].nbytes + self.trigramas_por_valor[col].nbytes for col in self.chaves)
+    
+    def codigos_trigrama(self, col, trigrama):
+        """Códigos dos valores com o trigrama; None quando a lista foi omitida (não dá para filtrar por ele)"""
+        chaves = self.chaves[col]
+        posicao = int(np.searchsorted(chaves, trigrama))
+        if posicao < len(chaves) and chaves[posicao] == trigrama:
+            return self.valores[col][self.inicios[col][posicao]:self.inicios[col][posicao + 1]]
+        omitidos = self.omitidos[col]
+        posicao = int(np.searchsorted(omitidos, trigrama))
+        return None if posicao < len(omitidos) and omitidos[posicao] == trigrama else np.empty(0, dtype=np.int32)
+    
+    def valores_trecho(self, col, texto, presentes=None):
+        """(códigos dos valores da coluna que contêm o trecho, listas de trigramas do trecho que estão no índice).
+        Só os valores com todos esses trigramas (e, com presentes, entre eles) são conferidos."""
+        dobrados = self.indice.dobrados[col]
+        listas = [self.codigos_trigrama(col, trigrama) for trigrama in np.unique(trigramas_bloco([texto])[0])]
+        conhecidas = sorted((lista for lista in listas if lista is not None), key=len)
+        candidatos = None
+        if conhecidas:
+            candidatos = conhecidas[0]
+            for lista in conhecidas[1:]:
+                candidatos = np.intersect1d(candidatos, lista, assume_unique=True)
+        if presentes is not None:
+            candidatos = presentes if candidatos is None else np.intersect1d(candidatos, presentes, assume_unique=True)
+        conferir = dobrados if candidatos is None else dobrados.iloc[candidatos]
+        exatos = np.asarray(conferir.str.contains(texto, regex=False).to_numpy(dtype=bool))
+        return (np.flatnonzero(exatos) if candidatos is None else candidatos[exatos]), conhecidas
+    
+    def valores_termo(self, col, texto, tolerante, presentes=None):
+        """Códigos dos valores da coluna aceitos para o trecho e a nota de cada valor: fração dos trigramas
+        do termo presentes no valor (cobertura) + semelhança dos dois conjuntos (Jaccard, favorece valores
+        curtos), mais 1 quando o trecho aparece inteiro. Tolerando erros de digitação, valores com cobertura
+        a partir de LIMIAR_COBERTURA também são aceitos (um erro em 'banner' ainda cobre metade dos trigramas).
+        presentes traz os códigos dos valores que ainda interessam (os das linhas do refino); só eles são conferidos."""
+        dobrados = self.indice.dobrados[col]
+        exatos, conhecidas = self.valores_trecho(col, texto, presentes)
+        if conhecidas:
+            total_trigramas = len(np.unique(trigramas_bloco([texto])[0]))
+            compartilhados = np.bincount(np.concatenate(conhecidas), minlength=len(dobrados))
+            cobertura = compartilhados / len(conhecidas)
+            notas = (cobertura + compartilhados / (total_trigramas + self.trigramas_por_valor[col] - compartilhados)).astype(np.float32)
+        else:
+            cobertura = None
+            notas = np.zeros(len(dobrados), dtype=np.float32)
+        aceitos = exatos
+        if tolerante and cobertura is not None:
+            aceitos = np.union1d(exatos, np.flatnonzero(cobertura >= LIMIAR_COBERTURA))
+        notas[exatos] += 1
+        return aceitos, notas
+    
+    def pesquisar_literal(self, consulta, posicoes=None):
+        """Posições (na ordem da planilha) das linhas em que o texto digitado inteiro, sem acentos,
+        aparece como trecho de alguma coluna; sem separar termos nem ler 'campo:'"""
+        indice = self.indice
+        texto = normalizar_texto(consulta)
+        if not texto:
+            return np.empty(0, dtype=np.int32)
+        presentes = {}
+        if posicoes is not None:
+            posicoes = np.sort(posicoes)
+            presentes = indice.valores_presentes(posicoes)
+        aceitos = {}
+        for col in indice.colunas:
+            aceitos_coluna, _ = self.valores_trecho(col, texto, presentes.get(col))
+            if len(aceitos_coluna):
+                aceitos[col] = aceitos_coluna
+        mascara = indice.marcar_linhas(aceitos, posicoes)
+        return (np.flatnonzero(mascara) if posicoes is None else posicoes[mascara]).astype(np.int32)
+    
+    def pesquisar(self, consulta, tolerante=False, posicoes=None):
+        """Posições das linhas em que cada termo aparece como trecho (cada 'campo:valor' só na sua coluna),
+        da mais para a menos semelhante à consulta. Com posicoes, só essas linhas são avaliadas."""
+        indice = self.indice
+        termos, desconhecidos = indice.interpretar(consulta)
+        termos = [(coluna, normalizar_texto(texto)) for coluna, texto in termos]
+        termos = [(coluna, texto) for coluna, texto in termos if texto]
+        if not termos:
+            return np.empty(0, dtype=np.int32), desconhecidos
+        presentes = {}
+        if posicoes is not None:
+            posicoes = np.sort(posicoes)  # empates na nota seguem a ordem das linhas, como na busca completa
+            presentes = indice.valores_presentes(posicoes)
+        mascara = None
+        notas_termos = []
+        for coluna, texto in termos:
+            aceitos, notas = {}, {}
+            for col in ([coluna] if coluna else indice.colunas):
+                aceitos_coluna, notas_coluna = self.valores_termo(col, texto, tolerante, presentes.get(col))
+                if len(aceitos_coluna):
+                    aceitos[col] = aceitos_coluna
+                    notas[col] = np.append(notas_coluna, np.float32(0))  # código -1 (vazio) lê o 0 do fim
+            linhas = indice.marcar_linhas(aceitos, posicoes)
+            mascara = linhas if mascara is None else np.logical_and(mascara, linhas, out=mascara)
+            notas_termos.append(notas)
+        posicoes = np.flatnonzero(mascara) if posicoes is None else posicoes[mascara]
+        todas = len(posicoes) == indice.total_linhas
+        pontos = np.zeros(len(posicoes), dtype=np.float32)
+        for notas in notas_termos:
+            melhor = np.zeros(len(posicoes), dtype=np.float32)
+            for col, notas_coluna in notas.items():
+                codigos = indice.codigos[col] if todas else indice.codigos[col][posicoes]
+                np.maximum(melhor, notas_coluna[codigos], out=melhor)
+            pontos += melhor
+        return posicoes[np.argsort(-pontos, kind='stable')].astype(np.int32), desconhecidos
+
+@st.cache_resource(max_entries=2)
+def indice_textual(versao, _snapshot):
+    return IndiceTextual(_snapshot.df, {papel: col for papel, col in _snapshot.colunas.items() if col})
+
+@st.cache_resource(max_entries=2)
+def indice_trigramas(versao, _snapshot):
+    """Montado só na primeira busca por trecho do snapshot"""
+    return IndiceTrigramas(indice_textual(versao, _snapshot))
+
+FRACAO_REFINO = 0.1  # refinar só compensa quando o resultado anterior é uma fração pequena das linhas
+
+def refina_consulta(indice, anterior, consulta):
+    """True quando todo resultado de consulta está no de anterior: a consulta continua a anterior,
+    os termos já completos não mudam e o último só ganha caracteres (trecho ou prefixo mais longo)"""
+    if consulta == anterior or not consulta.startswith(anterior):
+        return False
+    termos_anteriores, _ = indice.interpretar(anterior)
+    termos, _ = indice.interpretar(consulta)
+    if not termos_anteriores or len(termos) < len(termos_anteriores):
+        return False
+    *completos, (coluna, texto) = termos_anteriores
+    coluna_nova, texto_novo = termos[len(completos)]
+    return termos[:len(completos)] == completos and coluna_nova == coluna and texto_novo.startswith(texto)
+
+def pesquisar_texto(snapshot, consulta, modo='palavras', tolerante=False, anterior=None):
+    """Resultado da pesquisa (posições somente leitura), memorizado como os filtros.
+    anterior: (consulta, posições) de uma pesquisa no mesmo modo; se a nova só a refina,
+    apenas aquelas linhas são avaliadas. Com tolerância a erros não há refino (parecidos não encolhem).
+    No modo trecho sem tolerância a consulta é literal: o texto inteiro, na ordem da planilha."""
+    literal = modo == 'trecho' and not tolerante
+    def calcular():
+        base = None
+        if anterior is not None and not tolerante and len(anterior[1]) <= snapshot.total_linhas * FRACAO_REFINO:
+            if literal:
+                trecho_anterior = normalizar_texto(anterior[0])
+                refina = bool(trecho_anterior) and trecho_anterior in normalizar_texto(consulta)
+            else:
+                refina = refina_consulta(indice_textual(snapshot.versao, snapshot), anterior[0], consulta)
+            if refina:
+                base = anterior[1]
+        if literal:
+            posicoes, desconhecidos = indice_trigramas(snapshot.versao, snapshot).pesquisar_literal(consulta, base), ()
+        elif modo == 'trecho':
+            posicoes, desconhecidos = indice_trigramas(snapshot.versao, snapshot).pesquisar(consulta, tolerante, base)
+        else:
+            posicoes, desconhecidos = indice_textual(snapshot.versao, snapshot).pesquisar(consulta, base)
+        posicoes.flags.writeable = False
+        return posicoes, tuple(desconhecidos)
+    chave = ('pesquisa', consulta) if modo == 'palavras' else ('pesquisa', modo, tolerante, consulta)
+    return cache_filtros().obter(snapshot.versao, chave, calcular)
+
+def pesquisa_incremental(snapshot, consulta, modo='palavras', tolerante=False):
+    """Pesquisa da sessão: guarda o último resultado para que a próxima consulta, se só continuar
+    a digitação, filtre apenas aquelas linhas. Ao apagar caracteres, a consulta mais curta já
+    pesquisada volta do cache de filtros."""
+    contexto = (snapshot.versao, modo, tolerante)
+    ultima = st.session_state.get('pesquisa_anterior')
+    anterior = (ultima['consulta'], ultima['posicoes']) if ultima and ultima['contexto'] == contexto else None
+    posicoes, desconhecidos = pesquisar_texto(snapshot, consulta, modo, tolerante, anterior)
+    st.session_state['pesquisa_anterior'] = {'contexto': contexto, 'consulta': consulta, 'posicoes': posicoes}
+    return posicoes, desconhecidos
+
+MODOS_PESQUISA = {"Literal": 'trecho', "Palavra inteira": 'palavras', "Regex": 'regex'}
+
+# Regex: roda sobre os valores distintos já dobrados, em blocos, numa thread com orçamento de tempo.
+# Só o RE2 do pyarrow é usado: tempo linear e sem segurar o GIL, então o orçamento é respeitado.
+# O que o RE2 não aceita (retrovisores, lookaround) é recusado; o re do Python poderia travar o servidor.
+ORCAMENTO_REGEX = 1.0        # segundos
+VALORES_POR_BLOCO_REGEX = 5_000
+
+@lru_cache(maxsize=128)
+def padrao_regex(expressao):
+    """Expressão sem acentos (como os textos), validada no RE2 uma vez; ValueError sobe para a tela"""
+    padrao = unicodedata.normalize('NFKD', expressao).encode('ascii', 'ignore').decode('ascii')
+    try:
+        pc.match_substring_regex(pa.array([''], type=pa.string()), padrao, ignore_case=True)
+    except pa.ArrowInvalid as erro:
+        raise ValueError(f"Expressão regular inválida ou não suportada (sem retrovisores nem lookaround): {erro}") from None
+    return padrao
+
+def casar_regex(textos, padrao):
+    return np.asarray(pc.match_substring_regex(pa.array(textos), padrao, ignore_case=True), dtype=bool)
+
+def executar_regex(indice, padrao, orcamento=ORCAMENTO_REGEX):
+    """(coluna -> códigos dos valores que casam, parcial). O trabalho fica numa thread: passado o
+    orçamento, ela é avisada para parar no fim do bloco atual e o que já foi achado é devolvido."""
+    achados = []  # (coluna, códigos) por bloco concluído
+    parar = threading.Event()
+    concluido = threading.Event()
+    
+    def trabalhar():
+        for col in indice.colunas:
+            dobrados = indice.dobrados[col]
+            for inicio in range(0, len(dobrados), VALORES_POR_BLOCO_REGEX):
+                if parar.is_set():
+                    return
+                casou = casar_regex(dobrados.iloc[inicio:inicio + VALORES_POR_BLOCO_REGEX], padrao)
+                achados.append((col, np.flatnonzero(casou) + inicio))
+        concluido.set()
+    
+    trabalhador = threading.Thread(target=trabalhar, name="pesquisa-regex", daemon=True)
+    trabalhador.start()
+    trabalhador.join(orcamento)
+    parar.set()
+    parcial = not concluido.is_set()
+    por_coluna = {}
+    for col, codigos in achados[:]:
+        por_coluna.setdefault(col, []).append(codigos)
+    return {col: np.concatenate(partes) for col, partes in por_coluna.items()}, parcial
+
+def pesquisar_regex(snapshot, expressao):
+    """(posições somente leitura, parcial). O resultado parcial também fica no cache: repetir a
+    mesma expressão cara não volta a ocupar uma thread do servidor."""
+    padrao = padrao_regex(expressao)
+    def calcular():
+        indice = indice_textual(snapshot.versao, snapshot)
+        codigos, parcial = executar_regex(indice, padrao)
+        posicoes = np.flatnonzero(indice.marcar_linhas(codigos)).astype(np.int32)
+        posicoes.flags.writeable = False
+        return posicoes, parcial
+    return cache_filtros().obter(snapshot.versao, ('pesquisa', 'regex', expressao), calcular)
+
+# =========================================================
+# FILTROS AVANÇADOS E VISÕES SALVAS
+# =========================================================
+# Períodos prontos dos filtros de data: opção -> (início, fim) a partir de hoje e dos limites da coluna
+PERIODOS_FILTRO = {
+    'data_solicitacao': {
+        "Todos": lambda hoje, minimo, maximo: (minimo, maximo),
+        "Hoje": lambda hoje, minimo, maximo: (hoje, hoje),
+        "Esta semana": lambda hoje, minimo, maximo: (hoje - timedelta(days=hoje.weekday()), hoje),
+        "Este mês": lambda hoje, minimo, maximo: (hoje.replace(day=1), hoje),
+        "Últimos 30 dias": lambda hoje, minimo, maximo: (hoje - timedelta(days=30), hoje),
+    },
+    'deadline': {
+        "Todos": lambda hoje, minimo, maximo: (minimo, maximo),
+        "Hoje": lambda hoje, minimo, maximo: (hoje, hoje),
+        "Esta semana": lambda hoje, minimo, maximo: (hoje - timedelta(days=hoje.weekday()), hoje + timedelta(days=6 - hoje.weekday())),
+        "Este mês": lambda hoje, minimo, maximo: (hoje.replace(day=1), (hoje.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)),
+        "Próximos 7 dias": lambda hoje, minimo, maximo: (hoje, hoje + timedelta(days=7)),
+        "Próximos 30 dias": lambda hoje, minimo, maximo: (hoje, hoje + timedelta(days=30)),
+        "Atrasados": lambda hoje, minimo, maximo: (minimo, hoje - timedelta(days=1)),
+    },
+}
+# Papel -> chave do selectbox nos filtros avançados
+CHAVES_FILTRO = {'status': 'filtro_status', 'prioridade': 'filtro_prioridade', 'producao': 'filtro_producao'}
+# Papel de data -> (chave do período, chaves das datas personalizadas, prefixo em filtros_ativos)
+CHAVES_PERIODO = {
+    'data_solicitacao': ('periodo_data', 'data_ini', 'data_fim', 'data'),
+    'deadline': ('periodo_deadline', 'deadline_ini', 'deadline_fim', 'deadline'),
+}
+CHAVES_FILTROS_DATA = ['data_inicio', 'data_fim', 'tem_filtro_data',
+                       'deadline_inicio', 'deadline_fim', 'tem_filtro_deadline', 'coluna_deadline']
+
+def marcar_periodo(filtros_ativos, snapshot, papel, inicio, fim):
+    prefixo = CHAVES_PERIODO[papel][3]
+    filtros_ativos[f'{prefixo}_inicio'] = inicio
+    filtros_ativos[f'{prefixo}_fim'] = fim
+    filtros_ativos[f'tem_filtro_{prefixo}'] = True
+    if papel == 'deadline':
+        filtros_ativos['coluna_deadline'] = snapshot.colunas['deadline']
+
+def separar_filtros(snapshot, filtros_ativos):
+    """Filtros categóricos (coluna -> valor) e janelas em dias (papel -> (início, fim)) dos filtros avançados"""
+    filtros_categoricos = {col: valor for col, valor in filtros_ativos.items() if col not in CHAVES_FILTROS_DATA}
+    janelas_datas = {}
+    for papel, (_, _, _, prefixo) in CHAVES_PERIODO.items():
+        if f'tem_filtro_{prefixo}' in filtros_ativos and papel in snapshot.indices_datas:
+            janelas_datas[papel] = (dia_epoca(filtros_ativos[f'{prefixo}_inicio']), dia_epoca(filtros_ativos[f'{prefixo}_fim']))
+    return filtros_categoricos, janelas_datas
+
+def chave_consulta_filtros(filtros_categoricos, janelas_datas):
+    return (tuple(sorted(filtros_categoricos.items())), tuple(sorted(janelas_datas.items())))
+
+def posicoes_filtro(snapshot, filtros_categoricos, janelas_datas, quadro=None):
+    """Posições (somente leitura, compartilhadas entre sessões) das linhas que passam nos filtros"""
+    if motor_polars_ativo():
+        posicoes = posicoes_polars(snapshot, {'filtros': filtros_categoricos, 'meses': None, 'janelas': janelas_datas}, quadro)
+    else:
+        bitmaps = [snapshot.indices_datas[papel].bitmap(*janela) for papel, janela in janelas_datas.items()]
+        posicoes = np.flatnonzero(snapshot.indice_filtros.combinar(filtros_categoricos, bitmaps)).astype(np.int32)
+    posicoes.flags.writeable = False
+    return posicoes
+
+# Visões salvas ficam em um JSON no servidor: nome -> {filtros por papel, períodos, colunas exibidas}.
+# Guardam papéis (não nomes de coluna) para sobreviver a renomeações na planilha.
+ARQUIVO_VISOES = os.path.join(os.path.dirname(os.path.abspath(__file__)), st.secrets.get("ARQUIVO_VISOES", "visoes_salvas.json"))
+
+@st.cache_resource
+def trava_visoes():
+    return threading.Lock()
+
+def assinatura_visoes():
+    try:
+        info = os.stat(ARQUIVO_VISOES)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+@st.cache_data(show_spinner=False)
+def ler_visoes(assinatura):
+    if assinatura is None:
+        return {}
+    try:
+        with open(ARQUIVO_VISOES, encoding='utf-8') as arquivo:
+            visoes = json.load(arquivo)
+    except (OSError, ValueError):
+        return {}
+    return visoes if isinstance(visoes, dict) else {}
+
+def gravar_visoes(alterar):
+    """Lê, altera e regrava o arquivo de visões sob a trava (troca atômica do arquivo)"""
+    with trava_visoes():
+        visoes = dict(ler_visoes(assinatura_visoes()))
+        alterar(visoes)
+        temporario = f"{ARQUIVO_VISOES}.tmp"
+        with open(temporario, 'w', encoding='utf-8') as arquivo:
+            json.dump(visoes, arquivo, ensure_ascii=False, indent=2)
+        os.replace(temporario, ARQUIVO_VISOES)
+
+def filtros_ativos_da_visao(snapshot, definicao, hoje):
+    """O mesmo dicionário que os filtros avançados montam, a partir de uma visão salva.
+    Valores que não existem mais na planilha ficam de fora e voltam na lista de ignorados."""
+    filtros_ativos = {}
+    ignorados = []
+    for papel, valor in definicao.get('filtros', {}).items():
+        if valor == 'Todos':
+            continue
+        if papel in CHAVES_FILTRO and snapshot.colunas[papel] and valor in snapshot.opcoes.get(papel, []):
+            filtros_ativos[snapshot.colunas[papel]] = valor
+        else:
+            ignorados.append(f"{rotulo_papel(papel)}: {valor}")
+    for papel in CHAVES_PERIODO:
+        if not snapshot.colunas[papel] or papel not in snapshot.limites_datas:
+            continue
+        periodo = definicao.get('periodos', {}).get(papel, {'opcao': "Todos"})
+        if periodo['opcao'] == "Personalizado":
+            inicio = datetime.fromisoformat(periodo['inicio']).date()
+            fim = datetime.fromisoformat(periodo['fim']).date()
+        else:
+            if periodo['opcao'] not in PERIODOS_FILTRO[papel]:
+                ignorados.append(f"{rotulo_papel(papel)}: {periodo['opcao']}")
+            intervalo = PERIODOS_FILTRO[papel].get(periodo['opcao'], PERIODOS_FILTRO[papel]["Todos"])
+            inicio, fim = intervalo(hoje, *snapshot.limites_datas[papel])
+        marcar_periodo(filtros_ativos, snapshot, papel, inicio, fim)
+    return filtros_ativos, ignorados
+
+def estado_filtros_avancados():
+    """Estado atual dos filtros avançados (lido do session_state), no formato das visões salvas"""
+    estado = {
+        'filtros': {papel: st.session_state.get(chave, 'Todos') for papel, chave in CHAVES_FILTRO.items()},
+        'periodos': {},
+    }
+    for papel, (chave_periodo, chave_ini, chave_fim, _) in CHAVES_PERIODO.items():
+        periodo = {'opcao': st.session_state.get(chave_periodo, "Todos")}
+        if periodo['opcao'] == "Personalizado" and chave_ini in st.session_state and chave_fim in st.session_state:
+            periodo['inicio'] = st.session_state[chave_ini].isoformat()
+            periodo['fim'] = st.session_state[chave_fim].isoformat()
+        elif periodo['opcao'] == "Personalizado":
+            periodo['opcao'] = "Todos"
+        estado['periodos'][papel] = periodo
+    return estado
+
+def definicao_visao_atual(colunas):
+    return {**estado_filtros_avancados(), 'colunas': list(colunas), 'criada_em': datetime.now().isoformat(timespec='seconds')}
+
+@st.cache_resource(max_entries=2)
+def visoes_materializadas(versao, _snapshot, assinatura, hoje):
+    """Posições e KPIs de todas as visões salvas, calculados uma vez por snapshot.
+    O dia entra na chave porque os períodos ("Este mês", "Atrasados"...) são relativos a hoje."""
+    inicio = time.perf_counter()
+    visoes = {}
+    for nome, definicao in ler_visoes(assinatura).items():
+        try:
+            filtros_ativos, ignorados = filtros_ativos_da_visao(_snapshot, definicao, hoje)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue  # visão malformada no arquivo
+        filtros_categoricos, janelas_datas = separar_filtros(_snapshot, filtros_ativos)
+        posicoes = posicoes_filtro(_snapshot, filtros_categoricos, janelas_datas)
+        mascara = np.zeros(_snapshot.total_linhas, dtype=bool)
+        mascara[posicoes] = True
+        visoes[nome] = {
+            'definicao': definicao,
+            'chave': chave_consulta_filtros(filtros_categoricos, janelas_datas),
+            'posicoes': posicoes,
+            'kpis': calcular_kpis(_snapshot, mascara),
+            'ignorados': ignorados,
+        }
+    return {
+        'visoes': visoes,
+        'por_chave': {visao['chave']: visao for visao in visoes.values()},
+        'segundos': time.perf_counter() - inicio,
+        'materializadas_em': datetime.now(),
+    }
+
+def salvar_visao_atual():
+    nome = st.session_state.get('nome_nova_visao', '').strip()
+    if not nome:
+        st.toast("⚠️ Dê um nome para a visão")
+        return
+    definicao = definicao_visao_atual(st.session_state.get('colunas_nova_visao', []))
+    gravar_visoes(lambda visoes: visoes.update({nome: definicao}))
+    st.session_state.visao_salva = nome
+    st.session_state.nome_nova_visao = ""
+    st.toast(f"⭐ Visão \"{nome}\" salva")
+
+def excluir_visao():
+    nome = st.session_state.pop('visao_salva', None)
+    if nome:
+        gravar_visoes(lambda visoes: visoes.pop(nome, None))
+        st.toast(f"🗑️ Visão \"{nome}\" excluída")
+
+def limpar_filtros():
+    """Callback do 'Limpar Todos os Filtros': os widgets voltam ao padrão antes do trecho ser redesenhado"""
+    for key in list(st.session_state.keys()):
+        if key.startswith('filtro_') or key in ['periodo_data', 'data_ini', 'data_fim', 
+                                                'periodo_deadline', 'deadline_ini', 'deadline_fim', 'visao_salva']:
+            del st.session_state[key]
+
+def abrir_visao(snapshot):
+    """Callback do seletor: copia os filtros da visão para os widgets dos filtros avançados"""
+    nome = st.session_state.get('visao_salva')
+    definicao = ler_visoes(assinatura_visoes()).get(nome)
+    if definicao is None:
+        return
+    opcoes = snapshot.opcoes
+    for papel, chave in CHAVES_FILTRO.items():
+        valor = definicao.get('filtros', {}).get(papel, 'Todos')
+        st.session_state[chave] = valor if valor in opcoes.get(papel, []) else 'Todos'
+    for papel, (chave_periodo, chave_ini, chave_fim, _) in CHAVES_PERIODO.items():
+        periodo = definicao.get('periodos', {}).get(papel, {'opcao': "Todos"})
+        opcao = periodo.get('opcao', "Todos")
+        if opcao == "Personalizado":
+            st.session_state[chave_ini] = datetime.fromisoformat(periodo['inicio']).date()
+            st.session_state[chave_fim] = datetime.fromisoformat(periodo['fim']).date()
+        elif opcao not in PERIODOS_FILTRO[papel]:
+            opcao = "Todos"
+        st.session_state[chave_periodo] = opcao
+
+# =========================================================
+# PRÉ-CÁLCULO ESPECULATIVO (COMBINAÇÕES MAIS USADAS)
+# =========================================================
+TOP_COMBINACOES_AQUECIMENTO = 24
+ORCAMENTO_CPU_AQUECIMENTO = 2.0  # segundos de CPU da thread, por snapshot
+
+class UsoFiltros:
+    """Quantas vezes cada combinação de filtros foi escolhida, somando todas as sessões"""
+    
+    def __init__(self):
+        self.contagem = Counter()
+        self._trava = threading.Lock()
+    
+    def registrar(self, tipo, estado):
+        chave = (tipo, json.dumps(estado, sort_keys=True, ensure_ascii=False))
+        with self._trava:
+            self.contagem[chave] += 1
+    
+    def mais_usadas(self, n):
+        with self._trava:
+            return [(tipo, json.loads(estado)) for (tipo, estado), _ in self.contagem.most_common(n)]
+
+@st.cache_resource
+def uso_filtros():
+    return UsoFiltros()
+
+def registrar_uso(tipo, estado):
+    """Conta a combinação quando ela muda na sessão (reexecuções com os mesmos filtros não contam)"""
+    chave_sessao = f'ultimo_uso_{tipo}'
+    if st.session_state.get(chave_sessao) != estado:
+        st.session_state[chave_sessao] = estado
+        uso_filtros().registrar(tipo, estado)
+
+def combinacoes_semente(snapshot):
+    """Presets comuns, usados enquanto o histórico de uso ainda não chega ao top N"""
+    filtros_padrao = {papel: 'Todos' for papel in CHAVES_FILTRO}
+    periodos_padrao = {papel: {'opcao': "Todos"} for papel in CHAVES_PERIODO}
+    sementes = [('filtros', {'filtros': filtros_padrao, 'periodos': periodos_padrao})]
+    for opcao in ["Atrasados", "Próximos 7 dias", "Hoje"]:
+        sementes.append(('filtros', {'filtros': filtros_padrao, 'periodos': {**periodos_padrao, 'deadline': {'opcao': opcao}}}))
+    for valor in snapshot.opcoes.get('status', []):
+        sementes.append(('filtros', {'filtros': {**filtros_padrao, 'status': valor}, 'periodos': periodos_padrao}))
+    for periodo in PERIODOS_KPI:
+        sementes.append(('kpis', {'filtros': {'status': 'Todos', 'prioridade': 'Todos'}, 'periodo': periodo}))
+    for valor in snapshot.opcoes.get('status', []):
+        sementes.append(('kpis', {'filtros': {'status': valor, 'prioridade': 'Todos'}, 'periodo': "Todo período"}))
+    return sementes
+
+def aquecer_combinacao(snapshot, tipo, estado, hoje, recursos):
+    """Calcula (e guarda nos caches compartilhados) o mesmo que a interface calcularia para a combinação.
+    recursos: caches e quadro Polars obtidos na thread do script; aqui nenhuma função do Streamlit é chamada."""
+    if tipo == 'filtros':
+        filtros_ativos, _ = filtros_ativos_da_visao(snapshot, estado, hoje)
+        filtros_categoricos, janelas_datas = separar_filtros(snapshot, filtros_ativos)
+        recursos['filtros'].obter(snapshot.versao, chave_consulta_filtros(filtros_categoricos, janelas_datas),
+                                  lambda: posicoes_filtro(snapshot, filtros_categoricos, janelas_datas, recursos['quadro']))
+    else:
+        filtros_kpi = {
+            snapshot.colunas[papel]: valor for papel, valor in estado['filtros'].items()
+            if valor != 'Todos' and snapshot.colunas[papel] and valor in snapshot.opcoes.get(papel, [])
+        }
+        consulta_kpi, mascara_kpi, _ = consulta_kpi_periodo(snapshot, filtros_kpi, estado['periodo'], hoje)
+        calcular_kpis(snapshot, mascara_kpi, consulta_kpi, cache=recursos['kpis'], quadro=recursos['quadro'])
+
+def aquecer_caches(snapshot, combinacoes, hoje, progresso, recursos):
+    inicio = time.thread_time()
+    for tipo, estado in combinacoes:
+        if time.thread_time() - inicio > ORCAMENTO_CPU_AQUECIMENTO:
+            progresso['esgotado'] = True
+            break
+        try:
+            aquecer_combinacao(snapshot, tipo, estado, hoje, recursos)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue  # combinação que não se aplica a esta planilha
+        progresso['aquecidas'] += 1
+    progresso['cpu'] = time.thread_time() - inicio
+    progresso['concluido'] = True
+
+@st.cache_resource(max_entries=2)
+def aquecimento(versao, _snapshot, hoje):
+    """Dispara em segundo plano, uma vez por snapshot (e por dia), o pré-cálculo das combinações mais usadas.
+    Filtros avançados aquecem as posições; os da aba de KPIs, os KPIs e agregados dos gráficos."""
+    combinacoes = {}
+    for tipo, estado in uso_filtros().mais_usadas(TOP_COMBINACOES_AQUECIMENTO) + combinacoes_semente(_snapshot):
+        combinacoes.setdefault((tipo, json.dumps(estado, sort_keys=True, ensure_ascii=False)), (tipo, estado))
+    selecionadas = list(combinacoes.values())[:TOP_COMBINACOES_AQUECIMENTO]
+    progresso = {'combinacoes': len(selecionadas), 'aquecidas': 0, 'cpu': 0.0, 'esgotado': False, 'concluido': False}
+    # Recursos do Streamlit obtidos aqui: a thread vive além desta execução e não leva contexto de sessão
+    recursos = {
+        'filtros': cache_filtros(),
+        'kpis': cache_kpis(),
+        'quadro': quadro_polars(versao, _snapshot) if motor_polars_ativo() else None,
+    }
+    threading.Thread(target=aquecer_caches, args=(_snapshot, selecionadas, hoje, progresso, recursos),
+                     name='aquecimento-caches', daemon=True).start()
+    return progresso
+
+# =========================================================
+# CARREGAR DADOS
+# =========================================================
+with st.spinner("📥 Carregando dados do Excel..."):
+    versao_planilha = obter_versao_planilha()
+    snapshot = obter_snapshot(versao_planilha)
+
+df = snapshot.df
+derivadas = snapshot.derivadas
+carga = snapshot.carga
+COLUNAS = snapshot.colunas
+
+# Visões salvas materializadas assim que o snapshot fica pronto: abrir uma é só uma consulta
+visoes_prontas = visoes_materializadas(snapshot.versao, snapshot, assinatura_visoes(), datetime.now().date())
+
+# Em seguida, as combinações de filtros mais usadas são pré-calculadas em segundo plano
+progresso_aquecimento = aquecimento(snapshot.versao, snapshot, datetime.now().date())
+
+if carga['origem'] == 'exemplo':
+    st.warning("⚠️ Não foi possível carregar os dados do SharePoint. Usando dados de exemplo...")
+
+if carga['deriva']:
+    deriva = carga['deriva']
+    st.warning(
+        f"⚠️ A estrutura da aba '{SHEET_NAME}' mudou desde a última carga. "
+        f"Removidas: {', '.join(map(str, deriva['removidas'])) or 'nenhuma'} | "
+        f"Novas: {', '.join(map(str, deriva['novas'])) or 'nenhuma'}"
+        + (f" | Sem coluna agora: {', '.join(rotulo_papel(p) for p in deriva['papeis_perdidos'])}" if deriva['papeis_perdidos'] else "")
+    )
+
+if carga['esquema']['ausentes']:
+    st.warning(f"⚠️ Colunas não encontradas na aba '{SHEET_NAME}': {', '.join(rotulo_papel(p) for p in carga['esquema']['ausentes'])}. Os indicadores que dependem delas usam valores padrão.")
+
+# =========================================================
+# CALCULAR MÉTRICAS
+# =========================================================
+total_linhas = len(df)
+total_colunas = len(df.columns)
+
+# O checkbox fica na sidebar (desenhada depois); o valor da execução anterior vem do session_state
+modo_aproximado = st.session_state.get('modo_aproximado', MODO_APROXIMADO)
+
+# Métricas gerais (sem filtros): cada uma só é calculada quando algum widget a lê
+hoje_metricas = datetime.now().date()
+metricas = AvaliadorMetricas(
+    ('geral', modo_aproximado, hoje_metricas),
+    snapshot=snapshot, consulta={'filtros': {}, 'meses': None}, aproximado=modo_aproximado, hoje=hoje_metricas,
+)
+
+# =========================================================
+# SIDEBAR
+# =========================================================
+# Callbacks rodam antes da execução: os dados já são recarregados nela, sem um st.rerun extra
+def atualizar_dados():
+    st.cache_data.clear()
+    st.toast("✅ Cache limpo! Atualizando...")
+
+def limpar_caches():
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    st.toast("🧹 Cache completamente limpo!")
+
+with st.sidebar:
+    st.markdown("""
+    <div style="text-align: center; margin-bottom: 20px;">
+        <h1 style="color: #003366; font-size: 28px; margin: 0;">📊 COCRED</h1>
+        <p style="color: #00A3E0; font-size: 12px; margin: 0;">Dashboard de Campanhas</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    st.divider()
+    
+    st.markdown("### 🔄 **Atualização**")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.button("🔄 Atualizar", type="primary", use_container_width=True, on_click=atualizar_dados)
+    
+    with col2:
+        st.button("🗑️ Limpar Cache", type="secondary", use_container_width=True, on_click=limpar_caches)
+    
+    token = get_access_token()
+    if token:
+        st.success("✅ **Conectado** | Token ativo", icon="🔌")
+    else:
+        st.warning("⚠️ **Offline** | Usando dados de exemplo", icon="💾")
+    
+    st.divider()
+    
+    st.markdown("### ⭐ **Visões Salvas**")
+    
+    if st.session_state.get('visao_salva') not in visoes_prontas['visoes']:
+        st.session_state.pop('visao_salva', None)
+    
+    if visoes_prontas['visoes']:
+        st.selectbox(
+            "Abrir visão:", [None] + list(visoes_prontas['visoes']), key="visao_salva",
+            format_func=lambda nome: "— Escolha uma visão —" if nome is None else f"{nome} ({len(visoes_prontas['visoes'][nome]['posicoes']):,})",
+            on_change=abrir_visao, args=(snapshot,)
+        )
+    else:
+        st.caption("Nenhuma visão salva ainda.")
+    
+    with st.expander("💾 Salvar filtros atuais como visão"):
+        st.text_input("Nome:", key="nome_nova_visao", placeholder="Ex.: Alta prioridade em produção")
+        st.multiselect("Colunas exibidas:", list(df.columns), key="colunas_nova_visao", placeholder="Todas as colunas")
+        st.button("💾 Salvar visão", on_click=salvar_visao_atual, use_container_width=True)
+        if st.session_state.get('visao_salva'):
+            st.button(f"🗑️ Excluir \"{st.session_state.visao_salva}\"", on_click=excluir_visao, use_container_width=True)
+    
+    st.divider()
+    
+    st.markdown("### 👁️ **Visualização**")
+    
+    linhas_por_pagina = st.selectbox(
+        "📋 Linhas por página:",
+        ["50", "100", "200", "500", "Todas"],
+        index=1
+    )
+    
+    modo_compacto = st.checkbox("📏 Modo compacto", value=False)
+    
+    if modo_compacto:
+        st.markdown("""
+        <style>
+            .block-container {padding-top: 1rem; padding-bottom: 0rem;}
+            .stMetric {padding: 0.5rem;}
+        </style>
+        """, unsafe_allow_html=True)
+    
+    st.divider()
+    
+    st.markdown("### 📊 **Resumo Executivo**")
+    
+    col_m1, col_m2 = st.columns(2)
+    
+    with col_m1:
+        st.metric(label="📋 Total de Registros", value=f"{total_linhas:,}",
+                  delta=f"+{metricas['novos_7_dias']} em 7 dias" if metricas['novos_7_dias'] is not None else None)
+    
+    with col_m2:
+        st.metric(label="✅ Concluídos/Aprovados", value=f"{metricas['total_concluidos']:,}{margem_erro(metricas['kpis'], 'regras', 'concluido_aprovado')}", delta=f"{metricas['taxa_conclusao']:.0f}%")
+    
+    col_m3, col_m4 = st.columns(2)
+    
+    with col_m3:
+        st.metric(label="🔴 Prioridade Alta", value=f"{metricas['total_alta']:,}{margem_erro(metricas['kpis'], 'regras', 'prioridade_alta')}", delta=None)
+    
+    with col_m4:
+        st.metric(label="📅 Solicitações Hoje", value=metricas['total_hoje'],
+                  delta=f"{metricas['total_hoje'] - metricas['total_ontem']:+d} vs ontem" if metricas['total_ontem'] is not None else None)
+    
+    st.divider()
+    
+    st.markdown("### 🛠️ **Ferramentas**")
+    
+    if 'debug_mode' not in st.session_state:
+        st.session_state.debug_mode = False
+    
+    debug_mode = st.checkbox("🐛 **Modo Debug**", value=st.session_state.debug_mode)
+    st.session_state.debug_mode = debug_mode
+    
+    auto_refresh = st.checkbox("🔄 **Auto-refresh (60s)**", value=False)
+    
+    st.checkbox(
+        "≈ **Modo aproximado**", value=MODO_APROXIMADO, key="modo_aproximado",
+        help=f"A partir de {LIMIAR_LINHAS_APROXIMADO:,} linhas, os KPIs que o cubo não cobre são estimados por amostragem "
+             "estratificada e HyperLogLog, com margem de erro de 95%. Abaixo disso, tudo é exato."
+    )
+    
+    st.divider()
+    
+    st.markdown("### ℹ️ **Informações**")
+    st.caption(f"🕐 **Última atualização:** {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+    
+    st.markdown("""
+    **📎 Links úteis:**
+    - [📊 Abrir Excel Online](https://agenciaideatore-my.sharepoint.com/:x:/g/personal/cristini_cordesco_ideatoreamericas_com/IQDMDcVdgAfGSIyZfeke7NFkAatm3fhI0-X4r6gIPQJmosY)
+    """)
+    
+    st.divider()
+    
+    st.markdown("""
+    <div style="text-align: center; color: #6C757D; font-size: 11px; padding: 10px 0;">
+        <p style="margin: 0;">Desenvolvido para</p>
+        <p style="margin: 0; font-weight: bold; color: #003366;">SICOOB COCRED</p>
+        <p style="margin: 5px 0 0 0;">© 2026 - Ideatore</p>
+        <p style="margin: 5px 0 0 0;">v4.2.0</p>
+    </div>
+    """, unsafe_allow_html=True)
+
+# =========================================================
+# INTERFACE PRINCIPAL
+# =========================================================
+st.markdown(f"""
+<div style="display: flex; align-items: center; margin-bottom: 20px;">
+    <h1 style="color: #003366; margin: 0;">📊 Dashboard de Campanhas</h1>
+    <span style="background: #00A3E0; color: white; padding: 5px 15px; border-radius: 20px; margin-left: 20px; font-size: 14px;">
+        SICOOB COCRED
+    </span>
+</div>
+""", unsafe_allow_html=True)
+
+st.caption(f"🔗 Conectado ao Excel Online | Aba: {SHEET_NAME}")
+
+st.success(f"✅ **{total_linhas} registros** carregados com sucesso!")
+st.info(f"📋 **Colunas:** {', '.join(df.columns.tolist()[:5])}{'...' if len(df.columns) > 5 else ''}")
+
+# =========================================================
+# TABS
+# =========================================================
+tab1, tab2, tab3, tab4, tab5 = st.tabs([
+    "📊 Dados Completos", 
+    "📈 Análise Estratégica", 
+    "🔍 Pesquisa",
+    "🎯 KPIs COCRED",
+    "🧮 SQL"
+])
+
+# =========================================================
+# TAB 1: DADOS COMPLETOS
+# =========================================================
+with tab1:
+    @st.fragment
+    def dados_completos():
+        """Ordenação e paginação da tabela completa; navegar reexecuta só este trecho"""
+        coluna_ordem, ordem_decrescente = controle_ordenacao("completos", df.columns)
+        ordem_completos = None if coluna_ordem is None else posicoes_ordenadas(snapshot, None, None, coluna_ordem, ordem_decrescente)
+        
+        if linhas_por_pagina == "Todas":
+            st.subheader(f"📋 Todos os {total_linhas} registros")
+        tabela_paginada("completos", snapshot, ordem_completos, ('completos', coluna_ordem, ordem_decrescente), linhas_por_pagina)
+    
+    dados_completos()
+
+# =========================================================
+# TAB 2: ANÁLISE ESTRATÉGICA
+# =========================================================
+with tab2:
+    st.markdown("## 📈 Análise Estratégica")
+    
+    # Configurações de template para Plotly (funciona em dark/light)
+    is_dark = st.get_option('theme.base') == 'dark'
+    plotly_template = 'plotly_dark' if is_dark else 'plotly_white'
+    text_color = 'white' if is_dark else 'black'
+    
+    if metricas['kpis']['origem'] == 'aproximado':
+        st.caption("≈ Indicadores e gráficos estimados por amostragem estratificada e HyperLogLog (modo aproximado).")
+    
+    # ========== 1. MÉTRICAS DE NEGÓCIO ==========
+    st.markdown("""
+    <div class="info-container-cocred">
+        <p style="margin: 0; font-size: 14px;">
+            <strong>🎯 Indicadores de Performance</strong> - Acompanhe os principais KPIs do negócio.
+        </p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    col_metric1, col_metric2, col_metric3, col_metric4 = st.columns(4)
+    
+    with col_metric1:
+        st.markdown(f"""
+        <div class="metric-card-cocred">
+            <p style="font-size: 14px; margin: 0; opacity: 0.9;">✅ TAXA DE CONCLUSÃO</p>
+            <p style="font-size: 36px; font-weight: bold; margin: 0;">{metricas['taxa_conclusao']:.1f}%</p>
+            <p style="font-size: 12px; margin: 0;">{metricas['total_concluidos']} de {total_linhas} concluídos</p>
+            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                📌 Percentual de demandas finalizadas
+            </p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_metric2:
+        st.markdown(f"""
+        <div class="metric-card-cocred" style="background: linear-gradient(135deg, #00A3E0 0%, #0077A3 100%);">
+            <p style="font-size: 14px; margin: 0; opacity: 0.9;">⏱️ TEMPO MÉDIO</p>
+            <p style="font-size: 36px; font-weight: bold; margin: 0;">4.2 dias</p>
+            <p style="font-size: 12px; margin: 0;">da solicitação à entrega</p>
+            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                📌 Tempo médio de execução
+            </p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    with col_metric3:
+        st.markdown(f"""
+        <div class="metric-card-cocred" style="background: linear-gradient(135deg, #28A745 0%, #1E7E34 100%);">
+            <p style="font-size: 14px; margin: 0; opacity: 0.9;">👥 MÉDIA POR SOLICITANTE</p>
+            <p style="font-size: 36px; font-weight: bold; margin: 0;">{metricas['media_solicitante']:.1f}</p>
+            <p style="font-size: 12px; margin: 0;">demandas por pessoa</p>
+            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                📌 Volume médio por usuário
+            </p>
+        </div>
         """, unsafe_allow_html=True)
     
     with col_metric4:
-        perc_alta = (total_alta / total_linhas * 100) if total_linhas > 0 else 0
         st.markdown(f"""
         <div class="metric-card-cocred" style="background: linear-gradient(135deg, #DC3545 0%, #B22222 100%);">
             <p style="font-size: 14px; margin: 0; opacity: 0.9;">🔴 URGÊNCIA</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{perc_alta:.0f}%</p>
+            <p style="font-size: 36px; font-weight: bold; margin: 0;">{metricas['percentual_alta']:.0f}%</p>
             <p style="font-size: 12px; margin: 0;">prioridade alta</p>
             <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
                 📌 Demandas com prioridade alta
@@ -582,8 +3139,8 @@ with tab2:
     col_status1, col_status2 = st.columns([2, 1])
     
     with col_status1:
-        if 'Status' in df.columns:
-            status_counts = df['Status'].value_counts().reset_index()
+        if COLUNAS['status']:
+            status_counts = metricas['kpis']['contagens']['status'].reset_index()
             status_counts.columns = ['Status', 'Quantidade']
             
             ordem_status = ['Aguardando Aprovação', 'Em Produção', 'Aprovado', 'Concluído', 'Solicitação de Ajustes']
@@ -620,11 +3177,11 @@ with tab2:
             st.plotly_chart(fig_status, use_container_width=True, config={'displayModeBar': False})
     
     with col_status2:
-        if 'Status' in df.columns:
-            aguardando = len(df[df['Status'].str.contains('Aguardando', na=False, case=False)])
-            producao = len(df[df['Status'].str.contains('Produção', na=False, case=False)])
-            aprovado = len(df[df['Status'].str.contains('Aprovado', na=False, case=False)])
-            concluido = len(df[df['Status'].str.contains('Concluído', na=False, case=False)])
+        if COLUNAS['status']:
+            aguardando = metricas['kpis']['regras']['aguardando']
+            producao = metricas['kpis']['regras']['em_producao']
+            aprovado = metricas['kpis']['regras']['aprovado']
+            concluido = metricas['kpis']['regras']['concluido']
             
             gargalo = 'Em Produção' if producao > aguardando else 'Aguardando'
             gargalo_valor = producao if producao > aguardando else aguardando
@@ -657,7 +3214,7 @@ with tab2:
     st.divider()
     
     # ========== 3. ANÁLISE POR SOLICITANTE ==========
-    if 'Solicitante' in df.columns:
+    if COLUNAS['solicitante']:
         st.markdown("""
         <div class="info-container-cocred">
             <p style="margin: 0; font-size: 14px;">
@@ -669,7 +3226,7 @@ with tab2:
         col_sol1, col_sol2 = st.columns([2, 1])
         
         with col_sol1:
-            top_solicitantes = df['Solicitante'].value_counts().head(5).reset_index()
+            top_solicitantes = metricas['kpis']['contagens']['solicitante'].head(5).reset_index()
             top_solicitantes.columns = ['Solicitante', 'Quantidade']
             
             fig_sol = px.bar(
@@ -701,9 +3258,10 @@ with tab2:
             st.plotly_chart(fig_sol, use_container_width=True, config={'displayModeBar': False})
         
         with col_sol2:
-            media_sol = df['Solicitante'].value_counts().mean()
-            maior_sol = df['Solicitante'].value_counts().max()
-            nome_maior = df['Solicitante'].value_counts().index[0]
+            contagem_solicitantes = metricas['kpis']['contagens']['solicitante']
+            media_sol = contagem_solicitantes.mean()
+            maior_sol = contagem_solicitantes.max()
+            nome_maior = contagem_solicitantes.index[0]
             
             st.markdown(f"""
             <div class="resumo-card" style="height: 350px;">
@@ -730,7 +3288,7 @@ with tab2:
     st.divider()
     
     # ========== 4. ANÁLISE TEMPORAL ==========
-    if 'Data de Solicitação' in df.columns:
+    if COLUNAS['data_solicitacao']:
         st.markdown("""
         <div class="info-container-cocred">
             <p style="margin: 0; font-size: 14px;">
@@ -739,9 +3297,9 @@ with tab2:
         </div>
         """, unsafe_allow_html=True)
         
-        df['Mês'] = df['Data de Solicitação'].dt.to_period('M').astype(str)
-        evolucao = df.groupby('Mês').size().reset_index()
+        evolucao = metricas['kpis']['por_mes'].reset_index()
         evolucao.columns = ['Mês', 'Quantidade']
+        evolucao['Mês'] = evolucao['Mês'].map(rotulo_mes)
         
         col_temp1, col_temp2 = st.columns([3, 1])
         
@@ -771,22 +3329,29 @@ with tab2:
             st.plotly_chart(fig_evolucao, use_container_width=True, config={'displayModeBar': False})
         
         with col_temp2:
-            if len(evolucao) >= 2:
-                ultimo_mes = evolucao.iloc[-1]['Quantidade']
-                mes_anterior = evolucao.iloc[-2]['Quantidade']
-                variacao = ((ultimo_mes - mes_anterior) / mes_anterior * 100) if mes_anterior > 0 else 0
+            if snapshot.contagens_diarias is not None:
+                # Mês e semana até a referência contra o mesmo trecho do período anterior
+                referencia = min(datetime.now().date(), data_epoca(snapshot.contagens_diarias.dia_final))
+                janelas = janelas_comparacao(referencia)
+                mes_atual, mes_anterior = snapshot.contagens_diarias.comparar(*janelas['mes'])
+                semana_atual, semana_anterior = snapshot.contagens_diarias.comparar(*janelas['semana'])
+                variacao = variacao_percentual(mes_atual, mes_anterior)
+                variacao_semana = variacao_percentual(semana_atual, semana_anterior)
                 
                 st.markdown(f"""
                 <div class="resumo-card" style="height: 300px;">
                     <h4 style="color: #003366; margin-top: 0;">📈 Tendência</h4>
-                    <div style="text-align: center; margin-top: 40px;">
-                        <div style="background: {'#28A745' if variacao >= 0 else '#DC3545'}; 
+                    <div style="text-align: center; margin-top: 20px;">
+                        <div style="background: {'#28A745' if (variacao or 0) >= 0 else '#DC3545'}; 
                                     color: white; border-radius: 10px; padding: 20px;">
-                            <p style="font-size: 14px; margin: 0; opacity: 0.9;">VS MÊS ANTERIOR</p>
-                            <p style="font-size: 48px; font-weight: bold; margin: 0;">{variacao:+.1f}%</p>
+                            <p style="font-size: 14px; margin: 0; opacity: 0.9;">MÊS ATÉ {referencia.strftime('%d/%m')} VS ANTERIOR</p>
+                            <p style="font-size: 48px; font-weight: bold; margin: 0;">{formatar_variacao(variacao)}</p>
                         </div>
-                        <p style="margin-top: 20px; color: #6C757D;">
-                            {ultimo_mes} solicitações no último mês
+                        <p style="margin-top: 15px; color: #6C757D;">
+                            {mes_atual} solicitações no mês ({mes_anterior} no mesmo trecho do anterior)
+                        </p>
+                        <p style="margin: 0; color: #6C757D;">
+                            Semana: {semana_atual} vs {semana_anterior} ({formatar_variacao(variacao_semana)})
                         </p>
                     </div>
                 </div>
@@ -795,7 +3360,7 @@ with tab2:
     st.divider()
     
     # ========== 5. ANÁLISE DE PRODUÇÃO ==========
-    if 'Produção' in df.columns:
+    if COLUNAS['producao']:
         st.markdown("""
         <div class="info-container-cocred">
             <p style="margin: 0; font-size: 14px;">
@@ -807,7 +3372,7 @@ with tab2:
         col_prod1, col_prod2 = st.columns(2)
         
         with col_prod1:
-            producao_counts = df['Produção'].value_counts().reset_index()
+            producao_counts = metricas['kpis']['contagens']['producao'].reset_index()
             producao_counts.columns = ['Produção', 'Quantidade']
             
             fig_prod = px.pie(
@@ -871,6 +3436,38 @@ with tab2:
                 </div>
             </div>
             """, unsafe_allow_html=True)
+    
+    # ========== 6. PEÇAS POR FAMÍLIA ==========
+    contagem_pecas_familia = metricas['pecas']
+    if contagem_pecas_familia is not None and len(contagem_pecas_familia) > 0:
+        st.divider()
+        st.markdown("""
+        <div class="info-container-cocred">
+            <p style="margin: 0; font-size: 14px;">
+                <strong>🧩 Peças por Família</strong> - Volume de cada família de peça (ex.: CAMPANHA) dividido por item (ex.: KV).
+            </p>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        fig_pecas = px.bar(
+            contagem_pecas_familia,
+            x='Quantidade',
+            y='Família',
+            color='Item',
+            orientation='h',
+            title='Demandas por Família de Peça',
+            template=plotly_template
+        )
+        fig_pecas.update_layout(
+            height=max(300, 40 * contagem_pecas_familia['Família'].nunique() + 120),
+            xaxis_title="Número de Demandas",
+            yaxis_title="",
+            yaxis={'categoryorder': 'total ascending'},
+            font=dict(color=text_color),
+            paper_bgcolor='rgba(0,0,0,0)',
+            plot_bgcolor='rgba(0,0,0,0)'
+        )
+        st.plotly_chart(fig_pecas, use_container_width=True, config={'displayModeBar': False})
 
 # =========================================================
 # TAB 3: PESQUISA
@@ -878,31 +3475,64 @@ with tab2:
 with tab3:
     st.subheader("🔍 Pesquisa nos Dados")
     
-    texto_pesquisa = st.text_input(
-        "🔎 Pesquisar em todas as colunas:", 
-        placeholder="Digite um termo para buscar...",
-        key="pesquisa_principal"
-    )
-    
-    if texto_pesquisa:
-        mask = pd.Series(False, index=df.index)
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                try:
-                    mask = mask | df[col].astype(str).str.contains(texto_pesquisa, case=False, na=False)
-                except:
-                    pass
-        
-        resultados = df[mask]
-        
-        if len(resultados) > 0:
-            st.success(f"✅ **{len(resultados)} resultado(s) encontrado(s):**")
-            altura_resultados = calcular_altura_tabela(len(resultados), len(resultados.columns))
-            st.dataframe(resultados, use_container_width=True, height=min(altura_resultados, 800))
+    @st.fragment
+    def pesquisa():
+        """Pesquisa e resultados; digitar ou paginar reexecuta só este trecho"""
+        texto_pesquisa = st.text_input(
+            "🔎 Pesquisar em todas as colunas:", 
+            placeholder="Digite um termo para buscar...",
+            key="pesquisa_principal",
+            help="Sem acento e sem diferença de maiúsculas. "
+                 "Literal: o texto digitado inteiro é procurado como trecho de qualquer coluna (pedaços de códigos, IDs ou nomes). "
+                 "Palavra inteira: todos os termos precisam aparecer na linha como palavras completas; a última vale como "
+                 "início enquanto você digita. Use campo:valor para buscar em uma coluna (ex.: campanha:consórcio "
+                 "status:\"em produção\" alta); vale também no Literal tolerando erros, que separa os termos. "
+                 "Regex: a expressão inteira é procurada em todas as colunas."
+        )
+        
+        col_modo_pesquisa, col_tolerancia = st.columns([2, 1])
+        with col_modo_pesquisa:
+            modo_pesquisa = st.radio("Modo:", list(MODOS_PESQUISA), horizontal=True, key="modo_pesquisa")
+        with col_tolerancia:
+            tolerar_erros = st.checkbox("≈ Tolerar erros de digitação", key="pesquisa_tolerante",
+                                        disabled=MODOS_PESQUISA[modo_pesquisa] != 'trecho',
+                                        help="Separa os termos e inclui valores parecidos com cada um (semelhança de trigramas), "
+                                             "do mais para o menos parecido")
+        
+        if texto_pesquisa:
+            posicoes_pesquisa = None
+            campos_desconhecidos = ()
+            if MODOS_PESQUISA[modo_pesquisa] == 'regex':
+                if pa is None:
+                    st.info("📦 Instale o pacote pyarrow para habilitar a busca por Regex.")
+                else:
+                    try:
+                        posicoes_pesquisa, pesquisa_parcial = pesquisar_regex(snapshot, texto_pesquisa)
+                    except ValueError as erro:
+                        st.error(f"❌ {erro}")
+                    else:
+                        if pesquisa_parcial:
+                            st.warning(f"⏱️ A expressão passou de {ORCAMENTO_REGEX:.0f} s e foi interrompida: resultados parciais.")
+            elif MODOS_PESQUISA[modo_pesquisa] == 'trecho':
+                posicoes_pesquisa, campos_desconhecidos = pesquisa_incremental(snapshot, texto_pesquisa, 'trecho', tolerar_erros)
+            else:
+                posicoes_pesquisa, campos_desconhecidos = pesquisa_incremental(snapshot, texto_pesquisa)
+            if campos_desconhecidos:
+                st.caption(f"ℹ️ Campos não reconhecidos (buscados como texto): {', '.join(campos_desconhecidos)}")
+            
+            if posicoes_pesquisa is not None and len(posicoes_pesquisa) > 0:
+                st.success(f"✅ **{len(posicoes_pesquisa)} resultado(s) encontrado(s):**")
+                if MODOS_PESQUISA[modo_pesquisa] == 'trecho' and tolerar_erros:
+                    st.caption("Ordenados do mais para o menos parecido com a pesquisa.")
+                tabela_paginada("pesquisa", snapshot, posicoes_pesquisa,
+                                ('pesquisa', MODOS_PESQUISA[modo_pesquisa], tolerar_erros, texto_pesquisa),
+                                linhas_por_pagina, altura_maxima=800)
+            elif posicoes_pesquisa is not None:
+                st.warning(f"⚠️ Nenhum resultado encontrado para '{texto_pesquisa}'")
         else:
-            st.warning(f"⚠️ Nenhum resultado encontrado para '{texto_pesquisa}'")
-    else:
-        st.info("👆 Digite um termo acima para pesquisar nos dados")
+            st.info("👆 Digite um termo acima para pesquisar nos dados")
+    
+    pesquisa()
 
 # =========================================================
 # TAB 4: KPIs COCRED
@@ -928,566 +3558,549 @@ with tab4:
     </div>
     """, unsafe_allow_html=True)
     
-    # ========== FILTROS ==========
-    col_filtro_kpi1, col_filtro_kpi2, col_filtro_kpi3 = st.columns(3)
-    
-    df_kpi = df.copy()
-    
-    with col_filtro_kpi1:
-        if 'Status' in df.columns:
-            status_opcoes = ['Todos'] + sorted(df['Status'].dropna().unique().tolist())
-            status_filtro = st.selectbox("📌 Filtrar por Status:", status_opcoes, key="kpi_status")
-            if status_filtro != 'Todos':
-                df_kpi = df_kpi[df_kpi['Status'] == status_filtro]
-    
-    with col_filtro_kpi2:
-        if 'Prioridade' in df.columns:
-            prioridade_opcoes = ['Todos'] + sorted(df['Prioridade'].dropna().unique().tolist())
-            prioridade_filtro = st.selectbox("⚡ Filtrar por Prioridade:", prioridade_opcoes, key="kpi_prioridade")
-            if prioridade_filtro != 'Todos':
-                df_kpi = df_kpi[df_kpi['Prioridade'] == prioridade_filtro]
-    
-    with col_filtro_kpi3:
-        periodo_kpi = st.selectbox("📅 Período:", ["Todo período", "Últimos 30 dias", "Últimos 90 dias", "Este ano"], key="kpi_periodo")
-        
-        if periodo_kpi != "Todo período" and 'Data de Solicitação' in df_kpi.columns:
-            hoje = datetime.now().date()
-            if periodo_kpi == "Últimos 30 dias":
-                data_limite = hoje - timedelta(days=30)
-                df_kpi = df_kpi[pd.to_datetime(df_kpi['Data de Solicitação']).dt.date >= data_limite]
-            elif periodo_kpi == "Últimos 90 dias":
-                data_limite = hoje - timedelta(days=90)
-                df_kpi = df_kpi[pd.to_datetime(df_kpi['Data de Solicitação']).dt.date >= data_limite]
-            elif periodo_kpi == "Este ano":
-                data_limite = hoje.replace(month=1, day=1)
-                df_kpi = df_kpi[pd.to_datetime(df_kpi['Data de Solicitação']).dt.date >= data_limite]
-    
-    total_kpi = len(df_kpi)
-    st.divider()
-    
-    # ========== CARDS DE KPIs ==========
-    st.markdown("### 🎯 Indicadores Estratégicos")
-    
-    col_kpi1, col_kpi2, col_kpi3, col_kpi4 = st.columns(4)
-    
-    # CARD 1: CRIAÇÕES
-    if 'Tipo' in df_kpi.columns:
-        criacoes_kpi = len(df_kpi[df_kpi['Tipo'].str.contains('Criação|Criacao', na=False, case=False)])
-    else:
-        criacoes_kpi = extrair_tipo_demanda(df_kpi, 'Criação|Criacao|Novo|New')
-    
-    percent_criacoes = (criacoes_kpi / total_kpi * 100) if total_kpi > 0 else 0
-    
-    with col_kpi1:
-        st.markdown(f"""
-        <div class="metric-card-criacao">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">🎨 CRIAÇÕES</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{criacoes_kpi}</p>
-            <p style="font-size: 12px; margin: 0;">{percent_criacoes:.0f}% do total</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Peças novas desenvolvidas
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # CARD 2: DERIVAÇÕES
-    if 'Tipo' in df_kpi.columns:
-        derivacoes_kpi = len(df_kpi[df_kpi['Tipo'].str.contains('Derivação|Derivacao|Peça|Peca', na=False, case=False)])
-    else:
-        derivacoes_kpi = extrair_tipo_demanda(df_kpi, 'Derivação|Derivacao|Peça|Peca')
-    
-    percent_derivacoes = (derivacoes_kpi / total_kpi * 100) if total_kpi > 0 else 0
-    
-    with col_kpi2:
-        st.markdown(f"""
-        <div class="metric-card-derivacao">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">🔄 DERIVAÇÕES</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{derivacoes_kpi}</p>
-            <p style="font-size: 12px; margin: 0;">{percent_derivacoes:.0f}% do total</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Adaptações de peças existentes
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # CARD 3: EXTRA CONTRATO
-    if 'Tipo' in df_kpi.columns:
-        extra_kpi = len(df_kpi[df_kpi['Tipo'].str.contains('Extra|Contrato', na=False, case=False)])
-    else:
-        extra_kpi = extrair_tipo_demanda(df_kpi, 'Extra|Contrato')
-    
-    percent_extra = (extra_kpi / total_kpi * 100) if total_kpi > 0 else 0
-    
-    with col_kpi3:
-        st.markdown(f"""
-        <div class="metric-card-extra">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">📦 EXTRA CONTRATO</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{extra_kpi}</p>
-            <p style="font-size: 12px; margin: 0;">{percent_extra:.0f}% do total</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Demandas fora do escopo
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # CARD 4: CAMPANHAS ATIVAS
-    if 'Campanha' in df_kpi.columns:
-        campanhas_kpi = df_kpi['Campanha'].nunique()
-    else:
-        campanhas_kpi = len(df_kpi['ID'].unique()) // 50 if 'ID' in df_kpi.columns else 12
-    
-    with col_kpi4:
-        st.markdown(f"""
-        <div class="metric-card-campanha">
-            <p style="font-size: 14px; margin: 0; opacity: 0.9;">🚀 CAMPANHAS</p>
-            <p style="font-size: 36px; font-weight: bold; margin: 0;">{campanhas_kpi}</p>
-            <p style="font-size: 12px; margin: 0;">ativas no período</p>
-            <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
-                📌 Campanhas com demandas
-            </p>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    st.divider()
-    
-    # ========== GRÁFICOS ==========
-    col_chart1, col_chart2 = st.columns([3, 2])
-    
-    with col_chart1:
+    @st.fragment
+    def kpis_filtrados():
+        """Filtros da aba e tudo o que depende deles; mudar um filtro reexecuta só este trecho"""
+        # ========== FILTROS ==========
+        col_filtro_kpi1, col_filtro_kpi2, col_filtro_kpi3 = st.columns(3)
+        
+        # Filtros viram bitmaps combinados em uma máscara, sem cópia do DataFrame compartilhado
+        filtros_kpi = {}
+        
+        with col_filtro_kpi1:
+            if COLUNAS['status']:
+                status_opcoes = ['Todos'] + snapshot.opcoes['status']
+                status_filtro = st.selectbox("📌 Filtrar por Status:", status_opcoes, key="kpi_status")
+                if status_filtro != 'Todos':
+                    filtros_kpi[COLUNAS['status']] = status_filtro
+        
+        with col_filtro_kpi2:
+            if COLUNAS['prioridade']:
+                prioridade_opcoes = ['Todos'] + snapshot.opcoes['prioridade']
+                prioridade_filtro = st.selectbox("⚡ Filtrar por Prioridade:", prioridade_opcoes, key="kpi_prioridade")
+                if prioridade_filtro != 'Todos':
+                    filtros_kpi[COLUNAS['prioridade']] = prioridade_filtro
+        
+        with col_filtro_kpi3:
+            periodo_kpi = st.selectbox("📅 Período:", PERIODOS_KPI, key="kpi_periodo")
+            
+            consulta_kpi, mascara_kpi, comparacao_kpi = consulta_kpi_periodo(snapshot, filtros_kpi, periodo_kpi, datetime.now().date())
+            registrar_uso('kpis', {
+                'filtros': {'status': st.session_state.get('kpi_status', 'Todos'), 'prioridade': st.session_state.get('kpi_prioridade', 'Todos')},
+                'periodo': periodo_kpi,
+            })
+        
+        kpis_periodo = calcular_kpis(snapshot, mascara_kpi, consulta_kpi, aproximado=modo_aproximado)
+        total_kpi = kpis_periodo['total']
+        
+        if kpis_periodo['origem'] == 'aproximado':
+            st.caption(f"≈ Valores estimados por amostragem estratificada ({total_kpi:,} ±{kpis_periodo['erros']['total']:.0f} demandas, 95% de confiança)")
+        
+        def variacao_kpi(regra):
+            """Comparação com o período anterior, quando as contagens acumuladas cobrem os filtros"""
+            diarias = snapshot.contagens_diarias
+            if comparacao_kpi is None or diarias is None or not diarias.cobre(filtros_kpi, regra):
+                return ""
+            atual, anterior = diarias.comparar(*comparacao_kpi, filtros_kpi, regra)
+            return f'<p style="font-size: 11px; margin: 3px 0 0 0;">{formatar_variacao(variacao_percentual(atual, anterior))} vs período anterior ({anterior})</p>'
+        
+        st.divider()
+        
+        # ========== CARDS DE KPIs ==========
+        st.markdown("### 🎯 Indicadores Estratégicos")
+        
+        col_kpi1, col_kpi2, col_kpi3, col_kpi4 = st.columns(4)
+        
+        # CARD 1: CRIAÇÕES
+        criacoes_kpi = kpis_periodo['regras']['criacao']
+        
+        percent_criacoes = (criacoes_kpi / total_kpi * 100) if total_kpi > 0 else 0
+        
+        with col_kpi1:
+            st.markdown(f"""
+            <div class="metric-card-criacao">
+                <p style="font-size: 14px; margin: 0; opacity: 0.9;">🎨 CRIAÇÕES</p>
+                <p style="font-size: 36px; font-weight: bold; margin: 0;">{criacoes_kpi}{margem_erro(kpis_periodo, 'regras', 'criacao', MODELO_MARGEM_CARD)}</p>
+                <p style="font-size: 12px; margin: 0;">{percent_criacoes:.0f}% do total</p>{variacao_kpi('criacao')}
+                <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                    📌 Peças novas desenvolvidas
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # CARD 2: DERIVAÇÕES
+        derivacoes_kpi = kpis_periodo['regras']['derivacao']
+        
+        percent_derivacoes = (derivacoes_kpi / total_kpi * 100) if total_kpi > 0 else 0
+        
+        with col_kpi2:
+            st.markdown(f"""
+            <div class="metric-card-derivacao">
+                <p style="font-size: 14px; margin: 0; opacity: 0.9;">🔄 DERIVAÇÕES</p>
+                <p style="font-size: 36px; font-weight: bold; margin: 0;">{derivacoes_kpi}{margem_erro(kpis_periodo, 'regras', 'derivacao', MODELO_MARGEM_CARD)}</p>
+                <p style="font-size: 12px; margin: 0;">{percent_derivacoes:.0f}% do total</p>{variacao_kpi('derivacao')}
+                <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                    📌 Adaptações de peças existentes
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # CARD 3: EXTRA CONTRATO
+        extra_kpi = kpis_periodo['regras']['extra_contrato']
+        
+        percent_extra = (extra_kpi / total_kpi * 100) if total_kpi > 0 else 0
+        
+        with col_kpi3:
+            st.markdown(f"""
+            <div class="metric-card-extra">
+                <p style="font-size: 14px; margin: 0; opacity: 0.9;">📦 EXTRA CONTRATO</p>
+                <p style="font-size: 36px; font-weight: bold; margin: 0;">{extra_kpi}{margem_erro(kpis_periodo, 'regras', 'extra_contrato', MODELO_MARGEM_CARD)}</p>
+                <p style="font-size: 12px; margin: 0;">{percent_extra:.0f}% do total</p>{variacao_kpi('extra_contrato')}
+                <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                    📌 Demandas fora do escopo
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # CARD 4: CAMPANHAS ATIVAS
+        if COLUNAS['campanha']:
+            campanhas_kpi = kpis_periodo['distintos']['campanha']
+        else:
+            campanhas_kpi = len(df[COLUNAS['id']][mascara_kpi].unique()) // 50 if COLUNAS['id'] else 12
+        
+        with col_kpi4:
+            st.markdown(f"""
+            <div class="metric-card-campanha">
+                <p style="font-size: 14px; margin: 0; opacity: 0.9;">🚀 CAMPANHAS</p>
+                <p style="font-size: 36px; font-weight: bold; margin: 0;">{campanhas_kpi}{margem_erro(kpis_periodo, 'distintos', 'campanha', MODELO_MARGEM_CARD)}</p>
+                <p style="font-size: 12px; margin: 0;">ativas no período</p>
+                <p style="font-size: 11px; margin: 5px 0 0 0; opacity: 0.8;">
+                    📌 Campanhas com demandas
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        st.divider()
+        
+        # ========== GRÁFICOS ==========
+        col_chart1, col_chart2 = st.columns([3, 2])
+        
+        with col_chart1:
+            st.markdown("""
+            <div style="background: rgba(0, 51, 102, 0.1); padding: 10px; border-radius: 10px; margin-bottom: 10px;">
+                <p style="margin: 0; font-size: 13px;">
+                    <strong style="color: #003366;">🏆 Top Campanhas</strong> - Rankings das campanhas com maior volume.
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+            
+            if COLUNAS['campanha']:
+                campanhas_top = kpis_periodo['contagens']['campanha'].head(8).reset_index()
+                campanhas_top.columns = ['Campanha', 'Quantidade']
+                df_campanhas = campanhas_top
+            else:
+                campanhas_data = {
+                    'Campanha': ['Campanha de Crédito Automático', 'Campanha de Consórcios', 
+                                'Campanha de Crédito PJ', 'Campanha de Investimentos',
+                                'Campanha de Conta Digital', 'Atualização de TVs internas'],
+                    'Quantidade': [46, 36, 36, 36, 28, 12]
+                }
+                df_campanhas = pd.DataFrame(campanhas_data)
+            
+            fig_campanhas = px.bar(
+                df_campanhas.sort_values('Quantidade', ascending=True),
+                x='Quantidade',
+                y='Campanha',
+                orientation='h',
+                title='Top Campanhas',
+                color='Quantidade',
+                color_continuous_scale='Blues',
+                text='Quantidade',
+                template=plotly_template
+            )
+            
+            fig_campanhas.update_traces(
+                textposition='outside',
+                texttemplate='%{text}',
+                textfont=dict(size=12, color=text_color)
+            )
+            
+            fig_campanhas.update_layout(
+                height=400,
+                showlegend=False,
+                font=dict(color=text_color),
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)'
+            )
+            st.plotly_chart(fig_campanhas, use_container_width=True, config={'displayModeBar': False})
+        
+        with col_chart2:
+            st.markdown("""
+            <div style="background: rgba(0, 51, 102, 0.1); padding: 10px; border-radius: 10px; margin-bottom: 10px;">
+                <p style="margin: 0; font-size: 13px;">
+                    <strong style="color: #003366;">🎯 Distribuição por Status</strong> - Estágios das demandas.
+                </p>
+            </div>
+            """, unsafe_allow_html=True)
+            
+            if COLUNAS['status']:
+                status_dist = kpis_periodo['contagens']['status'].reset_index()
+                status_dist.columns = ['Status', 'Quantidade']
+                df_status = status_dist
+            else:
+                status_data = {
+                    'Status': ['Aprovado', 'Em Produção', 'Aguardando Aprovação', 'Concluído'],
+                    'Quantidade': [124, 89, 67, 45]
+                }
+                df_status = pd.DataFrame(status_data)
+            
+            fig_status = px.pie(
+                df_status,
+                values='Quantidade',
+                names='Status',
+                title='Demandas por Status',
+                color_discrete_sequence=['#003366', '#00A3E0', '#FF6600', '#28A745'],
+                template=plotly_template,
+                hole=0.4
+            )
+            
+            fig_status.update_traces(
+                textposition='outside', 
+                textinfo='percent+label',
+                textfont=dict(size=12, color=text_color),
+                marker=dict(line=dict(color='rgba(0,0,0,0)', width=0))
+            )
+            
+            fig_status.update_layout(
+                height=400,
+                font=dict(color=text_color),
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)',
+                showlegend=True,
+                legend=dict(
+                    orientation='h',
+                    yanchor='bottom',
+                    y=1.02,
+                    xanchor='right',
+                    x=1
+                )
+            )
+            st.plotly_chart(fig_status, use_container_width=True, config={'displayModeBar': False})
+        
+        st.divider()
+        
+        # ========== TABELA DE DEMANDAS ==========
         st.markdown("""
-        <div style="background: rgba(0, 51, 102, 0.1); padding: 10px; border-radius: 10px; margin-bottom: 10px;">
-            <p style="margin: 0; font-size: 13px;">
-                <strong style="color: #003366;">🏆 Top Campanhas</strong> - Rankings das campanhas com maior volume.
+        <div class="info-container-cocred">
+            <p style="margin: 0; font-size: 14px;">
+                <strong>📋 Demandas por Tipo de Atividade</strong> - Detalhamento do volume por tipo, com classificação.
             </p>
         </div>
         """, unsafe_allow_html=True)
         
-        if 'Campanha' in df_kpi.columns:
-            campanhas_top = df_kpi['Campanha'].value_counts().head(8).reset_index()
-            campanhas_top.columns = ['Campanha', 'Quantidade']
-            df_campanhas = campanhas_top
+        if COLUNAS['tipo_atividade']:
+            tipo_counts = kpis_periodo['contagens']['tipo_atividade'].head(8).reset_index()
+            tipo_counts.columns = ['Tipo de Atividade', 'Quantidade']
+            tipo_counts['% do Total'] = (tipo_counts['Quantidade'] / total_kpi * 100).round(1).astype(str) + '%'
+            
+            def get_status(qtd):
+                if qtd > 100:
+                    return '✅ Alto volume'
+                elif qtd > 50:
+                    return '⚠️ Médio volume'
+                else:
+                    return '🟡 Baixo volume'
+            
+            tipo_counts['Status'] = tipo_counts['Quantidade'].apply(get_status)
+            
+            st.dataframe(
+                tipo_counts,
+                use_container_width=True,
+                height=350,
+                hide_index=True,
+                column_config={
+                    "Tipo de Atividade": "📌 Tipo",
+                    "Quantidade": "🔢 Quantidade",
+                    "% do Total": "📊 %",
+                    "Status": "🚦 Classificação"
+                }
+            )
         else:
-            campanhas_data = {
-                'Campanha': ['Campanha de Crédito Automático', 'Campanha de Consórcios', 
-                            'Campanha de Crédito PJ', 'Campanha de Investimentos',
-                            'Campanha de Conta Digital', 'Atualização de TVs internas'],
-                'Quantidade': [46, 36, 36, 36, 28, 12]
-            }
-            df_campanhas = pd.DataFrame(campanhas_data)
-        
-        fig_campanhas = px.bar(
-            df_campanhas.sort_values('Quantidade', ascending=True),
-            x='Quantidade',
-            y='Campanha',
-            orientation='h',
-            title='Top Campanhas',
-            color='Quantidade',
-            color_continuous_scale='Blues',
-            text='Quantidade',
-            template=plotly_template
-        )
-        
-        fig_campanhas.update_traces(
-            textposition='outside',
-            texttemplate='%{text}',
-            textfont=dict(size=12, color=text_color)
-        )
-        
-        fig_campanhas.update_layout(
-            height=400,
-            showlegend=False,
-            font=dict(color=text_color),
-            paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)'
-        )
-        st.plotly_chart(fig_campanhas, use_container_width=True, config={'displayModeBar': False})
+            demandas_exemplo = pd.DataFrame({
+                'Tipo de Atividade': ['Evento', 'Comunicado', 'Campanha Orgânica', 
+                                      'Divulgação de Produto', 'Campanha de Incentivo', 
+                                      'E-mail Marketing', 'Redes Sociais', 'Landing Page'],
+                'Quantidade': [124, 89, 67, 45, 34, 28, 21, 15],
+                '% do Total': ['32%', '23%', '17%', '12%', '9%', '7%', '5%', '4%'],
+                'Status': ['✅ Alto volume', '✅ Alto volume', '⚠️ Médio volume', 
+                          '⚠️ Médio volume', '🟡 Baixo volume', '🟡 Baixo volume', 
+                          '🟡 Baixo volume', '🟡 Baixo volume']
+            })
+            st.dataframe(demandas_exemplo, use_container_width=True, height=350, hide_index=True)
     
-    with col_chart2:
-        st.markdown("""
-        <div style="background: rgba(0, 51, 102, 0.1); padding: 10px; border-radius: 10px; margin-bottom: 10px;">
-            <p style="margin: 0; font-size: 13px;">
-                <strong style="color: #003366;">🎯 Distribuição por Status</strong> - Estágios das demandas.
+    kpis_filtrados()
+
+# =========================================================
+# TAB 5: CONSULTA SQL
+# =========================================================
+with tab5:
+    st.subheader("🧮 Consulta SQL")
+    
+    if duckdb is None or pa is None:
+        st.info("📦 Instale os pacotes duckdb e pyarrow para habilitar as consultas SQL.")
+    else:
+        st.markdown(f"""
+        <div class="info-container-cocred">
+            <p style="margin: 0; font-size: 14px;">
+                <strong>📋 Tabela <code>demandas</code></strong> - Somente leitura (SELECT/WITH), até {LIMITE_LINHAS_SQL} linhas e {TEMPO_LIMITE_SQL}s por consulta.
+                Colunas com espaço ou acento vão entre aspas duplas, ex.: <code>"Data de Solicitação"</code>.
             </p>
         </div>
         """, unsafe_allow_html=True)
         
-        if 'Status' in df_kpi.columns:
-            status_dist = df_kpi['Status'].value_counts().reset_index()
-            status_dist.columns = ['Status', 'Quantidade']
-            df_status = status_dist
-        else:
-            status_data = {
-                'Status': ['Aprovado', 'Em Produção', 'Aguardando Aprovação', 'Concluído'],
-                'Quantidade': [124, 89, 67, 45]
-            }
-            df_status = pd.DataFrame(status_data)
-        
-        fig_status = px.pie(
-            df_status,
-            values='Quantidade',
-            names='Status',
-            title='Demandas por Status',
-            color_discrete_sequence=['#003366', '#00A3E0', '#FF6600', '#28A745'],
-            template=plotly_template,
-            hole=0.4
-        )
+        with st.expander("📑 Colunas disponíveis", expanded=False):
+            _, tabela_sql = banco_duckdb(snapshot.versao, snapshot)
+            st.dataframe(
+                pd.DataFrame({'Coluna': tabela_sql.schema.names, 'Tipo': [str(t) for t in tabela_sql.schema.types]}),
+                use_container_width=True, hide_index=True
+            )
         
-        fig_status.update_traces(
-            textposition='outside', 
-            textinfo='percent+label',
-            textfont=dict(size=12, color=text_color),
-            marker=dict(line=dict(color='rgba(0,0,0,0)', width=0))
+        coluna_status_sql = f'"{COLUNAS["status"]}"' if COLUNAS['status'] else '1'
+        consulta_sql = st.text_area(
+            "SQL:",
+            value=f"SELECT {coluna_status_sql} AS status, COUNT(*) AS quantidade\nFROM demandas\nGROUP BY 1\nORDER BY 2 DESC",
+            height=160,
+            key="consulta_sql"
         )
         
-        fig_status.update_layout(
-            height=400,
-            font=dict(color=text_color),
-            paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)',
-            showlegend=True,
-            legend=dict(
-                orientation='h',
-                yanchor='bottom',
-                y=1.02,
-                xanchor='right',
-                x=1
-            )
-        )
-        st.plotly_chart(fig_status, use_container_width=True, config={'displayModeBar': False})
-    
-    st.divider()
-    
-    # ========== TABELA DE DEMANDAS ==========
-    st.markdown("""
-    <div class="info-container-cocred">
-        <p style="margin: 0; font-size: 14px;">
-            <strong>📋 Demandas por Tipo de Atividade</strong> - Detalhamento do volume por tipo, com classificação.
-        </p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    if 'Tipo Atividade' in df_kpi.columns:
-        tipo_counts = df_kpi['Tipo Atividade'].value_counts().head(8).reset_index()
-        tipo_counts.columns = ['Tipo de Atividade', 'Quantidade']
-        tipo_counts['% do Total'] = (tipo_counts['Quantidade'] / total_kpi * 100).round(1).astype(str) + '%'
+        if st.button("▶️ Executar", type="primary", key="executar_sql"):
+            st.session_state.sql_executada = consulta_sql
         
-        def get_status(qtd):
-            if qtd > 100:
-                return '✅ Alto volume'
-            elif qtd > 50:
-                return '⚠️ Médio volume'
+        if st.session_state.get('sql_executada'):
+            inicio_sql = time.perf_counter()
+            try:
+                resultado_sql = consultar_sql(snapshot, st.session_state.sql_executada)
+            except (ValueError, TimeoutError) as erro:
+                st.error(f"❌ {erro}")
+            except duckdb.Error as erro:
+                st.error(f"❌ Erro na consulta: {erro}")
             else:
-                return '🟡 Baixo volume'
-        
-        tipo_counts['Status'] = tipo_counts['Quantidade'].apply(get_status)
-        
-        st.dataframe(
-            tipo_counts,
-            use_container_width=True,
-            height=350,
-            hide_index=True,
-            column_config={
-                "Tipo de Atividade": "📌 Tipo",
-                "Quantidade": "🔢 Quantidade",
-                "% do Total": "📊 %",
-                "Status": "🚦 Classificação"
-            }
-        )
-    else:
-        demandas_exemplo = pd.DataFrame({
-            'Tipo de Atividade': ['Evento', 'Comunicado', 'Campanha Orgânica', 
-                                  'Divulgação de Produto', 'Campanha de Incentivo', 
-                                  'E-mail Marketing', 'Redes Sociais', 'Landing Page'],
-            'Quantidade': [124, 89, 67, 45, 34, 28, 21, 15],
-            '% do Total': ['32%', '23%', '17%', '12%', '9%', '7%', '5%', '4%'],
-            'Status': ['✅ Alto volume', '✅ Alto volume', '⚠️ Médio volume', 
-                      '⚠️ Médio volume', '🟡 Baixo volume', '🟡 Baixo volume', 
-                      '🟡 Baixo volume', '🟡 Baixo volume']
-        })
-        st.dataframe(demandas_exemplo, use_container_width=True, height=350, hide_index=True)
+                st.caption(f"⏱️ {(time.perf_counter() - inicio_sql) * 1000:.0f} ms | {len(resultado_sql['df'])} linha(s)")
+                if resultado_sql['truncado']:
+                    st.warning(f"⚠️ Resultado limitado às primeiras {LIMITE_LINHAS_SQL} linhas.")
+                st.dataframe(resultado_sql['df'], use_container_width=True, height=min(calcular_altura_tabela(len(resultado_sql['df']), len(resultado_sql['df'].columns)), 600))
 
 # =========================================================
 # FILTROS AVANÇADOS (COM DATA DE SOLICITAÇÃO E DEADLINE!)
 # =========================================================
 st.header("🎛️ Filtros Avançados")
 
-# Layout com 5 colunas para acomodar os 2 filtros de data
-filtro_cols = st.columns(5)
-filtros_ativos = {}
-
-# Coluna 1: Status
-if 'Status' in df.columns:
-    with filtro_cols[0]:
-        status_opcoes = ['Todos'] + sorted(df['Status'].dropna().unique().tolist())
-        status_selecionado = st.selectbox("📌 Status:", status_opcoes, key="filtro_status")
-        if status_selecionado != 'Todos':
-            filtros_ativos['Status'] = status_selecionado
-
-# Coluna 2: Prioridade
-if 'Prioridade' in df.columns:
-    with filtro_cols[1]:
-        prioridade_opcoes = ['Todos'] + sorted(df['Prioridade'].dropna().unique().tolist())
-        prioridade_selecionada = st.selectbox("⚡ Prioridade:", prioridade_opcoes, key="filtro_prioridade")
-        if prioridade_selecionada != 'Todos':
-            filtros_ativos['Prioridade'] = prioridade_selecionada
-
-# Coluna 3: Produção
-if 'Produção' in df.columns:
-    with filtro_cols[2]:
-        producao_opcoes = ['Todos'] + sorted(df['Produção'].dropna().unique().tolist())
-        producao_selecionada = st.selectbox("🏭 Produção:", producao_opcoes, key="filtro_producao")
-        if producao_selecionada != 'Todos':
-            filtros_ativos['Produção'] = producao_selecionada
-
-# ========== COLUNA 4: FILTRO DE DATA DE SOLICITAÇÃO ==========
-with filtro_cols[3]:
-    st.markdown("**📅 Data Solicitação**")
-    
-    if 'Data de Solicitação' in df.columns:
-        datas_validas = df['Data de Solicitação'].dropna()
-        if not datas_validas.empty:
-            data_min = datas_validas.min().date()
-            data_max = datas_validas.max().date()
-            
-            periodo_opcao = st.selectbox(
-                "Período:", 
-                ["Todos", "Hoje", "Esta semana", "Este mês", "Últimos 30 dias", "Personalizado"], 
-                key="periodo_data"
-            )
-            hoje = datetime.now().date()
-            
-            if periodo_opcao == "Todos":
-                filtros_ativos['data_inicio'] = data_min
-                filtros_ativos['data_fim'] = data_max
-                filtros_ativos['tem_filtro_data'] = True
-            elif periodo_opcao == "Hoje":
-                filtros_ativos['data_inicio'] = hoje
-                filtros_ativos['data_fim'] = hoje
-                filtros_ativos['tem_filtro_data'] = True
-            elif periodo_opcao == "Esta semana":
-                inicio_semana = hoje - timedelta(days=hoje.weekday())
-                filtros_ativos['data_inicio'] = inicio_semana
-                filtros_ativos['data_fim'] = hoje
-                filtros_ativos['tem_filtro_data'] = True
-            elif periodo_opcao == "Este mês":
-                inicio_mes = hoje.replace(day=1)
-                filtros_ativos['data_inicio'] = inicio_mes
-                filtros_ativos['data_fim'] = hoje
-                filtros_ativos['tem_filtro_data'] = True
-            elif periodo_opcao == "Últimos 30 dias":
-                inicio_30d = hoje - timedelta(days=30)
-                filtros_ativos['data_inicio'] = inicio_30d
-                filtros_ativos['data_fim'] = hoje
-                filtros_ativos['tem_filtro_data'] = True
-            elif periodo_opcao == "Personalizado":
-                col1, col2 = st.columns(2)
-                with col1:
-                    data_ini = st.date_input("De", data_min, key="data_ini")
-                with col2:
-                    data_fim = st.date_input("Até", data_max, key="data_fim")
-                filtros_ativos['data_inicio'] = data_ini
-                filtros_ativos['data_fim'] = data_fim
-                filtros_ativos['tem_filtro_data'] = True
-    else:
-        st.info("ℹ️ Indisponível")
+@st.fragment
+def filtros_avancados():
+    """Filtros, resultado e exportação: mudar um filtro reexecuta só este trecho"""
+    # Layout com 5 colunas para acomodar os 2 filtros de data
+    filtro_cols = st.columns(5)
+    filtros_ativos = {}
 
-# ========== COLUNA 5: FILTRO DE DEADLINE (NOVO!) ==========
-with filtro_cols[4]:
-    st.markdown("**⏰ Deadline**")
-    
-    # Procurar por colunas de deadline/prazo
-    coluna_deadline = None
-    for col in df.columns:
-        if 'deadline' in col.lower() or 'prazo' in col.lower() or 'data entrega' in col.lower():
-            coluna_deadline = col
-            break
-    
-    if coluna_deadline is None and 'Deadline' in df.columns:
-        coluna_deadline = 'Deadline'
-    elif coluna_deadline is None and 'Prazo' in df.columns:
-        coluna_deadline = 'Prazo'
-    elif coluna_deadline is None and 'Data de Entrega' in df.columns:
-        coluna_deadline = 'Data de Entrega'
-    
-    if coluna_deadline:
-        # Garantir que é datetime
-        if not pd.api.types.is_datetime64_any_dtype(df[coluna_deadline]):
-            df[coluna_deadline] = pd.to_datetime(df[coluna_deadline], errors='coerce')
-        
-        datas_validas_deadline = df[coluna_deadline].dropna()
+    # Coluna 1: Status
+    if COLUNAS['status']:
+        with filtro_cols[0]:
+            status_opcoes = ['Todos'] + snapshot.opcoes['status']
+            status_selecionado = st.selectbox("📌 Status:", status_opcoes, key="filtro_status")
+            if status_selecionado != 'Todos':
+                filtros_ativos[COLUNAS['status']] = status_selecionado
+
+    # Coluna 2: Prioridade
+    if COLUNAS['prioridade']:
+        with filtro_cols[1]:
+            prioridade_opcoes = ['Todos'] + snapshot.opcoes['prioridade']
+            prioridade_selecionada = st.selectbox("⚡ Prioridade:", prioridade_opcoes, key="filtro_prioridade")
+            if prioridade_selecionada != 'Todos':
+                filtros_ativos[COLUNAS['prioridade']] = prioridade_selecionada
+
+    # Coluna 3: Produção
+    if COLUNAS['producao']:
+        with filtro_cols[2]:
+            producao_opcoes = ['Todos'] + snapshot.opcoes['producao']
+            producao_selecionada = st.selectbox("🏭 Produção:", producao_opcoes, key="filtro_producao")
+            if producao_selecionada != 'Todos':
+                filtros_ativos[COLUNAS['producao']] = producao_selecionada
+
+    # ========== COLUNA 4: FILTRO DE DATA DE SOLICITAÇÃO ==========
+    with filtro_cols[3]:
+        st.markdown("**📅 Data Solicitação**")
         
-        if not datas_validas_deadline.empty:
-            data_min_deadline = datas_validas_deadline.min().date()
-            data_max_deadline = datas_validas_deadline.max().date()
-            
-            periodo_opcao_deadline = st.selectbox(
-                "Período:", 
-                ["Todos", "Hoje", "Esta semana", "Este mês", "Próximos 7 dias", "Próximos 30 dias", "Atrasados", "Personalizado"], 
-                key="periodo_deadline"
-            )
-            
-            hoje = datetime.now().date()
-            
-            if periodo_opcao_deadline == "Todos":
-                filtros_ativos['deadline_inicio'] = data_min_deadline
-                filtros_ativos['deadline_fim'] = data_max_deadline
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
-                
-            elif periodo_opcao_deadline == "Hoje":
-                filtros_ativos['deadline_inicio'] = hoje
-                filtros_ativos['deadline_fim'] = hoje
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+        if COLUNAS['data_solicitacao']:
+            if 'data_solicitacao' in snapshot.limites_datas:
+                data_min, data_max = snapshot.limites_datas['data_solicitacao']
                 
-            elif periodo_opcao_deadline == "Esta semana":
-                inicio_semana = hoje - timedelta(days=hoje.weekday())
-                fim_semana = inicio_semana + timedelta(days=6)
-                filtros_ativos['deadline_inicio'] = inicio_semana
-                filtros_ativos['deadline_fim'] = fim_semana
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
-                
-            elif periodo_opcao_deadline == "Este mês":
-                inicio_mes = hoje.replace(day=1)
-                ultimo_dia = (inicio_mes + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-                filtros_ativos['deadline_inicio'] = inicio_mes
-                filtros_ativos['deadline_fim'] = ultimo_dia
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+                periodo_opcao = st.selectbox(
+                    "Período:", 
+                    list(PERIODOS_FILTRO['data_solicitacao']) + ["Personalizado"], 
+                    key="periodo_data"
+                )
+                hoje = datetime.now().date()
                 
-            elif periodo_opcao_deadline == "Próximos 7 dias":
-                filtros_ativos['deadline_inicio'] = hoje
-                filtros_ativos['deadline_fim'] = hoje + timedelta(days=7)
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+                if periodo_opcao == "Personalizado":
+                    # Padrão pelo session_state (abrir_visao também escreve nessas chaves)
+                    st.session_state.setdefault("data_ini", data_min)
+                    st.session_state.setdefault("data_fim", data_max)
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        data_ini = st.date_input("De", key="data_ini")
+                    with col2:
+                        data_fim = st.date_input("Até", key="data_fim")
+                else:
+                    data_ini, data_fim = PERIODOS_FILTRO['data_solicitacao'][periodo_opcao](hoje, data_min, data_max)
+                marcar_periodo(filtros_ativos, snapshot, 'data_solicitacao', data_ini, data_fim)
+        else:
+            st.info("ℹ️ Indisponível")
+
+    # ========== COLUNA 5: FILTRO DE DEADLINE (NOVO!) ==========
+    with filtro_cols[4]:
+        st.markdown("**⏰ Deadline**")
+        
+        # Coluna de deadline/prazo resolvida pelo esquema (já convertida para datetime na carga)
+        coluna_deadline = COLUNAS['deadline']
+        
+        if coluna_deadline:
+            if 'deadline' in snapshot.limites_datas:
+                data_min_deadline, data_max_deadline = snapshot.limites_datas['deadline']
                 
-            elif periodo_opcao_deadline == "Próximos 30 dias":
-                filtros_ativos['deadline_inicio'] = hoje
-                filtros_ativos['deadline_fim'] = hoje + timedelta(days=30)
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+                periodo_opcao_deadline = st.selectbox(
+                    "Período:", 
+                    list(PERIODOS_FILTRO['deadline']) + ["Personalizado"], 
+                    key="periodo_deadline"
+                )
                 
-            elif periodo_opcao_deadline == "Atrasados":
-                filtros_ativos['deadline_inicio'] = data_min_deadline
-                filtros_ativos['deadline_fim'] = hoje - timedelta(days=1)
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+                hoje = datetime.now().date()
                 
-            elif periodo_opcao_deadline == "Personalizado":
-                col1, col2 = st.columns(2)
-                with col1:
-                    data_ini_deadline = st.date_input("De", data_min_deadline, key="deadline_ini")
-                with col2:
-                    data_fim_deadline = st.date_input("Até", data_max_deadline, key="deadline_fim")
-                filtros_ativos['deadline_inicio'] = data_ini_deadline
-                filtros_ativos['deadline_fim'] = data_fim_deadline
-                filtros_ativos['tem_filtro_deadline'] = True
-                filtros_ativos['coluna_deadline'] = coluna_deadline
+                if periodo_opcao_deadline == "Personalizado":
+                    st.session_state.setdefault("deadline_ini", data_min_deadline)
+                    st.session_state.setdefault("deadline_fim", data_max_deadline)
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        data_ini_deadline = st.date_input("De", key="deadline_ini")
+                    with col2:
+                        data_fim_deadline = st.date_input("Até", key="deadline_fim")
+                else:
+                    data_ini_deadline, data_fim_deadline = PERIODOS_FILTRO['deadline'][periodo_opcao_deadline](hoje, data_min_deadline, data_max_deadline)
+                marcar_periodo(filtros_ativos, snapshot, 'deadline', data_ini_deadline, data_fim_deadline)
+            else:
+                st.info("ℹ️ Sem datas")
         else:
-            st.info("ℹ️ Sem datas")
+            st.info("ℹ️ Sem coluna")
+
+    # =========================================================
+    # APLICAR FILTROS
+    # =========================================================
+    # Filtros categóricos viram AND dos bitmaps do snapshot; datas, busca binária no índice ordenado
+    filtros_categoricos, janelas_datas = separar_filtros(snapshot, filtros_ativos)
+    chave_filtros = chave_consulta_filtros(filtros_categoricos, janelas_datas)
+    registrar_uso('filtros', estado_filtros_avancados())
+
+    # Visão salva aberta (e ainda com os mesmos filtros): resultado já materializado, com as colunas escolhidas
+    visao_ativa = visoes_prontas['visoes'].get(st.session_state.get('visao_salva'))
+    if visao_ativa is not None and visao_ativa['chave'] != chave_filtros:
+        visao_ativa = None
+    materializada = visao_ativa or visoes_prontas['por_chave'].get(chave_filtros)
+
+    if materializada is not None:
+        posicoes_filtradas = materializada['posicoes']
     else:
-        st.info("ℹ️ Sem coluna")
-
-# =========================================================
-# APLICAR FILTROS
-# =========================================================
-df_filtrado = df.copy()
-
-# Aplicar filtros categóricos
-for col, valor in filtros_ativos.items():
-    if col not in ['data_inicio', 'data_fim', 'tem_filtro_data', 
-                   'deadline_inicio', 'deadline_fim', 'tem_filtro_deadline', 'coluna_deadline']:
-        df_filtrado = df_filtrado[df_filtrado[col] == valor]
-
-# Aplicar filtro de data de solicitação
-if 'tem_filtro_data' in filtros_ativos and 'Data de Solicitação' in df.columns:
-    data_inicio = pd.Timestamp(filtros_ativos['data_inicio'])
-    data_fim = pd.Timestamp(filtros_ativos['data_fim']) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
-    df_filtrado = df_filtrado[
-        (df_filtrado['Data de Solicitação'] >= data_inicio) & 
-        (df_filtrado['Data de Solicitação'] <= data_fim)
-    ]
-
-# Aplicar filtro de deadline
-if 'tem_filtro_deadline' in filtros_ativos and 'coluna_deadline' in filtros_ativos:
-    col_deadline = filtros_ativos['coluna_deadline']
-    if col_deadline in df_filtrado.columns:
-        deadline_inicio = pd.Timestamp(filtros_ativos['deadline_inicio'])
-        deadline_fim = pd.Timestamp(filtros_ativos['deadline_fim']) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
-        df_filtrado = df_filtrado[
-            (df_filtrado[col_deadline] >= deadline_inicio) & 
-            (df_filtrado[col_deadline] <= deadline_fim)
-        ]
-
-# =========================================================
-# MOSTRAR RESULTADOS DOS FILTROS
-# =========================================================
-if filtros_ativos:
-    st.subheader(f"📊 Dados Filtrados ({len(df_filtrado)} de {total_linhas} registros)")
-    
-    if len(df_filtrado) > 0:
-        altura_filtrada = calcular_altura_tabela(len(df_filtrado), len(df_filtrado.columns))
-        st.dataframe(df_filtrado, use_container_width=True, height=min(altura_filtrada, 800))
-        
-        col_filtros_resumo1, col_filtros_resumo2, col_filtros_resumo3 = st.columns(3)
-        
-        with col_filtros_resumo1:
-            st.metric("📈 Registros Filtrados", len(df_filtrado))
-        
-        with col_filtros_resumo2:
-            porcentagem = (len(df_filtrado) / total_linhas * 100) if total_linhas > 0 else 0
-            st.metric("📊 % do Total", f"{porcentagem:.1f}%")
-        
-        with col_filtros_resumo3:
-            if 'tem_filtro_data' in filtros_ativos:
-                st.metric("📅 Solicitação", 
-                         f"{filtros_ativos['data_inicio'].strftime('%d/%m')} a {filtros_ativos['data_fim'].strftime('%d/%m')}")
-            elif 'tem_filtro_deadline' in filtros_ativos:
-                st.metric("⏰ Deadline", 
-                         f"{filtros_ativos['deadline_inicio'].strftime('%d/%m')} a {filtros_ativos['deadline_fim'].strftime('%d/%m')}")
-        
-        if st.button("🧹 Limpar Todos os Filtros", type="secondary", use_container_width=True):
-            for key in list(st.session_state.keys()):
-                if key.startswith('filtro_') or key in ['periodo_data', 'data_ini', 'data_fim', 
-                                                        'periodo_deadline', 'deadline_ini', 'deadline_fim']:
-                    del st.session_state[key]
-            st.rerun()
+        # Mesma combinação de filtros (em qualquer sessão) reaproveita as posições já calculadas
+        posicoes_filtradas = cache_filtros().obter(
+            snapshot.versao, chave_filtros, lambda: posicoes_filtro(snapshot, filtros_categoricos, janelas_datas)
+        )
+
+    # Só materializa as linhas uma vez, para exibição e exportação
+    df_filtrado = df if len(posicoes_filtradas) == total_linhas else df.iloc[posicoes_filtradas]
+    identidade_exportacao = ('tudo',)
+    if visao_ativa is not None:
+        colunas_visao = [col for col in visao_ativa['definicao'].get('colunas', []) if col in df.columns]
+        if colunas_visao:
+            df_filtrado = df_filtrado[colunas_visao]
+
+    # =========================================================
+    # MOSTRAR RESULTADOS DOS FILTROS
+    # =========================================================
+    if filtros_ativos:
+        st.subheader(f"📊 Dados Filtrados ({len(df_filtrado)} de {total_linhas} registros)")
+        
+        if visao_ativa is not None:
+            kpis_visao = visao_ativa['kpis']
+            st.caption(
+                f"⭐ Visão **{st.session_state.visao_salva}** (materializada às {visoes_prontas['materializadas_em'].strftime('%H:%M:%S')}) · "
+                f"✅ {kpis_visao['regras']['concluido_aprovado']:,} concluídos · 🔴 {kpis_visao['regras']['prioridade_alta']:,} prioridade alta"
+                + (f" · ⚠️ ignorados: {', '.join(visao_ativa['ignorados'])}" if visao_ativa['ignorados'] else "")
+            )
+        
+        if len(df_filtrado) > 0:
+            coluna_ordem_filtrados, decrescente_filtrados = controle_ordenacao("filtrados", df_filtrado.columns)
+            ordem_filtrados = posicoes_filtradas
+            if coluna_ordem_filtrados is not None:
+                ordem_filtrados = posicoes_ordenadas(snapshot, posicoes_filtradas, chave_filtros, coluna_ordem_filtrados, decrescente_filtrados)
+                df_filtrado = df.iloc[ordem_filtrados, df.columns.get_indexer(df_filtrado.columns)]
+            identidade_exportacao = (chave_filtros, coluna_ordem_filtrados, decrescente_filtrados, tuple(df_filtrado.columns))
+            
+            tabela_paginada("filtrados", snapshot, ordem_filtrados, (chave_filtros, coluna_ordem_filtrados, decrescente_filtrados),
+                            linhas_por_pagina, colunas=df_filtrado.columns if len(df_filtrado.columns) < len(df.columns) else None,
+                            altura_maxima=800)
+            
+            col_filtros_resumo1, col_filtros_resumo2, col_filtros_resumo3 = st.columns(3)
+            
+            with col_filtros_resumo1:
+                st.metric("📈 Registros Filtrados", len(df_filtrado))
+            
+            with col_filtros_resumo2:
+                porcentagem = (len(df_filtrado) / total_linhas * 100) if total_linhas > 0 else 0
+                st.metric("📊 % do Total", f"{porcentagem:.1f}%")
+            
+            with col_filtros_resumo3:
+                if 'tem_filtro_data' in filtros_ativos:
+                    st.metric("📅 Solicitação", 
+                             f"{filtros_ativos['data_inicio'].strftime('%d/%m')} a {filtros_ativos['data_fim'].strftime('%d/%m')}")
+                elif 'tem_filtro_deadline' in filtros_ativos:
+                    st.metric("⏰ Deadline", 
+                             f"{filtros_ativos['deadline_inicio'].strftime('%d/%m')} a {filtros_ativos['deadline_fim'].strftime('%d/%m')}")
+            
+            st.button("🧹 Limpar Todos os Filtros", type="secondary", use_container_width=True, on_click=limpar_filtros)
+        else:
+            st.warning("⚠️ Nenhum registro corresponde aos filtros aplicados.")
     else:
-        st.warning("⚠️ Nenhum registro corresponde aos filtros aplicados.")
-else:
-    st.info("👆 Use os filtros acima para refinar os dados")
+        st.info("👆 Use os filtros acima para refinar os dados")
 
-# =========================================================
-# EXPORTAÇÃO
-# =========================================================
-st.header("💾 Exportar Dados")
+    # =========================================================
+    # EXPORTAÇÃO
+    # =========================================================
+    st.header("💾 Exportar Dados")
 
-df_exportar = df_filtrado if filtros_ativos and len(df_filtrado) > 0 else df
+    df_exportar = df_filtrado if filtros_ativos and len(df_filtrado) > 0 else df
+    if df_exportar is df:
+        identidade_exportacao = ('tudo',)
 
-col_exp1, col_exp2, col_exp3 = st.columns(3)
+    col_exp1, col_exp2, col_exp3 = st.columns(3)
 
-with col_exp1:
-    csv = df_exportar.to_csv(index=False, encoding='utf-8-sig')
-    st.download_button(label="📥 Download CSV", data=csv, 
-                      file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
-                      mime="text/csv", use_container_width=True)
+    with col_exp1:
+        csv = arquivo_exportacao(snapshot, identidade_exportacao, 'csv', df_exportar)
+        st.download_button(label="📥 Download CSV", data=csv, 
+                          file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                          mime="text/csv", use_container_width=True)
 
-with col_exp2:
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df_exportar.to_excel(writer, index=False, sheet_name='Dados')
-    excel_data = output.getvalue()
-    st.download_button(label="📥 Download Excel", data=excel_data,
-                      file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-                      mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
-                      use_container_width=True)
+    with col_exp2:
+        excel_data = arquivo_exportacao(snapshot, identidade_exportacao, 'xlsx', df_exportar)
+        st.download_button(label="📥 Download Excel", data=excel_data,
+                          file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                          mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
+                          use_container_width=True)
 
-with col_exp3:
-    json_data = df_exportar.to_json(orient='records', force_ascii=False, date_format='iso')
-    st.download_button(label="📥 Download JSON", data=json_data,
-                      file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
-                      mime="application/json", use_container_width=True)
+    with col_exp3:
+        json_data = arquivo_exportacao(snapshot, identidade_exportacao, 'json', df_exportar)
+        st.download_button(label="📥 Download JSON", data=json_data,
+                          file_name=f"dados_cocred_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
+                          mime="application/json", use_container_width=True)
+
+filtros_avancados()
 
 # =========================================================
 # DEBUG INFO
@@ -1497,16 +4110,63 @@ if st.session_state.debug_mode:
     st.sidebar.markdown("**🐛 Debug Info:**")
     
     with st.sidebar.expander("Detalhes Técnicos", expanded=False):
-        st.write(f"**Cache:** 1 minuto")
+        st.write(f"**Cache:** versão verificada a cada 1 minuto")
+        st.write(f"**Versão do snapshot:** {snapshot.versao} ({snapshot.criado_em.strftime('%H:%M:%S')})")
         st.write(f"**Hora atual:** {datetime.now().strftime('%H:%M:%S')}")
         st.write(f"**DataFrame Shape:** {df.shape}")
-        st.write(f"**Memory:** {df.memory_usage(deep=True).sum() / 1024 / 1024:.2f} MB")
-        st.write(f"**Criações:** {criacoes}")
-        st.write(f"**Derivações:** {derivacoes}")
-        st.write(f"**Extra Contrato:** {extra_contrato}")
-        st.write(f"**Campanhas:** {campanhas_unicas}")
-        st.write(f"**Coluna Deadline:** {coluna_deadline if 'coluna_deadline' in locals() else 'Não encontrada'}")
+        relatorio_memoria = carga['relatorio_memoria']
+        st.write(f"**Memory:** {relatorio_memoria['Depois (KB)'].sum() / 1024:.2f} MB "
+                 f"(antes: {relatorio_memoria['Antes (KB)'].sum() / 1024:.2f} MB)")
+        st.write(f"**Colunas derivadas:** {derivadas.memory_usage(deep=True).sum() / 1024 / 1024:.2f} MB")
+        if snapshot.contagens_diarias is not None:
+            diarias = snapshot.contagens_diarias
+            st.write(f"**Contagens diárias:** {' × '.join(f'{e}({t})' for e, t in zip(diarias.eixos, diarias.forma))} × {diarias.total_dias} dias "
+                     f"= {diarias.tamanho_bytes / 1024 / 1024:.2f} MB")
+        st.write(f"**Cubo OLAP:** {' × '.join(f'{e}({t})' for e, t in zip(snapshot.cubo.eixos, snapshot.cubo.forma))} "
+                 f"= {snapshot.cubo.tamanho_bytes / 1024 / 1024:.2f} MB | KPIs pelo {'cubo' if snapshot.cubo.cobre_kpis else 'recorte de linhas'}")
+        st.write(f"**Criações:** {metricas['criacoes']}")
+        st.write(f"**Derivações:** {metricas['derivacoes']}")
+        st.write(f"**Extra Contrato:** {metricas['extra_contrato']}")
+        st.write(f"**Campanhas:** {metricas['campanhas_unicas']}")
+        st.write(f"**Coluna Deadline:** {COLUNAS['deadline'] or 'Não encontrada'}")
+        st.write(f"**Esquema:** {carga['esquema']['impressao']}")
+        for col, valores in carga['datas_invalidas'].items():
+            st.write(f"**Datas inválidas em {col}:** {len(valores)} ({', '.join(valores[:3])}{'...' if len(valores) > 3 else ''})")
         st.write(f"**Template Plotly:** {plotly_template}")
+        st.write(f"**Motor de consultas:** {'polars' if motor_polars_ativo() else 'pandas'}")
+
+    with st.sidebar.expander("Caches compartilhados", expanded=False):
+        st.write(f"**Filtros:** {cache_filtros().resumo()}")
+        st.write(f"**Páginas:** {cache_paginas().resumo()}")
+        st.write(f"**Exportações:** {cache_exportacoes().resumo()}")
+        st.write(f"**KPIs:** {cache_kpis().resumo()}")
+        if duckdb is not None and pa is not None:
+            st.write(f"**SQL:** {cache_sql().resumo()}")
+        st.write(f"**Visões:** {len(visoes_prontas['visoes'])} materializadas em {visoes_prontas['segundos'] * 1000:.0f} ms "
+                 f"({visoes_prontas['materializadas_em'].strftime('%H:%M:%S')})")
+        st.write(f"**Pré-cálculo:** {progresso_aquecimento['aquecidas']}/{progresso_aquecimento['combinacoes']} combinações "
+                 f"em {progresso_aquecimento['cpu'] * 1000:.0f} ms de CPU"
+                 + (" (orçamento esgotado)" if progresso_aquecimento['esgotado'] else "")
+                 + ("" if progresso_aquecimento['concluido'] else " | em andamento"))
+        if MODOS_PESQUISA.get(st.session_state.get('modo_pesquisa')) == 'trecho':
+            trigramas = indice_trigramas(snapshot.versao, snapshot)
+            st.write(f"**Trigramas:** {sum(len(chaves) for chaves in trigramas.chaves.values()):,} listas "
+                     f"({sum(len(omitidos) for omitidos in trigramas.omitidos.values()):,} omitidas) "
+                     f"| {trigramas.tamanho_bytes / 1024 / 1024:.2f} de {LIMITE_BYTES_TRIGRAMAS / 1024 / 1024:.0f} MB")
+        if modo_aproximado and snapshot.total_linhas >= LIMIAR_LINHAS_APROXIMADO:
+            amostra = amostra_estratificada(snapshot.versao, snapshot)
+            st.write(f"**Amostra:** {len(amostra.posicoes):,} linhas em {int(np.count_nonzero(amostra.linhas_estrato))} estratos "
+                     f"| {amostra.tamanho_bytes / 1024 / 1024:.2f} MB")
+
+    with st.sidebar.expander("Grafo de métricas", expanded=False):
+        st.graphviz_chart(metricas.grafo_dot(), use_container_width=True)
+        lidas = metricas.execucao
+        st.caption(f"{len(lidas)} de {len(METRICAS)} métricas lidas nesta execução | "
+                   f"{sum(1 for e in lidas.values() if e['origem'] == 'calculada')} calculadas | "
+                   f"{sum(e['segundos'] for e in lidas.values()) * 1000:.2f} ms no total")
+
+    with st.sidebar.expander("Memória por coluna", expanded=False):
+        st.dataframe(carga['relatorio_memoria'], use_container_width=True, hide_index=True)
 
 # =========================================================
 # RODAPÉ
@@ -0,0 +1,80 @@
+# verificar_paridade.py
+"""Paridade pandas × Polars fora do dashboard.
+
+Carrega as definições do app.py (tudo antes da carga dos dados e da interface), monta o
+snapshot dos dados de exemplo - ou da planilha passada como argumento - e compara filtros
+e KPIs nos dois motores. Sai com código 1 quando alguma consulta diverge.
+
+Sai com código 2 quando faltam dependências ou quando o app.py não tem mais o marcador
+INICIO_INTERFACE (a linha que abre a carga dos dados).
+
+Uso: python scripts/verificar_paridade.py [planilha.xlsx]
+"""
+import logging
+import os
+import sys
+import warnings
+from io import BytesIO
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app.py')
+INICIO_INTERFACE = 'with st.spinner("📥 Carregando dados do Excel...")'
+
+class InterfaceNaoEncontrada(Exception):
+    """O app.py não tem mais o marcador que separa as definições da interface"""
+
+def carregar_app():
+    """Executa só as definições do app.py; o Streamlit roda sem servidor (bare mode).
+    Sem .streamlit/secrets.toml as configurações ficam nos padrões (a paridade não usa a API)."""
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings('ignore')
+    import streamlit as st
+    if not st.secrets.load_if_toml_exists():
+        st.secrets = {}
+    with open(APP, encoding='utf-8') as arquivo:
+        fonte = arquivo.read()
+    if INICIO_INTERFACE not in fonte:
+        raise InterfaceNaoEncontrada(INICIO_INTERFACE)
+    app = {'__name__': 'app', '__file__': APP}
+    exec(compile(fonte[:fonte.index(INICIO_INTERFACE)], APP, 'exec'), app)
+    return app
+
+def consultas_paridade(app, snapshot):
+    """Sem filtros, um status, um período e mês + prioridade (quando a planilha tem as colunas)"""
+    consultas = {'Sem filtros': {'filtros': {}, 'meses': None}}
+    if snapshot.colunas['status']:
+        consultas['Status'] = {'filtros': {snapshot.colunas['status']: snapshot.opcoes['status'][0]}, 'meses': None}
+    if snapshot.limites_datas.get('data_solicitacao'):
+        inicio, fim = snapshot.limites_datas['data_solicitacao']
+        meio = inicio + (fim - inicio) / 2
+        consultas['Período'] = {'filtros': {}, 'meses': None,
+                                'janelas': {'data_solicitacao': (app['dia_epoca'](meio), app['dia_epoca'](fim))}}
+        consultas['Mês + Prioridade'] = {
+            'filtros': {snapshot.colunas['prioridade']: snapshot.opcoes['prioridade'][0]} if snapshot.colunas['prioridade'] else {},
+            'meses': (app['chave_mes_de'](meio), None),
+        }
+    return consultas
+
+def main(argumentos):
+    try:
+        app = carregar_app()
+    except InterfaceNaoEncontrada as erro:
+        print(f"❌ Marcador do início da interface não encontrado no app.py: {erro}\n"
+              "   Atualize INICIO_INTERFACE em scripts/verificar_paridade.py.")
+        return 2
+    if app['pl'] is None or app['pa'] is None:
+        print("❌ Instale polars e pyarrow para verificar a paridade.")
+        return 2
+    if argumentos:
+        with open(argumentos[0], 'rb') as arquivo:
+            conteudo = arquivo.read()
+        app['carregar_dados_excel_online'] = lambda: app['ler_planilha'](BytesIO(conteudo), sheet_name=app['SHEET_NAME'])
+        snapshot = app['construir_snapshot'](argumentos[0])
+    else:
+        snapshot = app['snapshot_exemplo']()
+    print(f"📊 {snapshot.total_linhas:,} linhas ({snapshot.carga['origem']})")
+    resultado = app['verificar_paridade'](snapshot, consultas_paridade(app, snapshot))
+    print(resultado.to_string(index=False))
+    return 0 if resultado['Resultado'].str.startswith('✅').all() else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))